@@ -1,36 +1,305 @@
-from astroquery.gaia import GaiaClass
+import contextlib
+import getpass
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
 from ashla import utils
 import ashla.data_access.config as cnf
 from ashla.data_access.binary_data import BinaryStarDataFrame
-
-
-class GaiaDataAccess(GaiaClass):
+from ashla.data_access import arrow_results
+from ashla.data_access import close_pairs
+from ashla.data_access import crossmatch
+from ashla.data_access import job_scheduler
+from ashla.data_access import metrics
+from ashla.data_access import parquet_io
+from ashla.data_access import query_cache
+from ashla.data_access import result_streaming
+from ashla.data_access import session_pool
+
+logger = logging.getLogger(__name__)
+
+# Methods of the Astroquery Gaia class which GaiaDataAccess passes on to it (logging in first, if needed). Only these
+# are passed on, so probing for other attributes (hasattr, copy, pickle, IPython's _repr_html_, ...) never logs in.
+GAIA_METHODS = frozenset(['launch_job', 'launch_job_async', 'load_async_job', 'list_async_jobs', 'search_async_jobs',
+                          'remove_jobs', 'load_tables', 'load_table', 'load_data', 'get_datalinks', 'query_object',
+                          'query_object_async', 'cone_search', 'cone_search_async', 'upload_table',
+                          'delete_user_table', 'update_user_table', 'share_table', 'share_group_create',
+                          'share_group_delete', 'share_group_add_user', 'share_group_delete_user', 'load_groups',
+                          'load_group', 'load_shared_items', 'cross_match'])
+
+
+class GaiaDataAccess:
     """
 
     Proxy for the Gaia Query (TAP) class. Uses a login class for login details, and contains easier to use functions
     to get data.
 
+    Query results can be cached on disk (see query_cache.QueryCache) by giving a cache_dir. gaia_query_to_pandas, and
+    so the built in queries, then reuse the results of an identical query rather than running it again.
+
+    The Astroquery Gaia class (and so astroquery and astropy) is only imported, and the login only happens, when it is
+    first needed, usually for the first job. Creating a GaiaDataAccess is instant, and queries answered from the cache
+    never log in. The Astroquery Gaia methods in GAIA_METHODS (launch_job_async, load_async_job, load_tables, ...) are
+    passed on to the Astroquery Gaia class. Use connect and disconnect (or login, login_gui and logout) to log in and
+    out.
+
+    Sessions can be renewed: after session_max_age seconds, or when the archive rejects the login of a job, the next
+    job logs in again. Jobs hold the session they run on (see session) until they finish, and a replaced session is
+    only logged out once no job holds it. The module level helpers share sessions through session_pool.SessionPool.
+
     """
 
-    def __init__(self, login_config=None):
-        super(GaiaDataAccess, self).__init__()
+    def __init__(self, login_config=None, cache_dir=None, cache_ttl=None, cache_max_size_bytes=None,
+                 defer_login=True, metrics_recorder=None, session_max_age=None):
+        """
+
+        Args:
+            login_config (str): Optional, default None. Path of the login config file (see config.GaiaLoginConf). If
+                None, you are prompted for your login details at login.
+            cache_dir (str): Optional, default None. Directory of the query cache. None for no cache.
+            cache_ttl (float): Optional, default None. Seconds before cached results expire.
+            cache_max_size_bytes (int): Optional, default None. Maximum size of the query cache.
+            defer_login (bool): Optional, default True. Log in on first use rather than now.
+            metrics_recorder (metrics.MetricsRecorder): Optional, default None. Records the time, rows and bytes of
+                each stage of the queries (submission, queue wait, download, to_pandas, ...). If None, the active
+                recorder (see metrics.set_recorder) is used, which records nothing by default.
+            session_max_age (float): Optional, default None. Seconds before the session logs in again. None to keep
+                the first login.
+
+        """
         self.login_config = login_config
-        if self.login_config is None:
-            # You can type in your details
-            self.login()
+        self.metrics_recorder = metrics_recorder
+        self.session_max_age = session_max_age
+        self.query_cache = None
+        if cache_dir is not None:
+            self.query_cache = query_cache.QueryCache(cache_dir, ttl=cache_ttl, max_size_bytes=cache_max_size_bytes)
+        self._gaia = None
+        self._gaia_lock = threading.Lock()
+        # id of a session -> number of jobs holding it, and the replaced sessions still held
+        self._session_users = {}
+        self._retired_sessions = {}
+        self._login_time = None
+        self._login_details = None
+        if not defer_login:
+            self.connect()
+
+    def _get_login_details(self):
+        if self._login_details is None:
+            if self.login_config is None:
+                # You can type in your details. They are kept, so renewing the session doesn't ask again.
+                self._login_details = (input("User: "), getpass.getpass("Password: "))
+            else:
+                login_conf_inst = cnf.GaiaLoginConf(config_file=self.login_config)
+                self._login_details = (login_conf_inst.user, login_conf_inst.password)
+        return self._login_details
+
+    def session_expired(self):
+        """
+
+        Returns:
+            bool: True if logged in for longer than session_max_age.
+
+        """
+        return (self.session_max_age is not None and self._login_time is not None and
+                time.monotonic() - self._login_time > self.session_max_age)
+
+    def connect(self):
+        """
+
+        Creates the Astroquery Gaia class and logs in, if not done already (or if the session has expired). Thread
+        safe, so concurrent jobs (e.g. from JobScheduler) share one login.
+
+        Returns:
+            GaiaClass: The logged in Astroquery Gaia class.
+
+        """
+        with self._gaia_lock:
+            return self._connect_locked()
+
+    def _connect_locked(self):
+        if self._gaia is None or self.session_expired():
+            from astroquery.gaia import GaiaClass
+            gaia = GaiaClass()
+            user, password = self._get_login_details()
+            gaia.login(user=user, password=password)
+            self._install_session_locked(gaia)
+        return self._gaia
+
+    def _install_session_locked(self, gaia):
+        previous = self._gaia
+        self._gaia = gaia
+        self._login_time = time.monotonic() if gaia is not None else None
+        if previous is not None:
+            self._retire_session_locked(previous)
+
+    def _retire_session_locked(self, gaia):
+        # Jobs still running on a replaced session keep using it, so it is only logged out once they have finished
+        if self._session_users.get(id(gaia)):
+            self._retired_sessions[id(gaia)] = gaia
         else:
-            login_conf_inst = cnf.GaiaLoginConf(config_file=self.login_config)
-            self.login(user=login_conf_inst.user, password=login_conf_inst.password)
+            _logout(gaia)
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+
+        Context manager holding the logged in session (connecting if needed) for the whole of a job: launching it,
+        waiting for it and downloading its results. If the session is replaced meanwhile (see renew), it is only
+        logged out once every job holding it has finished.
+
+        Yields:
+            GaiaClass: The logged in Astroquery Gaia class.
+
+        """
+        with self._gaia_lock:
+            gaia = self._connect_locked()
+            self._session_users[id(gaia)] = self._session_users.get(id(gaia), 0) + 1
+        try:
+            yield gaia
+        finally:
+            with self._gaia_lock:
+                self._session_users[id(gaia)] -= 1
+                if not self._session_users[id(gaia)]:
+                    del self._session_users[id(gaia)]
+                    if self._retired_sessions.pop(id(gaia), None) is not None:
+                        _logout(gaia)
+
+    def _run_on_session(self, func):
+        """
+
+        Runs func(gaia) holding the session (see session). If the archive has ended the session (rejecting its
+        login), logs in again and runs func once more.
+
+        """
+        with self.session() as gaia:
+            try:
+                return func(gaia)
+            except Exception as ex:
+                if not _is_login_error(ex):
+                    raise
+        self.renew(gaia)
+        with self.session() as gaia:
+            return func(gaia)
+
+    def renew(self, expired_gaia=None):
+        """
+
+        Logs in again with a new Astroquery Gaia class. The replaced session is logged out (so the archive doesn't
+        keep it) once no job holds it.
+
+        Args:
+            expired_gaia (GaiaClass): Optional, default None. The session found to be expired. If another thread has
+                already replaced it, its new session is used rather than logging in again.
+
+        Returns:
+            GaiaClass: The logged in Astroquery Gaia class.
+
+        """
+        with self._gaia_lock:
+            if self._gaia is not None and (expired_gaia is None or self._gaia is expired_gaia):
+                self._install_session_locked(None)
+        logger.info("Renewing the Gaia Archive session")
+        return self.connect()
+
+    def disconnect(self):
+        """
+
+        Logs out (once no job holds the session), if logged in. The next job logs in again.
+
+        """
+        with self._gaia_lock:
+            self._install_session_locked(None)
+
+    def login(self, user=None, password=None, credentials_file=None, verbose=False):
+        """
+
+        Logs in now, as the Astroquery Gaia login does, replacing the current session (see renew). The login details
+        are kept, so renewing the session logs in with them again.
+
+        Args:
+            user (str): Optional, default None. User name. If None (and no credentials_file), the login details from
+                login_config are used, or you are prompted for them.
+            password (str): Optional, default None. Password. If None with a user, you are prompted for it.
+            credentials_file (str): Optional, default None. File with the user name on the first line and the password
+                on the second.
+            verbose (bool): Optional, default False. Log the login.
+
+        Returns:
+            GaiaClass: The logged in Astroquery Gaia class.
+
+        """
+        if credentials_file is not None:
+            with open(credentials_file, 'r') as f:
+                user, password = f.readline().strip(), f.readline().strip()
+        if user is not None:
+            if password is None:
+                password = getpass.getpass("Password: ")
+            self._login_details = (user, password)
+        gaia = self.renew()
+        if verbose:
+            logger.info("Logged in to the Gaia Archive")
+        return gaia
+
+    def login_gui(self, verbose=False):
+        """
+
+        Logs in now with the Astroquery Gaia login window, replacing the current session (see renew). Renewing the
+        session later uses login_config, or prompts for the login details.
+
+        Args:
+            verbose (bool): Optional, default False. Passed on to the Astroquery Gaia login_gui.
+
+        Returns:
+            GaiaClass: The logged in Astroquery Gaia class.
+
+        """
+        from astroquery.gaia import GaiaClass
+        gaia = GaiaClass()
+        gaia.login_gui(verbose=verbose)
+        with self._gaia_lock:
+            self._install_session_locked(gaia)
+        return gaia
+
+    def logout(self, verbose=False):
+        """
+
+        Logs out, as the Astroquery Gaia logout does (see disconnect).
+
+        Args:
+            verbose (bool): Optional, default False. Log the logout.
+
+        """
+        self.disconnect()
+        if verbose:
+            logger.info("Logged out of the Gaia Archive")
+
+    @property
+    def gaia(self):
+        return self.connect()
+
+    @property
+    def recorder(self):
+        return self.metrics_recorder if self.metrics_recorder is not None else metrics.get_recorder()
+
+    def __getattr__(self, item):
+        if item not in GAIA_METHODS:
+            raise AttributeError("'{0}' object has no attribute '{1}'".format(type(self).__name__, item))
+        return getattr(self.connect(), item)
+
+    def launch_gaia_job(self, query, asyncronous=True, **kwargs):
+        # If the archive has ended the session, logs in again and resubmits
+        return self._run_on_session(lambda gaia: _launch_job(gaia, query, asyncronous, **kwargs))
 
     def get_gaia_job(self, query, asyncronous=True, **kwargs):
-        if asyncronous:
-            j1 = self.launch_job_async(query, **kwargs)
-        else:
-            j1 = self.launch_job(query, **kwargs)
-        job = j1.get_results()
-        return job
+        return self._run_on_session(lambda gaia: _launch_job(gaia, query, asyncronous, **kwargs).get_results())
 
-    def get_old_job_data(self, jobid, return_binary_inst=True, parquet_output_name=None):
+    def get_old_job_data(self, jobid, return_binary_inst=True, parquet_output_name=None, arrow_backed=False):
         """
 
         Function to grab the data from an old asyncronous TAP job. Saves the time for running the job. Great for large
@@ -41,26 +310,141 @@ class GaiaDataAccess(GaiaClass):
             return_binary_inst (bool): If True, returns BinaryStarDataFrame DataFrame proxy object, otherwise table obj.
             parquet_output_name (str): Optional, default None. If set, will save a Parquet file with this name (as a
             prefix).
+            arrow_backed (bool): Optional, default False. If return_binary_inst is True, convert the results through
+                Arrow (see gaia_query_to_pandas), for a lower peak memory.
 
         Returns:
             BinaryStarDataFrame: If return_binary_inst is True or Table. Contains the table data from the job.
 
         """
-        j1 = self.load_async_job(jobid)
-        job = j1.get_results()
+        job = self._run_on_session(lambda gaia: gaia.load_async_job(jobid=jobid).get_results())
+        if arrow_backed and return_binary_inst:
+            table = arrow_results.table_to_arrow(job, consume=True)
+            if parquet_output_name is not None:
+                self.data_save_parquet(table, output_file_name=parquet_output_name)
+            return BinaryStarDataFrame.from_arrow(table, arrow_backed=True)
         dta_pd = job.to_pandas()
         if parquet_output_name is not None:
             self.data_save_parquet(dta_pd, output_file_name=parquet_output_name)
         if return_binary_inst:
-            return BinaryStarDataFrame(dta_pd)
+            return BinaryStarDataFrame(dta_pd, compact=True)
         return job
 
-    def gaia_query_to_pandas(self, query, parquet_output_name=None, **kwargs):
+    def download_job_results(self, query=None, jobid=None, output_format='csv', output_file=None, **kwargs):
+        """
+
+        Runs a query (or loads an old asyncronous job) and saves the results straight to a file, without parsing them
+        into memory. Use with result_streaming to read the file in chunks.
+
+        Args:
+            query (str): Query to send to the Gaia Archive. Either this or jobid must be given.
+            jobid (str): Job ID of an old asyncronous job.
+            output_format (str): Optional, default 'csv'. Results format for a new query. 'csv' and 'fits' can be
+                read incrementally. Old jobs keep the format they were run with.
+            output_file (str): Optional, default None. File to save the results to. If None, Astroquery picks a
+                name in the current directory.
+
+        Kwargs:
+            See gaia_query_to_pandas.
+
+        Returns:
+            (str, str): Path of the results file, and its output format.
+
+        """
+        if query is not None:
+            job = self.launch_gaia_job(query, output_format=output_format, dump_to_file=True,
+                                       output_file=output_file, **kwargs)
+        elif jobid is not None:
+            def save_results(gaia):
+                old_job = gaia.load_async_job(jobid=jobid, load_results=False)
+                if output_file is not None:
+                    old_job.outputFileUser = output_file
+                old_job.save_results()
+                return old_job
+
+            job = self._run_on_session(save_results)
+            output_format = job.parameters.get('format', output_format)
+        else:
+            raise ValueError("Either query or jobid must be given.")
+        return job.outputFile if job.outputFile is not None else output_file, output_format
+
+    def iter_job_chunks(self, query=None, jobid=None, chunk_rows=1000000, output_format='csv', keep_download=False,
+                        **kwargs):
+        """
+
+        Streams the results of a query (or an old asyncronous job) as BinaryStarDataFrame chunks. The results are
+        downloaded to disk, then parsed one chunk at a time, so peak memory depends on chunk_rows rather than on the
+        size of the results.
+
+        Args:
+            query (str): Query to send to the Gaia Archive. Either this or jobid must be given.
+            jobid (str): Job ID of an old asyncronous job (run with a 'csv' or 'fits' output format).
+            chunk_rows (int): Maximum number of rows per chunk.
+            output_format (str): Optional, default 'csv'. 'csv' or 'fits'.
+            keep_download (bool): Keep the downloaded results file, rather than deleting it at the end.
+
+        Kwargs:
+            See gaia_query_to_pandas.
+
+        Yields:
+            BinaryStarDataFrame: The next chunk of rows.
+
+        """
+        download_dir = tempfile.mkdtemp(prefix='ashla_job_')
+        try:
+            output_file = os.path.join(download_dir, "results.{0}".format(output_format))
+            file_path, output_format = self.download_job_results(query=query, jobid=jobid,
+                                                                 output_format=output_format,
+                                                                 output_file=output_file, **kwargs)
+            for chunk in result_streaming.iter_result_file_chunks(file_path, output_format, chunk_rows=chunk_rows):
+                yield chunk
+        finally:
+            if not keep_download:
+                shutil.rmtree(download_dir, ignore_errors=True)
+
+    def job_to_parquet_dataset(self, output_dir, query=None, jobid=None, chunk_rows=1000000, output_format='csv',
+                               **kwargs):
+        """
+
+        Streams the results of a query (or an old asyncronous job) into a Parquet dataset (a directory of part
+        files), without holding all of the results in memory.
+
+        Args:
+            output_dir (str): Directory for the dataset.
+            query (str): Query to send to the Gaia Archive. Either this or jobid must be given.
+            jobid (str): Job ID of an old asyncronous job (run with a 'csv' or 'fits' output format).
+            chunk_rows (int): Maximum number of rows per part file.
+            output_format (str): Optional, default 'csv'. 'csv' or 'fits'.
+
+        Kwargs:
+            See gaia_query_to_pandas.
+
+        Returns:
+            list: Paths of the part files written.
+
+        """
+        download_dir = tempfile.mkdtemp(prefix='ashla_job_')
+        try:
+            output_file = os.path.join(download_dir, "results.{0}".format(output_format))
+            file_path, output_format = self.download_job_results(query=query, jobid=jobid,
+                                                                 output_format=output_format,
+                                                                 output_file=output_file, **kwargs)
+            return result_streaming.result_file_to_parquet_dataset(file_path, output_format, output_dir,
+                                                                   chunk_rows=chunk_rows)
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+    def gaia_query_to_pandas(self, query, parquet_output_name=None, use_cache=True, arrow_backed=False, **kwargs):
         """
 
         Args:
             query (str): Query to send to the Gaia Archive.
             parquet_output_name (str): Optional, default None. If set, will output a Parquet file of this name prefix.
+            use_cache (bool): Optional, default True. If False, always run the query, even if the results are in the
+                query cache (the new results still replace the cached ones).
+            arrow_backed (bool): Optional, default False. Convert the results through Arrow (see gaia_query_to_arrow)
+                into an Arrow backed BinaryStarDataFrame, rather than with to_pandas. Peak memory is then about the
+                size of the results, rather than several times it.
 
         Kwargs:
             output_file (str): optional, default None
@@ -87,18 +471,234 @@ class GaiaDataAccess(GaiaClass):
         Returns:
 
         """
-        job = self.get_gaia_job(query, **kwargs)
-        gaia_data = job.to_pandas()
+        if arrow_backed:
+            table = self.gaia_query_to_arrow(query, parquet_output_name=parquet_output_name, use_cache=use_cache,
+                                             compression='gzip', **kwargs)
+            with self.recorder.stage('binary_star_df', rows=table.num_rows):
+                return BinaryStarDataFrame.from_arrow(table, arrow_backed=True)
+        recorder = self.recorder
+        gaia_data = None
+        if self.query_cache is not None and use_cache:
+            with recorder.stage('cache_lookup') as record:
+                gaia_data = self.query_cache.get(query, job_kwargs=kwargs)
+                record['hit'] = gaia_data is not None
+        if gaia_data is None:
+            j1, results = self._run_job_stages(query, recorder, **kwargs)
+            with recorder.stage('to_pandas', rows=len(results)):
+                gaia_data = results.to_pandas()
+            if self.query_cache is not None:
+                with recorder.stage('cache_put', rows=len(gaia_data)):
+                    self.query_cache.put(query, gaia_data, job_id=getattr(j1, 'jobid', None), job_kwargs=kwargs)
         if parquet_output_name is not None:
             self.data_save_parquet(gaia_data, output_file_name=parquet_output_name)
-        return BinaryStarDataFrame(gaia_data)
+        with recorder.stage('binary_star_df', rows=len(gaia_data)):
+            return BinaryStarDataFrame(gaia_data, compact=True)
+
+    def gaia_query_to_arrow(self, query, parquet_output_name=None, use_cache=True, compression='zstd', **kwargs):
+        """
+
+        Runs a query and returns the results as an Arrow table. The columns are converted from the buffers of the
+        results table (see arrow_results.table_to_arrow), without copying where their dtypes allow, and each column of
+        the results table is freed once converted. Parquet files are written straight from Arrow.
+
+        Args:
+            query (str): Query to send to the Gaia Archive.
+            parquet_output_name (str): Optional, default None. If set, will output a Parquet file of this name prefix.
+            use_cache (bool): Optional, default True. If False, always run the query, even if the results are in the
+                query cache.
+            compression (str): Compression codec of the Parquet file, see data_save_parquet.
+
+        Kwargs:
+            See gaia_query_to_pandas.
+
+        Returns:
+            pa.Table: Results of the query.
+
+        """
+        recorder = self.recorder
+        table = None
+        if self.query_cache is not None and use_cache:
+            with recorder.stage('cache_lookup') as record:
+                table = self.query_cache.get(query, as_arrow=True, job_kwargs=kwargs)
+                record['hit'] = table is not None
+        if table is None:
+            j1, results = self._run_job_stages(query, recorder, **kwargs)
+            with recorder.stage('to_arrow', rows=len(results)):
+                table = arrow_results.table_to_arrow(results, consume=True)
+            if self.query_cache is not None:
+                with recorder.stage('cache_put', rows=table.num_rows):
+                    self.query_cache.put(query, table, job_id=getattr(j1, 'jobid', None), job_kwargs=kwargs)
+        if parquet_output_name is not None:
+            self.data_save_parquet(table, output_file_name=parquet_output_name, compression=compression)
+        return table
+
+    def _run_job_stages(self, query, recorder, asyncronous=True, **kwargs):
+        """
+
+        Runs a job and gets its results table, holding the session until the results are downloaded (see session).
+        When recording metrics, asyncronous jobs are run in the background, so submission, queue wait and download
+        (and parsing) are recorded as separate stages.
+
+        Returns:
+            (Job, astropy.table.Table): The job and its results.
+
+        """
+        return self._run_on_session(lambda gaia: self._job_stages(gaia, query, recorder, asyncronous, **kwargs))
+
+    def _job_stages(self, gaia, query, recorder, asyncronous, **kwargs):
+        if not recorder.enabled or not asyncronous or 'background' in kwargs:
+            with recorder.stage('job') as record:
+                j1 = _launch_job(gaia, query, asyncronous, **kwargs)
+                results = j1.get_results()
+                record['job_id'] = getattr(j1, 'jobid', None)
+                record['rows'] = len(results)
+            return j1, results
+
+        with recorder.stage('job_submit') as record:
+            j1 = _launch_job(gaia, query, background=True, **kwargs)
+            record['job_id'] = j1.jobid
+        with recorder.stage('queue_wait', job_id=j1.jobid) as record:
+            record['phase'] = j1.wait_for_job_end()[1]
+        if kwargs.get('dump_to_file'):
+            with recorder.stage('download', job_id=j1.jobid) as record:
+                j1.save_results()
+                record['bytes'] = os.path.getsize(j1.outputFile)
+            with recorder.stage('parse', job_id=j1.jobid) as record:
+                results = j1.get_results()
+                record['rows'] = len(results)
+        else:
+            with recorder.stage('download_parse', job_id=j1.jobid) as record:
+                results = j1.get_results()
+                record['rows'] = len(results)
+                record['bytes'] = metrics.table_nbytes(results)
+        return j1, results
+
+    def run_queries(self, queries, output_dir=None, max_concurrent=4, max_retries=2, **kwargs):
+        """
+
+        Runs many queries as concurrent asyncronous jobs (see job_scheduler.JobScheduler).
+
+        Args:
+            queries (list): ADQL queries.
+            output_dir (str): Optional, default None. If set, each query's results are written to a Parquet file in
+                this directory as soon as its job finishes, rather than combined in memory.
+            max_concurrent (int): Maximum number of jobs running at once.
+            max_retries (int): Number of times a failed job is retried.
+
+        Kwargs:
+            parquet_kwargs (dict): Arguments of parquet_io.write_parquet for the files in output_dir, see
+                job_scheduler.JobScheduler.run.
+            See gaia_query_to_pandas.
+
+        Returns:
+            BinaryStarDataFrame or list: The combined results, or the Parquet files written if output_dir is set.
+
+        """
+        scheduler = job_scheduler.JobScheduler(self, max_concurrent=max_concurrent, max_retries=max_retries)
+        return scheduler.run(queries, output_dir=output_dir, **kwargs)
+
+    def cross_match_upload(self, data, columns=('g.*',), table='gaiaedr3.gaia_source', on='source_id',
+                           radius_arcsec=1., max_upload_bytes=crossmatch.DEFAULT_MAX_UPLOAD_BYTES,
+                           votable_format='binary', max_concurrent=4, max_retries=2, **kwargs):
+        """
+
+        Gets archive columns for local rows (e.g. candidates in a BinaryStarDataFrame), by uploading their IDs (or
+        positions) and joining them to an archive table. The upload is split into VOTables of at most
+        max_upload_bytes, whose join queries run as concurrent jobs (see run_queries). The query cache keys include
+        the content of each chunk's upload, so chunks already run are answered from the query cache.
+
+        Args:
+            data (pd.DataFrame): Rows to match, e.g. a BinaryStarDataFrame.
+            columns (list): Optional, default all columns. Columns (or ADQL expressions) of the archive table, aliased
+                g, to get, e.g. ['g.phot_g_mean_mag', 'g.bp_rp'].
+            table (str): Optional, default 'gaiaedr3.gaia_source'. Archive table to match to.
+            on (str or tuple): Optional, default 'source_id'. Column matched to the same column of the archive table,
+                or (ra column, dec column) in degrees to match the nearest source within radius_arcsec (the archive
+                positions are at the epoch of the table, so use positions at that epoch).
+            radius_arcsec (float): Optional, default 1. Match radius of a positional match.
+            max_upload_bytes (int): Optional, default crossmatch.DEFAULT_MAX_UPLOAD_BYTES. Maximum size of each upload.
+            votable_format (str): Optional, default 'binary'. VOTable serialization of the uploads (see
+                crossmatch.write_upload_chunks).
+            max_concurrent (int): Maximum number of jobs running at once.
+            max_retries (int): Number of times a failed job is retried.
 
-    def data_save_parquet(self, data, output_file_name):
-        data.to_parquet("{0}.parquet.gzip".format(output_file_name), compression='gzip')
+        Kwargs:
+            See gaia_query_to_pandas.
+
+        Returns:
+            BinaryStarDataFrame: The archive columns, one row per row of data and with its index, so they can be
+                joined to it (data.join(matches)). Rows with no match have missing values. A positional match also
+                has the match distance, in match_dist_arcsec.
+
+        """
+        upload = crossmatch.upload_table(data, on)
+        if len(upload) == 0:
+            return BinaryStarDataFrame(pd.DataFrame(index=data.index))
+        with tempfile.TemporaryDirectory() as upload_dir:
+            chunks = crossmatch.write_upload_chunks(upload, upload_dir, max_upload_bytes=max_upload_bytes,
+                                                    votable_format=votable_format)
+            query = crossmatch.crossmatch_query(columns, table, on, radius_arcsec=radius_arcsec)
+            job_kwargs = [{'upload_resource': path, 'upload_table_name': crossmatch.UPLOAD_TABLE_NAME}
+                          for path in chunks]
+            scheduler = job_scheduler.JobScheduler(self, max_concurrent=max_concurrent, max_retries=max_retries)
+            results = scheduler.run([query] * len(chunks), job_kwargs=job_kwargs, **kwargs)
+        return BinaryStarDataFrame(crossmatch.align_results(results.to_df(), data.index))
+
+    def run_tiled_query(self, query_template, healpix_level=1, source_id_column='gaia_source.source_id',
+                        output_dir=None, max_concurrent=4, max_retries=2, **kwargs):
+        """
+
+        Splits a query into HEALPix tiles of the sky (by source_id range), and runs the tiles as concurrent jobs.
+        Useful for whole sky queries which are too big (or slow) as a single job.
+
+        Args:
+            query_template (str): ADQL query containing '{tile_condition}' where the tile condition should go.
+            healpix_level (int): HEALPix level of the tiles (12 * 4 ** healpix_level tiles).
+            source_id_column (str): source_id column to put the tile condition on.
+            output_dir (str): Optional, default None. If set, each tile is written to a Parquet file in this
+                directory as soon as it finishes. Tiles already written are skipped, so a failed run can be resumed.
+            max_concurrent (int): Maximum number of jobs running at once.
+            max_retries (int): Number of times a failed tile is retried.
+
+        Kwargs:
+            parquet_kwargs (dict): Arguments of parquet_io.write_parquet for the tile files, see
+                job_scheduler.JobScheduler.run.
+            See gaia_query_to_pandas.
+
+        Returns:
+            BinaryStarDataFrame or list: The combined results, or the Parquet files written if output_dir is set.
+
+        """
+        queries = job_scheduler.tile_queries(query_template, healpix_level=healpix_level,
+                                             source_id_column=source_id_column)
+        return self.run_queries(queries, output_dir=output_dir, max_concurrent=max_concurrent,
+                                max_retries=max_retries, **kwargs)
+
+    def data_save_parquet(self, data, output_file_name, compression='gzip', **kwargs):
+        """
+
+        Saves data to Parquet, as <output_file_name>.parquet.gzip for gzip compression (the default, as before) or
+        <output_file_name>.parquet for any other codec. If partitioning, this is a directory.
+
+        Args:
+            data (pd.DataFrame or pa.Table): Data to save.
+            output_file_name (str): Output file name prefix.
+            compression (str): Compression codec, see parquet_io.PARQUET_CODECS. 'zstd' is much faster than 'gzip'.
+
+        Kwargs:
+            See parquet_io.write_parquet (row_group_size, sort_by, partition_cols, sky_cell_level).
+
+        Returns:
+            str: Path written.
+
+        """
+        extension = "parquet.gzip" if compression == 'gzip' else "parquet"
+        return parquet_io.write_parquet(data, "{0}.{1}".format(output_file_name, extension), compression=compression,
+                                        **kwargs)
 
     def gaia_query_save_parquet_file(self, query, output_file_name):
-        gaia_data = query_gaia_to_pandas(query)
-        self.data_save_parquet(gaia_data, output_file_name)
+        # Runs on this session, rather than logging in again through the module level helpers
+        self.gaia_query_to_arrow(query, parquet_output_name=output_file_name, compression='gzip')
 
     def gaia_get_dr2_initial_data(self, save_to_parquet=False, **kwargs):
         """
@@ -149,29 +749,39 @@ class GaiaDataAccess(GaiaClass):
             self.data_save_parquet(output_df, "initial_dr2_data")
         return output_df
 
-    def gaia_get_pairs_of_close_stars(self, save_to_parquet=False, **kwargs):
-        query = r"""SELECT * FROM (
-SELECT g1.source_id as id1, g1.ra as ra1, g1.ra_error as ra1_err, g1.dec_error as dec1_err, g1.dec as dec1, 1000.0 / g1.parallax as d1, (g1.parallax_error / g1.parallax)*(1000.0 / g1.parallax) as d1_err, g1.parallax_error as plx1_err,
-	g1.pmra as pmra1, g1.pmdec as pmdec1, g1.pmra_error as pmra1_err, g1.pmdec_error as pmdec1_err, g2.parallax_error as plx2_err, g1.dr2_radial_velocity as rad_vel1, g1.dr2_radial_velocity_error as rad_vel1_err, 
-	g2.source_id as id2, g2.ra as ra2, g2.dec as dec2, g2.ra_error as ra2_err, g2.dec_error as dec2_err, 1000.0 / g2.parallax as d2,  (g2.parallax_error / g2.parallax)*(1000.0 / g2.parallax) as d2_err, 
-	g2.pmra as pmra2, g2.pmdec as pmdec2, g2.pmra_error as pmra2_err, g2.pmdec_error as pmdec2_err,g2.dr2_radial_velocity as rad_vel2, g2.dr2_radial_velocity_error as rad_vel2_err,
-	
-	-- Distance between stars
-  sqrt(ABS(power((1000.0 / g1.parallax + 1000.0 / g2.parallax), 2) * (1 - (sin(g1.dec * 2*pi()/360.0) * sin(g2.dec * 2*pi()/360.0) + (cos(g1.dec * 2*pi()/360.0) * cos(g2.dec * 2*pi()/360.0) * cos((g1.ra * 2*pi()/360.0) - (g2.ra * 2*pi()/360.0))))) / 2)) as dist
-FROM gaiaedr3.gaia_source as g1, gaiaedr3.gaia_source as g2 
-	-- avoids duplicates
-	where g1.source_id < g2.source_id and
-	g1.parallax is not null and g2.parallax is not null and g1.parallax_over_error > 5 and g2.parallax_over_error > 5 
-	and g1.pmdec is not null and g1.pmra is not null and g1.dr2_radial_velocity is not null 
-	and g2.pmra is not null and g2.pmdec is not null and g2.dr2_radial_velocity is not null
-	-- only pick combinations of stars in plane of sight in sky so we use proper motions ( parallax's around the same, giving a 20% breathing space for errors)
-	and ABS(g1.parallax - g2.parallax) <= SQRT(power(g1.parallax_error, 2) + power(g2.parallax_error,2))*1.2
-  --and (g1.source_id=4722135642226356736 and g2.source_id=4722111590409480064) or (g2.source_id=4722135642226356736 and g1.source_id=4722111590409480064) 
-	) main 
-
-where main.dist <= 1.0
-"""
-        output_df = self.gaia_query_to_pandas(query, **kwargs)
+    def gaia_get_pairs_of_close_stars(self, save_to_parquet=False, data=None, max_dist=1.0, extra_conditions=None,
+                                      **kwargs):
+        """
+
+        Function to find pairs of stars close to each other (in position, with consistent parallaxes). Only the single
+        star rows are queried from the archive, the pairs are found locally with a KD-tree (see
+        close_pairs.find_close_star_pairs), rather than with a self join of gaia_source on the archive.
+
+        Args:
+            save_to_parquet (bool): Save results to Parquet format.
+            data (pd.DataFrame): Optional, default None. Single star rows to search. If None, these are queried from
+                gaiaedr3.gaia_source.
+            max_dist (float): Maximum separation between the stars, in parsecs.
+            extra_conditions (str): Optional, default None. Extra ADQL conditions for the single star query, e.g. a
+                sky region, to limit the amount of data downloaded.
+
+        Kwargs:
+            See gaia_query_to_pandas.
+
+        Returns:
+            BinaryStarDataFrame: One row per pair of stars.
+
+        """
+        if data is None:
+            extra_where = " and ({0})".format(extra_conditions) if extra_conditions is not None else ""
+            query = r"""SELECT source_id, ra, ra_error, dec, dec_error, parallax, parallax_error, pmra, pmdec, pmra_error,
+                        pmdec_error, dr2_radial_velocity, dr2_radial_velocity_error
+                    FROM gaiaedr3.gaia_source
+                    WHERE parallax is not null and parallax_over_error > 5
+                        and pmra is not null and pmdec is not null and dr2_radial_velocity is not null{0}""".format(
+                extra_where)
+            data = self.gaia_query_to_pandas(query, **kwargs)
+        output_df = close_pairs.find_close_star_pairs(data, max_dist=max_dist)
         if save_to_parquet:
             self.data_save_parquet(output_df, "gaia_close_star_pairs")
         return output_df
@@ -258,6 +868,37 @@ where main.dist <= 1.0
         return output_df
 
 
+def _launch_job(gaia, query, asyncronous=True, **kwargs):
+    if asyncronous:
+        return gaia.launch_job_async(query, **kwargs)
+    return gaia.launch_job(query, **kwargs)
+
+
+def _logout(gaia):
+    # A rejected or expired session may fail to log out, which only matters to the archive
+    try:
+        gaia.logout()
+    except Exception as ex:
+        logger.warning("Logging out of the replaced Gaia Archive session failed: %s", ex)
+
+
+def _is_login_error(ex):
+    """
+
+    True if ex is the archive rejecting the login of a request (HTTP 401 or 403). The HTTPErrors Astroquery raises have
+    no response: a rejected job launch has the reason of the response as its message ('Unauthorized' or
+    'Forbidden'), other requests a message starting with 'Error <status>'.
+
+    """
+    from requests.exceptions import HTTPError
+    if not isinstance(ex, HTTPError):
+        return False
+    if ex.response is not None:
+        return ex.response.status_code in (401, 403)
+    message = str(ex).strip()
+    return message.lower() in ('unauthorized', 'forbidden') or message.startswith(('Error 401', 'Error 403'))
+
+
 def query_random_selection(num_results):
     top_line = "TOP {0}".format(num_results) if num_results is not None else ""
     query = r"""SELECT {0} gaia_source.source_id,gaia_source.ra,gaia_source.dec,gaia_source.parallax,
@@ -283,7 +924,8 @@ def query_random_selection(num_results):
 
 
 def run_gaia_query(query, login_config=None):
-    gaia_cls = GaiaDataAccess(login_config=login_config)
+    # Shared session of this login, see session_pool
+    gaia_cls = session_pool.get_session(login_config)
     job = gaia_cls.get_gaia_job(query)
     return job
 
@@ -294,6 +936,8 @@ def query_gaia_to_pandas(query, login_cnf=None):
     return gaia_data
 
 
-def gaia_query_to_parquet(query, output_file_name, login_cnf=None):
+def gaia_query_to_parquet(query, output_file_name, login_cnf=None, compression='gzip', **kwargs):
     gaia_data = query_gaia_to_pandas(query, login_cnf=login_cnf)
-    gaia_data.to_parquet("{0}.parquet.gzip".format(output_file_name), compression='gzip')
+    extension = "parquet.gzip" if compression == 'gzip' else "parquet"
+    parquet_io.write_parquet(gaia_data, "{0}.{1}".format(output_file_name, extension), compression=compression,
+                             **kwargs)
@@ -0,0 +1,59 @@
+import numpy as np
+import pyarrow as pa
+
+
+def column_to_arrow(column):
+    """
+
+    Converts an astropy Table column (e.g. of query results) to an Arrow array. Native byte order numeric columns are
+    not copied: Arrow uses the column's buffer, plus a validity bitmap for masked columns. Big endian columns (as
+    parsed from VOTable and FITS results) are byte swapped, strings are re-encoded, both of which copy.
+
+    Args:
+        column (astropy.table.Column or MaskedColumn): Column to convert.
+
+    Returns:
+        pa.Array: The column, with masked values as nulls.
+
+    """
+    mask = np.ma.getmask(column)
+    data = np.ma.getdata(column)
+    if data.ndim > 1:
+        # Array valued cells: one list per row
+        return pa.array([None if np.all(row_mask) else list(row) for row, row_mask in
+                         zip(data, np.broadcast_to(mask, data.shape))])
+    mask = mask if np.any(mask) else None
+    if data.dtype.kind in 'biuf':
+        if not data.dtype.isnative:
+            data = data.astype(data.dtype.newbyteorder('='))
+        return pa.array(data, mask=mask)
+    if data.dtype.kind == 'S':
+        return pa.array(np.char.decode(data, 'utf-8'), mask=mask, type=pa.string())
+    if data.dtype.kind == 'U':
+        return pa.array(data, mask=mask, type=pa.string())
+    return pa.array(data.tolist(), mask=mask)
+
+
+def table_to_arrow(table, consume=False):
+    """
+
+    Converts an astropy Table (e.g. from job.get_results()) to an Arrow table, one column at a time, without going
+    through pandas. See column_to_arrow for which columns are copied.
+
+    Args:
+        table (astropy.table.Table): Table to convert.
+        consume (bool): Optional, default False. Remove each column from table once it is converted, so its memory can
+            be freed as the conversion goes. Peak memory is then about the size of the data plus one column, rather
+            than twice the size of the data. table is left empty.
+
+    Returns:
+        pa.Table: The converted table.
+
+    """
+    names = list(table.colnames)
+    arrays = []
+    for name in names:
+        arrays.append(column_to_arrow(table[name]))
+        if consume:
+            table.remove_column(name)
+    return pa.Table.from_arrays(arrays, names=names)
@@ -1,28 +1,142 @@
+import numpy as np
 import pandas as pd
-import dask
-import dask.dataframe as dd
 from ashla import utils
+from ashla.data_access import close_pairs
+from ashla.data_access import known_binaries
+from ashla.data_access import metrics
+from ashla.data_access import pair_metrics
+from ashla.data_access import parquet_io
+from ashla.data_access import schema
 import os
 
 
+def _binary_star_df_constructor(*args, **kwargs):
+    # Used by pandas for the results of operations (merge, loc, ...), so skips the BinaryStarDataFrame.__init__ checks
+    # and options, which have already been applied to the original frame.
+    output = BinaryStarDataFrame.__new__(BinaryStarDataFrame)
+    pd.DataFrame.__init__(output, *args, **kwargs)
+    return output
+
+
 class BinaryStarDataFrame(pd.DataFrame):
     """
 
     Proxy of a Pandas DataFrame class, with added functionality for Wide Binary Star searching.
 
+    The distance columns (dist_pc, dist_err_pc) are calculated from the parallax on first use, or with
+    add_distance_cols. Pandas operations (merge, loc, sort_values, ...) return a BinaryStarDataFrame.
+
+    The add_* methods are recorded as stages of the active metrics recorder, if there is one (see metrics.recording).
+
     """
 
-    def __init__(self, data):
-        if isinstance(data, pd.DataFrame):
-            if 'parallax' in data.columns and 'dist_pc' not in data.columns:
-                data['dist_pc'] = 1000.0 / data['parallax']
-                if 'parallax_error' in data.columns and 'dist_err_pc' not in data.columns:
-                    data['dist_err_pc'] = (data['parallax_error'] / data['parallax']) * data['dist_pc']
+    DERIVED_COLUMNS = ('dist_pc', 'dist_err_pc')
 
-            super().__init__(data)
-            self.drop_duplicates()
-        else:
+    def __init__(self, data, copy=False, drop_duplicate_sources=False, compact=False):
+        """
+
+        Args:
+            data (pd.DataFrame): Star data. Not changed by the constructor.
+            copy (bool): Optional, default False. Copy the data, rather than sharing it with the original frame where
+                possible.
+            drop_duplicate_sources (bool): Optional, default False. Only keep the first row of each source_id.
+            compact (bool): Optional, default False. Cast the known Gaia / Hipparcos columns to compact dtypes (float32
+                photometry and proper motions, categorical flags, nullable integers), see schema.COLUMN_SCHEMA. This
+                roughly halves the memory used by query results, but copies the cast columns, so it is done where data
+                is loaded (query results, from_parquet) rather than on every construction.
+
+        """
+        if not isinstance(data, pd.DataFrame):
             raise TypeError("You did not pass a DataFrame! Boooooo!")
+        if drop_duplicate_sources and 'source_id' in data.columns:
+            duplicates = data['source_id'].duplicated()
+            if duplicates.any():
+                data = data.loc[~duplicates]
+        if compact:
+            data = schema.compact_dtypes(data)
+        super().__init__(data, copy=copy)
+
+    @property
+    def _constructor(self):
+        return _binary_star_df_constructor
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and key in self.DERIVED_COLUMNS and key not in self.columns:
+            self.add_distance_cols()
+        elif isinstance(key, list) and any(col in self.DERIVED_COLUMNS and col not in self.columns for col in key
+                                           if isinstance(col, str)):
+            self.add_distance_cols()
+        return super().__getitem__(key)
+
+    def __getattr__(self, name):
+        if name in BinaryStarDataFrame.DERIVED_COLUMNS and name not in self.columns:
+            self.add_distance_cols()
+        return super().__getattr__(name)
+
+    def add_distance_cols(self):
+        """
+
+        Adds the distance (dist_pc) and distance error (dist_err_pc) columns, in parsecs, from the parallax columns,
+        if they don't already exist.
+
+        Returns:
+            BinaryStarDataFrame: self, with the new columns.
+
+        """
+        if 'parallax' in self.columns and 'dist_pc' not in self.columns:
+            self['dist_pc'] = 1000.0 / self['parallax']
+        if 'parallax' in self.columns and 'parallax_error' in self.columns and 'dist_err_pc' not in self.columns:
+            self['dist_err_pc'] = (self['parallax_error'] / self['parallax']) * self['dist_pc']
+        return self
+
+    @classmethod
+    @metrics.instrumented('parquet_read')
+    def from_parquet(cls, path, columns=None, filters=None, ra_range=None, dec_range=None, arrow_backed=False):
+        """
+
+        Reads a Parquet file or (partitioned) dataset, only loading the columns and rows asked for. See
+        parquet_io.read_parquet_table.
+
+        Args:
+            path (str): Parquet file or dataset directory.
+            columns (list): Optional, default None. Columns to read. None reads all columns.
+            filters (list): Optional, default None. Row filters, e.g. [('parallax_over_error', '>', 5)].
+            ra_range (tuple): Optional, default None. (min, max) RA in degrees.
+            dec_range (tuple): Optional, default None. (min, max) Dec in degrees.
+            arrow_backed (bool): Optional, default False. Keep the columns in Arrow memory, see from_arrow.
+
+        Returns:
+            BinaryStarDataFrame: The matching rows.
+
+        """
+        return cls.from_arrow(parquet_io.read_parquet_table(path, columns=columns, filters=filters, ra_range=ra_range,
+                                                            dec_range=dec_range), arrow_backed=arrow_backed)
+
+    @classmethod
+    def from_arrow(cls, table, arrow_backed=False, compact=True):
+        """
+
+        Makes a BinaryStarDataFrame from an Arrow table (e.g. from arrow_results.table_to_arrow, or a Parquet read).
+
+        Args:
+            table (pa.Table): Star data. Consumed if arrow_backed is False: its buffers are freed as they are
+                converted, so don't use it afterwards.
+            arrow_backed (bool): Optional, default False. Wrap the Arrow buffers in pandas ArrowDtype columns rather
+                than converting them to NumPy, so nothing is copied. Missing values stay nulls.
+            compact (bool): Optional, default True. Cast the known columns to compact types first, see
+                schema.compact_arrow_table.
+
+        Returns:
+            BinaryStarDataFrame: The data.
+
+        """
+        if compact:
+            table = schema.compact_arrow_table(table)
+        if arrow_backed:
+            data = table.to_pandas(types_mapper=pd.ArrowDtype)
+        else:
+            data = table.to_pandas(split_blocks=True, self_destruct=True, types_mapper=schema.NULLABLE_INT_TYPES.get)
+        return cls(data, compact=False)
 
     def to_df(self):
         """
@@ -35,70 +149,259 @@ class BinaryStarDataFrame(pd.DataFrame):
         """
         return pd.DataFrame(self)
 
-    def add_cartesian_coords_cols(self):
-        self['cart_x'], self['cart_y'], self['cart_z'] = utils.ra_dec_dist_to_cartesian(self['ra'],
-                                                                                        self['dec'],
-                                                                                        self['dist_pc'])
+    @metrics.instrumented('cartesian_coords')
+    def add_cartesian_coords_cols(self, dtype=np.float64):
+        """
+
+        Adds cartesian coordinate columns (cart_x, cart_y, cart_z), in parsecs, from ra, dec and dist_pc.
+
+        Args:
+            dtype (np.dtype): Optional, default np.float64. dtype of the new columns, e.g. np.float32 to save memory.
+
+        Returns:
+            BinaryStarDataFrame: self, with the new columns.
+
+        """
+        coords = tuple(np.empty(len(self), dtype=dtype) for _ in range(3))
+        utils.ra_dec_dist_to_cartesian(self['ra'].to_numpy(), self['dec'].to_numpy(), self['dist_pc'].to_numpy(),
+                                       out=coords)
+        self['cart_x'], self['cart_y'], self['cart_z'] = coords
         return self
 
-    def add_plotting_data_cols(self):
+    @metrics.instrumented('plotting_cols')
+    def add_plotting_data_cols(self, colour_output='string', use_lookup_table=False):
+        """
+
+        Adds columns for plotting: the colour of each star from bp_g, and a dot size from phot_g_mean_mag.
+
+        Args:
+            colour_output (str): 'string' for an rgb_colour column of 'rgb(r, g, b)' strings, 'category' for the same
+                as a categorical column, or 'rgb' for numeric rgb_r, rgb_g and rgb_b columns (between 0 and 1).
+            use_lookup_table (bool): Interpolate the colours from a precomputed table (utils.bv2rgb_lookup_table)
+                rather than evaluating the colour polynomials for every star.
+
+        Returns:
+            BinaryStarDataFrame: self, with the new columns.
 
-        self['rgb_colour'] = "rgb" + self['bp_g'].apply(utils.bv2rgb).astype(str)
+        """
+        lookup_table = utils.bv2rgb_lookup_table() if use_lookup_table else None
+        colours = utils.bv2rgb_colours(self['bp_g'].to_numpy(), output=colour_output, lookup_table=lookup_table)
+        if colour_output == 'rgb':
+            self['rgb_r'], self['rgb_g'], self['rgb_b'] = colours.T
+        else:
+            self['rgb_colour'] = colours
         self['dot_size'] = utils.dot_size_from_mag(self['phot_g_mean_mag'])
         return self
 
-    def add_binary_sys_id_column(self, column_name=None, ignore_hipp_col=False):
+    @metrics.instrumented('close_star_pairs')
+    def get_close_star_pairs(self, max_dist=1.0, **kwargs):
+        """
+
+        Finds pairs of stars close to each other, see close_pairs.find_close_star_pairs.
+
+        Args:
+            max_dist (float): Maximum separation between the stars, in parsecs.
+
+        Returns:
+            BinaryStarDataFrame: One row per pair of stars (id1, id2, dist, ...).
+
+        """
+        return close_pairs.find_close_star_pairs(self, max_dist=max_dist, **kwargs)
+
+    @metrics.instrumented('pair_kinematics')
+    def add_pair_kinematics_cols(self):
+        """
+
+        For pair rows (e.g. from get_close_star_pairs), adds the angular and projected separation and the tangential,
+        radial and 3D velocity differences with their errors. See pair_metrics.pair_kinematics.
+
+        Returns:
+            BinaryStarDataFrame: self, with the new columns.
+
+        """
+        kinematics = pair_metrics.pair_kinematics(self)
+        for col in kinematics.columns:
+            self[col] = kinematics[col].to_numpy()
+        return self
+
+    @metrics.instrumented('chance_alignment')
+    def add_chance_alignment_col(self, stars, num_trials=100, seed=0, **kwargs):
+        """
+
+        For pair rows (e.g. from get_close_star_pairs), adds a chance_alignment_prob column: the Monte Carlo estimate of
+        the probability that the pair is a chance alignment. See pair_metrics.estimate_chance_alignment.
+
+        Args:
+            stars (pd.DataFrame): Single star rows the pairs were found in.
+            num_trials (int): Number of Monte Carlo trials, run in parallel processes.
+            seed (int): Seed for the trials, so results are reproducible.
+
+        Kwargs:
+            See pair_metrics.estimate_chance_alignment.
+
+        Returns:
+            BinaryStarDataFrame: self, with the new column.
+
+        """
+        self['chance_alignment_prob'] = pair_metrics.estimate_chance_alignment(self, stars, num_trials=num_trials,
+                                                                                seed=seed, **kwargs).to_numpy()
+        return self
+
+    @metrics.instrumented('binary_sys_id')
+    def add_binary_sys_id_column(self, column_name=None, ignore_hipp_col=False, known_binaries_index=None):
         """
 
         if column_name is not None, this column overrides any hipparcos data or data from the paper.
             Otherwise, if the Hipparcos CCDM column exists (and ignore_hipp_col is False), it uses the
-            Hipparcos CCDM column only.
+            Hipparcos CCDM column only. Otherwise, binary IDs are looked up by source_id in the known binaries index.
 
         Args:
-            column_name:
+            column_name (str): Optional, default None. Column to use as the binary ID.
+            ignore_hipp_col (bool): Don't use the Hipparcos CCDM column, even if it exists.
+            known_binaries_index (KnownBinariesIndex): Optional, default None. Index to look the binary IDs up in. If
+                None, the (cached) index of the known binaries from the paper. See known_binaries.KnownBinariesIndex,
+                which can be extended with the Hipparcos CCDM groups.
 
-        Returns:8
+        Returns:
+            BinaryStarDataFrame: self, with a binary_id column.
 
         """
         # Uses custom binary ID column
         if column_name is not None:
-            self.rename(columns={column_name: 'binary_id'})
+            self = self.rename(columns={column_name: 'binary_id'})
         # Uses the Hipparcos CCDM (binary ID) column
         elif not ignore_hipp_col and 'ccdm' in self.columns:
-            self.rename(columns={'ccdm': 'binary_id'})
+            self = self.rename(columns={'ccdm': 'binary_id'})
         else:
-            current_dir = os.path.dirname(os.path.realpath(__file__))
-            known_binaries = pd.read_csv(r'{0}\known_binaries.csv'.format(current_dir), usecols=['binary_id', 'GDR2'])
-            known_binaries['binary_id'] = known_binaries['binary_id'].astype(dtype=int)
-            self = BinaryStarDataFrame(
-                self.merge(right=known_binaries, how='left', left_on='source_id', right_on='GDR2'))
+            if known_binaries_index is None:
+                known_binaries_index = known_binaries.get_known_binaries_index()
+            self['binary_id'] = known_binaries_index.lookup(self['source_id'].to_numpy())
         return self
 
 
-class BinarySystemDataFrame(BinaryStarDataFrame):
+@metrics.instrumented('group_binary_systems')
+def group_binary_systems(data, magnitude_column='phot_g_mean_mag', max_components=None):
     """
 
-    Proxy of a Pandas DataFrame class, with added functionality for Wide Binary Star searching.
+    Reshapes star rows (with a binary_id column) into one row per system. Stars are ranked within their system by
+    magnitude, brightest first, so column <name>_1 is the primary, <name>_2 the secondary and so on. Uses a single
+    sort and scatter into (systems x components) arrays, rather than a Python call per system.
+
+    Args:
+        data (pd.DataFrame): Star rows, with a binary_id column. Stars without a binary ID are dropped.
+        magnitude_column (str): Column to rank the stars by (ascending). Stars without a magnitude come last.
+        max_components (int): Optional, default None. Only keep this many stars per system. None keeps all stars.
+
+    Returns:
+        pd.DataFrame: One row per system, indexed by binary_id, with a num_stars column and <column>_<n> columns for
+            every other column of data. Integer and boolean columns become nullable, as smaller systems have gaps.
+            Nullable (masked) and categorical columns keep their dtype.
+
+    """
+    data = data.loc[data['binary_id'].notnull()]
+    system_codes, binary_ids = pd.factorize(data['binary_id'], sort=True)
+    if magnitude_column in data.columns:
+        order = np.lexsort((data[magnitude_column].to_numpy(dtype=np.float64, na_value=np.nan), system_codes))
+    else:
+        order = np.argsort(system_codes, kind='stable')
+    system_codes = system_codes[order]
+
+    # cumcount within each system: position in the sorted rows minus the position of the system's first star
+    num_stars = np.bincount(system_codes, minlength=len(binary_ids))
+    first_star = np.concatenate([[0], np.cumsum(num_stars)[:-1]])
+    component = np.arange(len(system_codes)) - first_star[system_codes]
+
+    num_components = int(num_stars.max()) if len(num_stars) else 0
+    if max_components is not None:
+        num_components = min(num_components, max_components)
+        keep = component < num_components
+        order, system_codes, component = order[keep], system_codes[keep], component[keep]
+
+    shape = (len(binary_ids), num_components)
+    columns = {'num_stars': num_stars}
+    for col in data.columns:
+        if col == 'binary_id':
+            continue
+        series = data[col]
+        dtype = series.dtype
+        names = ["{0}_{1}".format(col, num + 1) for num in range(num_components)]
+        if isinstance(dtype, pd.CategoricalDtype):
+            # Scatter the codes, -1 (missing) where a system has no star
+            grid = np.full(shape, -1, dtype=series.cat.codes.dtype)
+            grid[system_codes, component] = series.cat.codes.to_numpy()[order]
+            columns.update((name, pd.Categorical.from_codes(grid[:, num], dtype=dtype))
+                           for num, name in enumerate(names))
+            continue
+
+        masked_type = None
+        if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+            if not isinstance(dtype, pd.ArrowDtype) and dtype.kind in 'iufb':
+                # Nullable column: scatter the values and the missing value mask separately
+                masked_type = type(series.array)
+                values = series.to_numpy(dtype=dtype.numpy_dtype, na_value=dtype.numpy_dtype.type(0))[order]
+                value_missing = series.isna().to_numpy()[order]
+            else:
+                values = series.to_numpy(dtype=object)[order]
+        else:
+            values = series.to_numpy()[order]
+            if values.dtype.kind in 'iub':
+                masked_type = pd.arrays.BooleanArray if values.dtype.kind == 'b' else pd.arrays.IntegerArray
+                value_missing = False
+
+        if masked_type is not None:
+            grid = np.zeros(shape, dtype=values.dtype)
+            missing = np.ones(shape, dtype=bool)
+            missing[system_codes, component] = value_missing
+        elif values.dtype.kind in 'fc':
+            grid = np.full(shape, np.nan, dtype=values.dtype)
+        else:
+            grid = np.full(shape, None, dtype=object)
+        grid[system_codes, component] = values
+        for num, name in enumerate(names):
+            columns[name] = grid[:, num] if masked_type is None else masked_type(grid[:, num], missing[:, num])
+    return pd.DataFrame(columns, index=pd.Index(binary_ids, name='binary_id'))
+
 
-    Warning:
-        This is not yet working properly. Just a test / play.
+def _binary_system_df_constructor(*args, **kwargs):
+    output = BinarySystemDataFrame.__new__(BinarySystemDataFrame)
+    pd.DataFrame.__init__(output, *args, **kwargs)
+    return output
 
+
+class BinarySystemDataFrame(BinaryStarDataFrame):
     """
 
-    def __init__(self, data, known_binaries=True):
-        super().__init__(data)
-        if known_binaries:
-            if 'binary_id' not in self.columns:
-                self = self.add_binary_sys_id_column(ignore_hipp_col=True)
+    Proxy of a Pandas DataFrame class, with one row per binary (or multiple) system rather than per star. See
+    group_binary_systems for the layout.
 
-            def reset_index_prox(df):
-                return df.reset_index(drop=True)
+    """
 
-            self = self.loc[self['binary_id'].notnull()]
-            self = self.groupby(by='binary_id').apply(reset_index_prox)
-            # maybe do a multi index for binary id and source id? Then play with stack unstack?
+    def __init__(self, data, known_binaries=True, ignore_hipp_col=False, magnitude_column='phot_g_mean_mag',
+                 max_components=None):
+        """
 
-            self.pivot(index='binary_id', columns='pivot_col')
+        Args:
+            data (pd.DataFrame): Star rows.
+            known_binaries (bool): If there is no binary_id column, add one with add_binary_sys_id_column (from the
+                Hipparcos CCDM column if it exists, else from the known binaries).
+            ignore_hipp_col (bool): Don't use the Hipparcos CCDM column for the binary IDs.
+            magnitude_column (str): Column to rank the stars in each system by, brightest first.
+            max_components (int): Optional, default None. Only keep this many stars per system.
+
+        """
+        if not isinstance(data, pd.DataFrame):
+            raise TypeError("You did not pass a DataFrame! Boooooo!")
+        stars = BinaryStarDataFrame(data)
+        if 'binary_id' not in stars.columns:
+            if not known_binaries:
+                raise ValueError("The data has no binary_id column, and known_binaries is False.")
+            stars = stars.add_binary_sys_id_column(ignore_hipp_col=ignore_hipp_col)
+        super().__init__(group_binary_systems(stars.add_distance_cols(), magnitude_column=magnitude_column,
+                                              max_components=max_components))
+
+    @property
+    def _constructor(self):
+        return _binary_system_df_constructor
 
     def to_df(self):
         """
@@ -112,6 +415,130 @@ class BinarySystemDataFrame(BinaryStarDataFrame):
         return pd.DataFrame(self)
 
 
+def _partition_to_binary_star_df(partition):
+    return BinaryStarDataFrame(partition, copy=True).add_distance_cols().to_df()
+
+
+class DaskBinaryStarDataFrame:
+    """
+
+    Out of core (Dask) counterpart of BinaryStarDataFrame, for data which doesn't fit in memory. Wraps a Dask
+    DataFrame, and applies the BinaryStarDataFrame columns lazily, one partition at a time. Nothing is calculated until
+    compute (or to_parquet) is called, and partitions are then processed in parallel.
+
+    Any other attribute (head, npartitions, columns, ...) is passed on to the Dask DataFrame.
+
+    """
+
+    def __init__(self, data):
+        import dask.dataframe as dd
+        if isinstance(data, pd.DataFrame):
+            data = dd.from_pandas(data, npartitions=max(1, os.cpu_count() or 1))
+        if not isinstance(data, dd.DataFrame):
+            raise TypeError("You did not pass a Dask or Pandas DataFrame!")
+        self.ddf = data.map_partitions(_partition_to_binary_star_df,
+                                       meta=_partition_to_binary_star_df(data._meta))
+
+    @classmethod
+    def from_parquet(cls, path, columns=None, **kwargs):
+        """
+
+        Opens a Parquet file (e.g. from GaiaDataAccess.data_save_parquet) or a partitioned Parquet dataset directory.
+
+        Args:
+            path (str): Parquet file, directory or glob.
+            columns (list): Optional, default None. Only read these columns.
+
+        Kwargs:
+            Passed to dask.dataframe.read_parquet.
+
+        Returns:
+            DaskBinaryStarDataFrame: Lazy data frame of the Parquet data.
+
+        """
+        import dask.dataframe as dd
+        return cls(dd.read_parquet(path, columns=columns, **kwargs))
+
+    def __getattr__(self, item):
+        return getattr(self.ddf, item)
+
+    def __getitem__(self, item):
+        return self.ddf[item]
+
+    def __len__(self):
+        return len(self.ddf)
+
+    def _map_binary_star_df(self, func):
+        # func(BinaryStarDataFrame) -> BinaryStarDataFrame, run on every partition
+        def apply_func(partition):
+            return func(BinaryStarDataFrame(partition, copy=True)).to_df()
+
+        output = DaskBinaryStarDataFrame.__new__(DaskBinaryStarDataFrame)
+        output.ddf = self.ddf.map_partitions(apply_func, meta=apply_func(self.ddf._meta))
+        return output
+
+    def add_cartesian_coords_cols(self, dtype=np.float64):
+        """
+
+        Lazy version of BinaryStarDataFrame.add_cartesian_coords_cols.
+
+        """
+        return self._map_binary_star_df(lambda df: df.add_cartesian_coords_cols(dtype=dtype))
+
+    def add_plotting_data_cols(self, colour_output='string', use_lookup_table=False):
+        """
+
+        Lazy version of BinaryStarDataFrame.add_plotting_data_cols. 'category' colours are stored as strings, as the
+        categories can differ between partitions.
+
+        """
+        colour_output = 'string' if colour_output == 'category' else colour_output
+        return self._map_binary_star_df(lambda df: df.add_plotting_data_cols(colour_output=colour_output,
+                                                                             use_lookup_table=use_lookup_table))
+
+    def add_binary_sys_id_column(self, column_name=None, ignore_hipp_col=False, known_binaries_index=None):
+        """
+
+        Lazy version of BinaryStarDataFrame.add_binary_sys_id_column. The known binaries index is loaded once and
+        sent to every partition.
+
+        """
+        if column_name is None and (ignore_hipp_col or 'ccdm' not in self.ddf.columns) and \
+                known_binaries_index is None:
+            known_binaries_index = known_binaries.get_known_binaries_index()
+        return self._map_binary_star_df(lambda df: df.add_binary_sys_id_column(
+            column_name=column_name, ignore_hipp_col=ignore_hipp_col, known_binaries_index=known_binaries_index))
+
+    def compute(self, **kwargs):
+        """
+
+        Calculates the data, returning it in memory.
+
+        Kwargs:
+            Passed to dask compute, e.g. scheduler='processes'.
+
+        Returns:
+            BinaryStarDataFrame: The computed data.
+
+        """
+        return BinaryStarDataFrame(self.ddf.compute(**kwargs))
+
+    def to_parquet(self, path, compression='snappy', **kwargs):
+        """
+
+        Calculates the data one partition at a time, writing it to a partitioned Parquet dataset.
+
+        Args:
+            path (str): Output directory.
+            compression (str): Parquet compression codec.
+
+        Kwargs:
+            Passed to dask.dataframe.to_parquet.
+
+        """
+        return self.ddf.to_parquet(path, compression=compression, **kwargs)
+
+
 if __name__ == '__main__':
     import ashla.data_access as da
 
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+
+from ashla import utils
+
+# Output column of the pair table (formatted with 1 or 2) -> candidate input columns of the single star table (first
+# match is used). The candidates cover both the EDR3 column names and the aliases used by the built in DR2 queries.
+PAIR_COLUMNS = [('id{0}', ('source_id',)),
+                ('ra{0}', ('ra',)),
+                ('ra{0}_err', ('ra_error',)),
+                ('dec{0}', ('dec',)),
+                ('dec{0}_err', ('dec_error',)),
+                ('d{0}', ('dist_pc',)),
+                ('d{0}_err', ('dist_err_pc',)),
+                ('plx{0}_err', ('parallax_error',)),
+                ('pmra{0}', ('pmra', 'proper_motion_ra')),
+                ('pmdec{0}', ('pmdec', 'proper_motion_dec')),
+                ('pmra{0}_err', ('pmra_error', 'proper_motion_ra_error')),
+                ('pmdec{0}_err', ('pmdec_error', 'proper_motion_dec_error')),
+                ('rad_vel{0}', ('dr2_radial_velocity', 'radial_velocity')),
+                ('rad_vel{0}_err', ('dr2_radial_velocity_error', 'radial_velocity_error'))]
+
+KINEMATIC_COLUMNS = ['pmra{0}', 'pmdec{0}', 'rad_vel{0}']
+
+
+def _find_column(data, candidates):
+    for col in candidates:
+        if col in data.columns:
+            return col
+    return None
+
+
+def prepare_single_stars(data, min_parallax_over_error, require_kinematics):
+    """
+
+    Filters the single star rows the same way the server side self join does, and makes sure the distance columns
+    exist.
+
+    """
+    for col in ['source_id', 'ra', 'dec', 'parallax', 'parallax_error']:
+        if col not in data.columns:
+            raise KeyError("Column {0} is needed to search for close pairs of stars.".format(col))
+
+    mask = (data['parallax'] > 0) & data['parallax_error'].notnull()
+    if min_parallax_over_error is not None:
+        mask &= (data['parallax'] / data['parallax_error']) > min_parallax_over_error
+    if require_kinematics:
+        for out_col, candidates in PAIR_COLUMNS:
+            if out_col in KINEMATIC_COLUMNS:
+                col = _find_column(data, candidates)
+                if col is None:
+                    raise KeyError("No column for {0} found, use require_kinematics=False.".format(out_col.format('')))
+                mask &= data[col].notnull()
+
+    stars = data.loc[mask]
+    # Local import, as binary_data imports this module for BinaryStarDataFrame.get_close_star_pairs
+    from ashla.data_access.binary_data import BinaryStarDataFrame
+    return BinaryStarDataFrame(stars.reset_index(drop=True)).add_distance_cols()
+
+
+def _neighbour_pairs(tree, positions, search_radius):
+    neighbours = tree.query_ball_point(positions, r=search_radius)
+    counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+    first = np.repeat(np.arange(len(neighbours), dtype=np.int64), counts)
+    second = np.concatenate([np.asarray(n, dtype=np.int64) for n in neighbours])
+    return first, second
+
+
+def _candidate_pairs(positions, search_radius):
+    """
+
+    Radius query of every star against a KD-tree of all the stars.
+
+    Args:
+        positions (np.ndarray): (N, 3) array of positions (unit sky vectors).
+        search_radius (np.ndarray): (N,) search radius per star.
+
+    Returns:
+        (np.ndarray, np.ndarray): Row positions of the unique candidate pairs, with first < second.
+
+    """
+    if len(positions) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    from scipy.spatial import cKDTree
+    first, second = _neighbour_pairs(cKDTree(positions), positions, search_radius)
+    lower = np.minimum(first, second)
+    upper = np.maximum(first, second)
+    keep = lower != upper
+    # Both stars may find each other, so drop the pair found the second time
+    pair_keys = np.unique(lower[keep] * len(positions) + upper[keep])
+    return pair_keys // len(positions), pair_keys % len(positions)
+
+
+def _cross_candidate_pairs(positions, search_radius, other_positions, other_search_radius):
+    """
+
+    Radius queries of every star of one set against a KD-tree of the other set, in both directions.
+
+    Returns:
+        (np.ndarray, np.ndarray): Row positions (in positions, in other_positions) of the unique candidate pairs.
+
+    """
+    if len(positions) == 0 or len(other_positions) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    from scipy.spatial import cKDTree
+    first, second = _neighbour_pairs(cKDTree(other_positions), positions, search_radius)
+    other_first, other_second = _neighbour_pairs(cKDTree(positions), other_positions, other_search_radius)
+    pair_keys = np.unique(np.concatenate([first * len(other_positions) + second,
+                                          other_second * len(other_positions) + other_first]))
+    return pair_keys // len(other_positions), pair_keys % len(other_positions)
+
+
+def _star_arrays(stars, max_dist):
+    arrays = {'plx': stars['parallax'].to_numpy(dtype=float),
+              'plx_err': stars['parallax_error'].to_numpy(dtype=float),
+              'dist': stars['dist_pc'].to_numpy(dtype=float)}
+    arrays['positions'] = np.column_stack(utils.ra_dec_dist_to_cartesian(stars['ra'].to_numpy(dtype=float),
+                                                                         stars['dec'].to_numpy(dtype=float), 1.0))
+    # A pair's separation is (d1 + d2) / 2 * chord >= min(d1, d2) * chord, so the nearer star of any pair within
+    # max_dist finds it with a chord radius of max_dist / its distance. Chords are at most 2 (opposite directions).
+    arrays['search_radius'] = np.minimum(max_dist / arrays['dist'], 2.0)
+    return arrays
+
+
+def find_close_star_pairs(data, other=None, max_dist=1.0, parallax_error_factor=1.2, min_parallax_over_error=5,
+                          require_kinematics=True):
+    """
+
+    Local version of the Gaia archive self join of gaia_source, finding pairs of stars close to each other. Uses a
+    KD-tree over the directions (unit vectors) of the stars, so scales as about O(N log N) rather than O(N^2).
+
+    A pair is kept when the parallaxes are consistent within parallax_error_factor times the combined parallax error
+    and the separation (using the mean distance of the pair, as in the archive query) is at most max_dist. Each star
+    searches a small circle on the sky, the angle max_dist subtends at its distance, which contains every pair it is
+    the nearer star of. The parallax and separation cuts are then applied exactly to these few candidates.
+
+    Args:
+        data (pd.DataFrame): Single star rows, with at least source_id, ra, dec, parallax and parallax_error.
+        other (pd.DataFrame): Optional, default None. If given, find pairs with one star from data (star 1) and one
+            from other (star 2), rather than pairs within data.
+        max_dist (float): Maximum separation between the stars, in parsecs.
+        parallax_error_factor (float): Parallaxes must agree within this factor times the combined parallax error.
+        min_parallax_over_error (float): Only use stars with a parallax over error above this. None uses all stars.
+            Stars with a low parallax over error give many more chance pairs.
+        require_kinematics (bool): Only use stars with proper motions and a radial velocity.
+
+    Returns:
+        BinaryStarDataFrame: One row per pair, with the same columns as GaiaDataAccess.gaia_get_pairs_of_close_stars.
+
+    """
+    from ashla.data_access.binary_data import BinaryStarDataFrame
+    stars1 = prepare_single_stars(data, min_parallax_over_error, require_kinematics)
+    stars2 = stars1 if other is None else prepare_single_stars(other, min_parallax_over_error, require_kinematics)
+    star1 = _star_arrays(stars1, max_dist)
+    star2 = star1 if other is None else _star_arrays(stars2, max_dist)
+
+    if other is None:
+        first, second = _candidate_pairs(star1['positions'], star1['search_radius'])
+    else:
+        first, second = _cross_candidate_pairs(star1['positions'], star1['search_radius'],
+                                               star2['positions'], star2['search_radius'])
+
+    plx_ok = np.abs(star1['plx'][first] - star2['plx'][second]) <= np.sqrt(
+        star1['plx_err'][first] ** 2 + star2['plx_err'][second] ** 2) * parallax_error_factor
+    first, second = first[plx_ok], second[plx_ok]
+
+    # Chord between the unit vectors is 2 sin(theta / 2), so this is the archive query's
+    # sqrt(|(d1 + d2)^2 (1 - cos(theta)) / 2|) without the cancellation at small angles
+    dist1, dist2 = star1['dist'][first], star2['dist'][second]
+    chord = np.linalg.norm(star1['positions'][first] - star2['positions'][second], axis=1)
+    pair_dist = (dist1 + dist2) * chord / 2.0
+    dist_ok = pair_dist <= max_dist
+    first, second, pair_dist = first[dist_ok], second[dist_ok], pair_dist[dist_ok]
+
+    if other is None:
+        # Same ordering as the archive query: id1 < id2
+        source_id = stars1['source_id'].to_numpy()
+        swap = source_id[first] > source_id[second]
+        first, second = np.where(swap, second, first), np.where(swap, first, second)
+
+    pairs = {}
+    for num, stars, idx in (('1', stars1, first), ('2', stars2, second)):
+        for out_col, candidates in PAIR_COLUMNS:
+            col = _find_column(stars, candidates)
+            values = stars[col].to_numpy()[idx] if col is not None else np.full(len(idx), np.nan)
+            pairs[out_col.format(num)] = values
+    pairs['dist'] = pair_dist
+    return BinaryStarDataFrame(pd.DataFrame(pairs))
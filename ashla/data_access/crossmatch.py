@@ -0,0 +1,132 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+UPLOAD_TABLE_NAME = 'ashla_upload'
+# Column of the uploads and results giving the position of each row in the input
+ROW_COLUMN = 'ashla_row'
+MATCH_DIST_COLUMN = 'match_dist_arcsec'
+# Kept well under the archive's upload limit, so each upload (and its job) stays quick
+DEFAULT_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+
+def _votable_bytes(table, votable_format):
+    from astropy.io.votable import from_table
+    output = io.BytesIO()
+    from_table(table).to_xml(output, tabledata_format=votable_format)
+    return output.getvalue()
+
+
+def upload_table(data, on):
+    """
+
+    The minimal table to upload for a cross match: the row number of each input row with the match columns, and
+    without the rows missing any of them.
+
+    Args:
+        data (pd.DataFrame): Rows to match.
+        on (str or tuple): Match column (e.g. 'source_id'), or (ra column, dec column) for a positional match.
+
+    Returns:
+        astropy.table.Table: Table with ROW_COLUMN and the match columns ('ra' and 'dec' for a positional match).
+
+    """
+    from astropy.table import Table
+    if isinstance(on, str):
+        columns = {on: on}
+    else:
+        columns = {on[0]: 'ra', on[1]: 'dec'}
+    keys = data[list(columns)].reset_index(drop=True)
+    keys = keys.dropna()
+    table = Table({ROW_COLUMN: keys.index.to_numpy(dtype=np.int64)})
+    for column, name in columns.items():
+        values = keys[column]
+        table[name] = values.to_numpy(dtype=np.int64 if name == on else np.float64)
+    return table
+
+
+def write_upload_chunks(table, output_dir, max_upload_bytes=DEFAULT_MAX_UPLOAD_BYTES, votable_format='binary'):
+    """
+
+    Writes a table as VOTables of at most max_upload_bytes each. The number of rows per chunk comes from the size of
+    a sample of the rows, as the binary formats have a fixed size per row.
+
+    Args:
+        table (astropy.table.Table): Table to upload, e.g. from upload_table.
+        output_dir (str): Directory to write the VOTables to.
+        max_upload_bytes (int): Optional, default DEFAULT_MAX_UPLOAD_BYTES. Maximum size of each VOTable.
+        votable_format (str): Optional, default 'binary'. VOTable serialization: 'binary' (about a third the size of
+            'tabledata'), 'binary2' or 'tabledata'.
+
+    Returns:
+        list: Path of each chunk, in row order.
+
+    """
+    header_bytes = len(_votable_bytes(table[:0], votable_format))
+    sample = table[:1000]
+    row_bytes = max((len(_votable_bytes(sample, votable_format)) - header_bytes) / max(len(sample), 1), 1.)
+    # 5% spare for base64 line breaks
+    chunk_rows = max(int(0.95 * (max_upload_bytes - header_bytes) / row_bytes), 1)
+
+    chunks = []
+    for num, start in enumerate(range(0, len(table), chunk_rows)):
+        content = _votable_bytes(table[start:start + chunk_rows], votable_format)
+        path = os.path.join(output_dir, "{0}-{1:05d}.vot".format(UPLOAD_TABLE_NAME, num))
+        with open(path, 'wb') as upload_file:
+            upload_file.write(content)
+        chunks.append(path)
+    return chunks
+
+
+def crossmatch_query(columns, table, on, radius_arcsec=1.):
+    """
+
+    ADQL query joining an uploaded chunk (as tap_upload.<UPLOAD_TABLE_NAME>, aliased u) to an archive table (aliased
+    g). The query is the same for every chunk: the query cache tells the chunks apart by their uploads (see
+    query_cache.query_key).
+
+    Args:
+        columns (list): Columns (or expressions) of the archive table to get, e.g. ['g.phot_g_mean_mag', 'g.bp_rp'].
+        table (str): Archive table, e.g. 'gaiaedr3.gaia_source'.
+        on (str or tuple): Match column, or (ra column, dec column) for a positional match.
+        radius_arcsec (float): Optional, default 1. Match radius of a positional match.
+
+    Returns:
+        str: The query.
+
+    """
+    select = [" u.{0}".format(ROW_COLUMN)]
+    if isinstance(on, str):
+        join = "g.{0} = u.{0}".format(on)
+    else:
+        select.append(" DISTANCE(POINT('ICRS', u.ra, u.dec), POINT('ICRS', g.ra, g.dec)) * 3600. AS {0}".format(
+            MATCH_DIST_COLUMN))
+        join = "1 = CONTAINS(POINT('ICRS', g.ra, g.dec), CIRCLE('ICRS', u.ra, u.dec, {0!r}))".format(
+            radius_arcsec / 3600.)
+    select.extend(" {0}".format(column) for column in columns)
+    return "SELECT{0}\nFROM tap_upload.{1} AS u\nJOIN {2} AS g ON {3}".format(",".join(select), UPLOAD_TABLE_NAME,
+                                                                                 table, join)
+
+
+def align_results(results, index):
+    """
+
+    Lines the results of a cross match up with the input rows. Where a row has several matches (in a positional
+    match), the nearest is kept.
+
+    Args:
+        results (pd.DataFrame): Combined results of the chunks, with ROW_COLUMN.
+        index (pd.Index): Index of the input rows.
+
+    Returns:
+        pd.DataFrame: The results, one row per input row (missing values where there was no match), with its index.
+
+    """
+    if MATCH_DIST_COLUMN in results.columns:
+        results = results.sort_values(MATCH_DIST_COLUMN, kind='stable')
+    results = results.drop_duplicates(ROW_COLUMN).set_index(ROW_COLUMN)
+    aligned = results.reindex(pd.RangeIndex(len(index)))
+    aligned.index = index
+    return aligned
@@ -0,0 +1,3 @@
+# Gaia source_ids encode the level 12 HEALPix (nested) index of the source: source_id // 2^35
+SOURCE_ID_HEALPIX_FACTOR = 2 ** 35
+HEALPIX_MAX_LEVEL = 12
@@ -0,0 +1,193 @@
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ashla.data_access import parquet_io
+from ashla.data_access import query_cache
+from ashla.data_access.healpix import SOURCE_ID_HEALPIX_FACTOR, HEALPIX_MAX_LEVEL
+
+logger = logging.getLogger(__name__)
+
+TILE_PLACEHOLDER = '{tile_condition}'
+
+
+def healpix_source_id_ranges(healpix_level):
+    """
+
+    source_id ranges covering the sky in HEALPix tiles at the given level, using the HEALPix index in the source_id.
+
+    Args:
+        healpix_level (int): HEALPix level between 0 (12 tiles) and 12. Each level has 4 times the tiles.
+
+    Returns:
+        list: (first source_id, last source_id) of each tile, inclusive.
+
+    """
+    if not 0 <= healpix_level <= HEALPIX_MAX_LEVEL:
+        raise ValueError("healpix_level must be between 0 and {0}".format(HEALPIX_MAX_LEVEL))
+    level_12_per_tile = 4 ** (HEALPIX_MAX_LEVEL - healpix_level)
+    num_tiles = 12 * 4 ** healpix_level
+    return [(tile * level_12_per_tile * SOURCE_ID_HEALPIX_FACTOR,
+             (tile + 1) * level_12_per_tile * SOURCE_ID_HEALPIX_FACTOR - 1) for tile in range(num_tiles)]
+
+
+def tile_queries(query_template, healpix_level=1, source_id_column='gaia_source.source_id'):
+    """
+
+    Splits a query into one query per HEALPix tile of the sky.
+
+    Args:
+        query_template (str): ADQL query containing '{tile_condition}' where the tile condition should go, e.g.
+            "SELECT ... FROM gaiaedr3.gaia_source WHERE parallax_over_error > 5 AND {tile_condition}".
+        healpix_level (int): HEALPix level of the tiles (12 * 4 ** healpix_level tiles).
+        source_id_column (str): source_id column to put the condition on.
+
+    Returns:
+        list: One query per tile.
+
+    """
+    if TILE_PLACEHOLDER not in query_template:
+        raise ValueError("The query must contain {0} where the tile condition goes.".format(TILE_PLACEHOLDER))
+    return [query_template.replace(TILE_PLACEHOLDER, "{0} BETWEEN {1} AND {2}".format(source_id_column, first, last))
+            for first, last in healpix_source_id_ranges(healpix_level)]
+
+
+class JobScheduler:
+    """
+
+    Runs many queries as concurrent asyncronous jobs, with at most max_concurrent jobs at once. Each job runs (and is
+    polled by Astroquery) in its own thread. Failed jobs are retried, and results can be written to a Parquet dataset
+    as each job finishes, rather than held in memory.
+
+    """
+
+    def __init__(self, gaia_data_access, max_concurrent=4, max_retries=2, retry_wait=5.0):
+        """
+
+        Args:
+            gaia_data_access (GaiaDataAccess): Logged in connection to run the jobs with.
+            max_concurrent (int): Maximum number of jobs running at once. The archive limits the number of running
+                jobs per user, so there's no point going above that.
+            max_retries (int): Number of times a failed job is run again before giving up on it.
+            retry_wait (float): Seconds to wait before the first retry, doubled for each further retry.
+
+        """
+        self.gaia_data_access = gaia_data_access
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+
+    @staticmethod
+    def output_file_name(num, query, **kwargs):
+        """
+
+        Name of the Parquet file of a query's results: its number, and a hash of the query (and result changing
+        kwargs, see query_cache.query_key), so an earlier run of a different query is never taken for this one.
+
+        """
+        return "tile-{0:05d}-{1}.parquet".format(num, query_cache.query_key(query, job_kwargs=kwargs)[:16])
+
+    @staticmethod
+    def _finished(output_file):
+        # A file, or a directory if the results are partitioned
+        if not os.path.exists(output_file):
+            return False
+        try:
+            if os.path.isdir(output_file):
+                for root, _, names in os.walk(output_file):
+                    for name in names:
+                        pq.read_metadata(os.path.join(root, name))
+            else:
+                pq.read_metadata(output_file)
+            return True
+        except (OSError, pa.ArrowInvalid):
+            logger.warning("Removing unreadable results %s", output_file)
+            if os.path.isdir(output_file):
+                shutil.rmtree(output_file)
+            else:
+                os.remove(output_file)
+            return False
+
+    def _run_job(self, num, query, output_dir, parquet_kwargs, **kwargs):
+        output_file = None
+        if output_dir is not None:
+            output_file = os.path.join(output_dir, self.output_file_name(num, query, **kwargs))
+            if self._finished(output_file):
+                # Finished in an earlier run
+                return output_file
+        for attempt in range(self.max_retries + 1):
+            try:
+                data = self.gaia_data_access.gaia_query_to_pandas(query, **kwargs)
+                break
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Job %s failed (attempt %s), retrying", num, attempt + 1, exc_info=True)
+                time.sleep(self.retry_wait * 2 ** attempt)
+        if output_file is None:
+            return data
+        # Written in full before it takes the name of a finished file
+        tmp_file = "{0}.{1}.tmp".format(output_file, os.getpid())
+        parquet_io.write_parquet(data.to_df(), tmp_file, **(parquet_kwargs or {}))
+        os.replace(tmp_file, output_file)
+        return output_file
+
+    def run(self, queries, output_dir=None, job_kwargs=None, parquet_kwargs=None, **kwargs):
+        """
+
+        Runs the queries, returning once they have all finished.
+
+        Args:
+            queries (list): ADQL queries.
+            output_dir (str): Optional, default None. If set, the results of each query are written to a Parquet file
+                in this directory (see output_file_name) as soon as the query finishes. Queries with a readable file
+                already there (e.g. from an interrupted run of the same queries) are skipped.
+            job_kwargs (list): Optional, default None. Extra arguments of each query (dicts, in query order), e.g. the
+                upload_resource of each chunk of a cross match.
+            parquet_kwargs (dict): Optional, default None. Arguments of parquet_io.write_parquet for the files in
+                output_dir (compression, row_group_size, sort_by, partition_cols, sky_cell_level, compact). Files of
+                partitioned results are directories.
+
+        Kwargs:
+            Passed to GaiaDataAccess.gaia_query_to_pandas.
+
+        Returns:
+            BinaryStarDataFrame or list: The combined results of all the queries, in query order, or the Parquet files
+                written if output_dir is set.
+
+        Raises:
+            RuntimeError: If any query still fails after max_retries retries. The other queries are finished (and
+                written) first.
+
+        """
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        results = {}
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            futures = {executor.submit(self._run_job, num, query, output_dir, parquet_kwargs,
+                                       **dict(kwargs, **(job_kwargs[num] if job_kwargs is not None else {}))): num
+                       for num, query in enumerate(queries)}
+            for future in as_completed(futures):
+                num = futures[future]
+                try:
+                    results[num] = future.result()
+                except Exception as ex:
+                    logger.error("Job %s failed after %s retries: %s", num, self.max_retries, ex)
+                    failed[num] = ex
+        if failed:
+            raise RuntimeError("{0} of {1} queries failed: {2}".format(len(failed), len(queries),
+                                                                       sorted(failed.keys())))
+        ordered = [results[num] for num in range(len(queries))]
+        if output_dir is not None:
+            return ordered
+        from ashla.data_access.binary_data import BinaryStarDataFrame
+        if not ordered:
+            return BinaryStarDataFrame(pd.DataFrame())
+        return BinaryStarDataFrame(pd.concat([result.to_df() for result in ordered], ignore_index=True))
@@ -0,0 +1,182 @@
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+KNOWN_BINARIES_CSV = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'known_binaries.csv')
+
+
+def load_known_binaries(file_path=KNOWN_BINARIES_CSV):
+    """
+
+    Reads the known binaries table (binary_id and Gaia DR2 source_id, GDR2) from the paper.
+
+    """
+    known_binaries = pd.read_csv(file_path, usecols=['binary_id', 'GDR2'])
+    known_binaries['binary_id'] = known_binaries['binary_id'].astype(dtype=int)
+    return known_binaries
+
+
+class KnownBinariesIndex:
+    """
+
+    Index of stars known to be in binary (or multiple) systems: a sorted int64 array of source_ids, with the code of
+    each star's binary ID (into an array of the unique binary IDs). Lookups are a vectorised binary search, so tagging
+    millions of stars takes milliseconds. The arrays can be saved and memory mapped, so worker processes share them
+    rather than loading their own copy.
+
+    """
+
+    def __init__(self, source_ids, binary_id_codes, binary_ids):
+        """
+
+        Args:
+            source_ids (np.ndarray): Sorted, unique int64 source_ids.
+            binary_id_codes (np.ndarray): Position in binary_ids of each source's binary ID.
+            binary_ids (np.ndarray): Unique binary IDs.
+
+        """
+        self.source_ids = source_ids
+        self.binary_id_codes = binary_id_codes
+        self.binary_ids = binary_ids
+
+    @classmethod
+    def from_arrays(cls, source_ids, binary_ids):
+        """
+
+        Builds the index from (unsorted) source_id and binary ID arrays. If a source_id appears more than once, its
+        first binary ID is used. Rows with a missing source_id or binary ID are skipped.
+
+        """
+        source_ids = pd.Series(source_ids)
+        binary_ids = pd.Series(binary_ids, index=source_ids.index)
+        keep = source_ids.notnull() & binary_ids.notnull()
+        source_ids = source_ids[keep].to_numpy(dtype=np.int64)
+        binary_ids = binary_ids[keep].to_numpy()
+
+        order = np.argsort(source_ids, kind='stable')
+        source_ids = source_ids[order]
+        first = np.ones(len(source_ids), dtype=bool)
+        first[1:] = source_ids[1:] != source_ids[:-1]
+        codes, uniques = pd.factorize(binary_ids[order][first])
+        return cls(source_ids[first], codes.astype(np.int64), np.asarray(uniques))
+
+    @classmethod
+    def from_csv(cls, file_path=KNOWN_BINARIES_CSV):
+        known_binaries = load_known_binaries(file_path)
+        return cls.from_arrays(known_binaries['GDR2'], known_binaries['binary_id'])
+
+    @classmethod
+    def from_hipp_binaries(cls, data, source_id_column='source_id', ccdm_column='ccdm'):
+        """
+
+        Builds an index of the Hipparcos CCDM groups, from the output of GaiaDataAccess.gaia_get_hipp_binaries.
+
+        """
+        return cls.from_arrays(data[source_id_column], data[ccdm_column])
+
+    def extend(self, other):
+        """
+
+        Combines two indexes. Sources in both keep their binary ID from this index.
+
+        Args:
+            other (KnownBinariesIndex): Index to add, e.g. from from_hipp_binaries.
+
+        Returns:
+            KnownBinariesIndex: The combined index.
+
+        """
+        binary_ids = np.concatenate([self.binary_ids.astype(object)[self.binary_id_codes],
+                                     other.binary_ids.astype(object)[other.binary_id_codes]])
+        return KnownBinariesIndex.from_arrays(np.concatenate([self.source_ids, other.source_ids]), binary_ids)
+
+    def __len__(self):
+        return len(self.source_ids)
+
+    def _positions(self, source_ids):
+        source_ids = np.asarray(source_ids, dtype=np.int64)
+        if len(self.source_ids) == 0:
+            return np.zeros(len(source_ids), dtype=np.int64), np.zeros(len(source_ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.source_ids, source_ids), len(self.source_ids) - 1)
+        return positions, self.source_ids[positions] == source_ids
+
+    def contains(self, source_ids):
+        """
+
+        Returns:
+            np.ndarray: bool array, True for sources in a known binary.
+
+        """
+        return self._positions(source_ids)[1]
+
+    def lookup_codes(self, source_ids):
+        """
+
+        Returns:
+            np.ndarray: Position in binary_ids of each source's binary ID, -1 for sources not in a known binary.
+
+        """
+        positions, found = self._positions(source_ids)
+        if len(self.source_ids) == 0:
+            return np.full(len(positions), -1, dtype=np.int64)
+        return np.where(found, self.binary_id_codes[positions], -1)
+
+    def lookup(self, source_ids):
+        """
+
+        Returns:
+            pd.arrays.IntegerArray or np.ndarray: The binary ID of each source. Integer binary IDs stay integers
+                (nullable Int64, missing values are pd.NA), float IDs have NaN missing values and others None.
+
+        """
+        codes = self.lookup_codes(source_ids)
+        if self.binary_ids.dtype.kind in 'iub':
+            binary_ids = self.binary_ids.astype(np.int64)
+            if len(binary_ids) == 0:
+                return pd.arrays.IntegerArray(np.zeros(len(codes), dtype=np.int64), np.ones(len(codes), dtype=bool))
+            return pd.arrays.IntegerArray(binary_ids[np.maximum(codes, 0)], codes < 0)
+        if self.binary_ids.dtype.kind == 'f':
+            binary_ids = self.binary_ids.astype(np.float64)
+            missing = np.nan
+        else:
+            binary_ids = self.binary_ids.astype(object)
+            missing = None
+        if len(binary_ids) == 0:
+            return np.full(len(codes), missing, dtype=binary_ids.dtype)
+        output = binary_ids[np.maximum(codes, 0)]
+        output[codes < 0] = missing
+        return output
+
+    def save(self, directory):
+        """
+
+        Saves the index as .npy files in directory, for load (with memory mapping).
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'source_ids.npy'), self.source_ids)
+        np.save(os.path.join(directory, 'binary_id_codes.npy'), self.binary_id_codes)
+        np.save(os.path.join(directory, 'binary_ids.npy'), self.binary_ids, allow_pickle=True)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+
+        Loads an index saved with save. The source_id and code arrays are memory mapped by default.
+
+        """
+        return cls(np.load(os.path.join(directory, 'source_ids.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, 'binary_id_codes.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, 'binary_ids.npy'), allow_pickle=True))
+
+
+@functools.lru_cache(maxsize=None)
+def get_known_binaries_index(file_path=KNOWN_BINARIES_CSV):
+    """
+
+    The known binaries index, read from the CSV the first time it is used in the process and cached after that.
+
+    """
+    return KnownBinariesIndex.from_csv(file_path)
@@ -0,0 +1,214 @@
+import os
+
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from ashla.data_access import close_pairs
+from ashla.data_access import parquet_io
+from ashla.data_access.binary_data import BinaryStarDataFrame
+
+# Columns kept in the mirror, for each archive table used by the built in queries
+MIRROR_TABLES = {
+    'gaiadr2.gaia_source': ['source_id', 'ra', 'ra_error', 'dec', 'dec_error', 'parallax', 'parallax_error',
+                            'parallax_over_error', 'phot_g_mean_mag', 'bp_rp', 'radial_velocity',
+                            'radial_velocity_error', 'phot_variable_flag', 'teff_val', 'a_g_val', 'pmra', 'pmra_error',
+                            'pmdec', 'pmdec_error'],
+    'gaiaedr3.gaia_source': ['source_id', 'ra', 'ra_error', 'dec', 'dec_error', 'parallax', 'parallax_error',
+                             'parallax_over_error', 'pmra', 'pmra_error', 'pmdec', 'pmdec_error', 'dr2_radial_velocity',
+                             'dr2_radial_velocity_error', 'phot_g_mean_mag', 'phot_g_mean_flux', 'bp_rp', 'bp_g',
+                             'pseudocolour', 'dr2_rv_template_teff', 'l', 'b', 'ecl_lon', 'ecl_lat', 'random_index'],
+    'gaiadr2.hipparcos2_best_neighbour': ['source_id', 'original_ext_source_id', 'angular_distance',
+                                          'gaia_astrometric_params'],
+    'public.hipparcos_newreduction': ['hip', 'plx', 'e_plx'],
+    'public.hipparcos': ['hip', 'ccdm', 'n_ccdm', 'nsys'],
+}
+
+# Aliases used by the built in DR2 queries
+DR2_PROPER_MOTION_ALIASES = {'pmra': 'proper_motion_ra', 'pmra_error': 'proper_motion_ra_error',
+                             'pmdec': 'proper_motion_dec', 'pmdec_error': 'proper_motion_dec_error'}
+
+
+def mirror_table_path(mirror_dir, table):
+    schema, name = table.split('.')
+    return os.path.join(mirror_dir, schema, "{0}.parquet".format(name))
+
+
+def build_local_mirror(gaia_data_access, mirror_dir, gaia_source_conditions=None, compression='zstd', **kwargs):
+    """
+
+    Downloads the tables used by the built in queries to a local mirror, for LocalGaiaDataAccess. The Hipparcos tables
+    are downloaded whole (they are small), gaia_source only where gaia_source_conditions holds.
+
+    gaia_source is sorted by parallax_over_error before writing, so the row group statistics let the common
+    parallax_over_error cuts skip most of the file.
+
+    Args:
+        gaia_data_access (GaiaDataAccess): Logged in connection to the archive.
+        mirror_dir (str): Directory for the mirror.
+        gaia_source_conditions (str): Optional, default None. ADQL conditions for the gaia_source subset, e.g.
+            'parallax > 10'. None downloads the whole of gaia_source, which is not recommended.
+        compression (str): Parquet compression codec.
+
+    Kwargs:
+        Passed to GaiaDataAccess.gaia_query_to_pandas.
+
+    Returns:
+        str: mirror_dir.
+
+    """
+    for table, columns in MIRROR_TABLES.items():
+        query = "SELECT {0} FROM {1}".format(', '.join(columns), table)
+        if table.endswith('.gaia_source') and gaia_source_conditions is not None:
+            query += " WHERE {0}".format(gaia_source_conditions)
+        data = gaia_data_access.gaia_query_to_pandas(query, **kwargs).to_df()[columns]
+        path = mirror_table_path(mirror_dir, table)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        sort_by = 'parallax_over_error' if table.endswith('.gaia_source') else columns[0]
+        parquet_io.write_parquet(data, path, compression=compression, sort_by=sort_by)
+    return mirror_dir
+
+
+class LocalGaiaDataAccess:
+    """
+
+    Offline counterpart of GaiaDataAccess, running the built in queries against a local mirror of the archive tables
+    (see build_local_mirror) rather than on the archive. The methods have the same names and return the same columns
+    as GaiaDataAccess. Each query is a pandas / Arrow plan: filters are pushed down to the Parquet files, and joins are
+    done on source_id / hip indexes.
+
+    """
+
+    def __init__(self, mirror_dir):
+        self.mirror_dir = mirror_dir
+
+    def read_table(self, table, columns=None, filters=None):
+        """
+
+        Reads a table of the mirror (e.g. 'gaiadr2.gaia_source'), only loading the columns and rows asked for.
+
+        Args:
+            table (str): <schema>.<table> name, as in the archive.
+            columns (list): Optional, default None. Columns to read.
+            filters (pyarrow.dataset.Expression or list): Optional, default None. Row filters.
+
+        Returns:
+            pd.DataFrame: The matching rows.
+
+        """
+        return parquet_io.read_parquet_table(mirror_table_path(self.mirror_dir, table), columns=columns,
+                                             filters=filters).to_pandas()
+
+    def data_save_parquet(self, data, output_file_name, compression='gzip', **kwargs):
+        extension = "parquet.gzip" if compression == 'gzip' else "parquet"
+        return parquet_io.write_parquet(data, "{0}.{1}".format(output_file_name, extension), compression=compression,
+                                        **kwargs)
+
+    def gaia_get_dr2_initial_data(self, save_to_parquet=False, **kwargs):
+        """
+
+        Local version of GaiaDataAccess.gaia_get_dr2_initial_data.
+
+        """
+        columns = [col for col in MIRROR_TABLES['gaiadr2.gaia_source'] if col != 'parallax_over_error']
+        output_df = self.read_table('gaiadr2.gaia_source', columns=columns,
+                                    filters=ds.field('source_id').isin([4722135642226356736, 4722111590409480064]))
+        output_df = BinaryStarDataFrame(output_df.head(500).rename(columns=DR2_PROPER_MOTION_ALIASES))
+        if save_to_parquet:
+            self.data_save_parquet(output_df, "initial_dr2_data")
+        return output_df
+
+    def gaia_get_pairs_of_close_stars(self, save_to_parquet=False, data=None, max_dist=1.0, extra_conditions=None,
+                                      **kwargs):
+        """
+
+        Local version of GaiaDataAccess.gaia_get_pairs_of_close_stars. extra_conditions are Arrow filters here (an
+        expression, or a list of tuples, see parquet_io.read_parquet_table) rather than ADQL.
+
+        """
+        if data is None:
+            filters = ((ds.field('parallax_over_error') > 5) & ds.field('parallax').is_valid() &
+                       ds.field('pmra').is_valid() & ds.field('pmdec').is_valid() &
+                       ds.field('dr2_radial_velocity').is_valid())
+            if extra_conditions is not None:
+                if not isinstance(extra_conditions, ds.Expression):
+                    extra_conditions = pq.filters_to_expression(extra_conditions)
+                filters = filters & extra_conditions
+            data = self.read_table('gaiaedr3.gaia_source', filters=filters,
+                                   columns=['source_id', 'ra', 'ra_error', 'dec', 'dec_error', 'parallax',
+                                            'parallax_error', 'pmra', 'pmdec', 'pmra_error', 'pmdec_error',
+                                            'dr2_radial_velocity', 'dr2_radial_velocity_error'])
+        output_df = close_pairs.find_close_star_pairs(data, max_dist=max_dist)
+        if save_to_parquet:
+            self.data_save_parquet(output_df, "gaia_close_star_pairs")
+        return output_df
+
+    def _hipp_gaia_matches(self, gaia_columns, gaia_filters=None):
+        # hipparcos2_best_neighbour -> hipparcos_newreduction -> hipparcos, joined on hip, then to gaia_source on
+        # source_id. Only the gaia_source rows with a Hipparcos match are read.
+        hipp = self.read_table('public.hipparcos', filters=ds.field('ccdm').is_valid()).set_index('hip')
+        hipp2 = self.read_table('public.hipparcos_newreduction').set_index('hip')
+        best_neighbour = self.read_table('gaiadr2.hipparcos2_best_neighbour')
+        best_neighbour = best_neighbour.join(hipp2, on='original_ext_source_id', how='inner')
+        best_neighbour = best_neighbour.join(hipp, on='original_ext_source_id', how='inner').set_index('source_id')
+
+        filters = ds.field('source_id').isin(best_neighbour.index.to_numpy())
+        if gaia_filters is not None:
+            filters = filters & gaia_filters
+        gaia = self.read_table('gaiadr2.gaia_source', columns=gaia_columns, filters=filters)
+        matches = gaia.join(best_neighbour, on='source_id', how='inner')
+        parallax_ok = (matches['plx'] - matches['parallax']).abs() <= matches['e_plx'] + matches['parallax_error']
+        return matches, parallax_ok
+
+    def gaia_get_hipp_binaries(self, save_to_parquet=False, only_show_stars_with_both_stars_in_data=True, **kwargs):
+        """
+
+        Local version of GaiaDataAccess.gaia_get_hipp_binaries.
+
+        """
+        matches, parallax_ok = self._hipp_gaia_matches(MIRROR_TABLES['gaiadr2.gaia_source'])
+
+        # Number of stars of each CCDM system in both catalogues
+        counted = matches
+        if only_show_stars_with_both_stars_in_data:
+            counted = matches.loc[parallax_ok & (matches['parallax_over_error'] > 5)]
+        num_ccdm = counted.groupby('ccdm').size().rename('num_stars_in_binary_w_data_available')
+        if only_show_stars_with_both_stars_in_data:
+            num_ccdm = num_ccdm.loc[num_ccdm > 1]
+
+        selected = matches.loc[(matches['nsys'] >= 2) & (matches['gaia_astrometric_params'] == 5) & parallax_ok &
+                               (matches['parallax_over_error'] > 5)]
+        selected = selected.join(num_ccdm, on='ccdm', how='inner').sort_values('ccdm', kind='stable')
+        output_df = selected.rename(columns=dict(DR2_PROPER_MOTION_ALIASES, plx='hipp_parallax',
+                                                 e_plx='hipp_error_parallax', n_ccdm='ccdm_history',
+                                                 angular_distance='angular_distance_between_hipp_gaia'))
+        output_df = output_df[['source_id', 'ra', 'ra_error', 'dec', 'dec_error', 'parallax', 'parallax_error',
+                               'hipp_parallax', 'hipp_error_parallax', 'phot_g_mean_mag', 'parallax_over_error',
+                               'bp_rp', 'radial_velocity', 'radial_velocity_error', 'phot_variable_flag', 'teff_val',
+                               'a_g_val', 'proper_motion_ra', 'proper_motion_ra_error', 'proper_motion_dec',
+                               'proper_motion_dec_error', 'ccdm', 'ccdm_history', 'angular_distance_between_hipp_gaia',
+                               'num_stars_in_binary_w_data_available']]
+        output_df = BinaryStarDataFrame(output_df.reset_index(drop=True))
+        if save_to_parquet:
+            self.data_save_parquet(output_df, "hipp_binaries")
+        return output_df
+
+    def query_random_selection(self, num_results):
+        """
+
+        Local version of running query_random_selection(num_results): stars with good parallaxes and radial
+        velocities, in random_index order.
+
+        """
+        filters = (ds.field('dr2_radial_velocity').is_valid() & ds.field('parallax').is_valid() &
+                   ds.field('phot_g_mean_mag').is_valid() & ds.field('phot_g_mean_flux').is_valid() &
+                   ds.field('dr2_rv_template_teff').is_valid() & ds.field('bp_g').is_valid() &
+                   (ds.field('parallax_over_error') > 30) & (ds.field('dr2_radial_velocity_error') < 10))
+        columns = ['source_id', 'ra', 'dec', 'parallax', 'parallax_error', 'parallax_over_error', 'phot_g_mean_mag',
+                   'phot_g_mean_flux', 'bp_rp', 'dr2_radial_velocity', 'dr2_radial_velocity_error', 'pseudocolour',
+                   'dr2_rv_template_teff', 'pmra', 'pmdec', 'l', 'b', 'ecl_lon', 'ecl_lat', 'bp_g', 'random_index']
+        output_df = self.read_table('gaiaedr3.gaia_source', columns=columns, filters=filters)
+        if num_results is not None:
+            output_df = output_df.nsmallest(num_results, 'random_index')
+        else:
+            output_df = output_df.sort_values('random_index')
+        return BinaryStarDataFrame(output_df.drop(columns='random_index').reset_index(drop=True))
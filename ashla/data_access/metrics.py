@@ -0,0 +1,266 @@
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRecorder:
+    """
+
+    Records the wall time, rows, bytes and (optionally) peak memory of each stage of a pipeline, e.g. job submission,
+    archive queue wait, result download, to_pandas and the Parquet write of GaiaDataAccess.gaia_query_to_pandas.
+
+    Stages are timed with the stage context manager. Each finished stage gives a record (a dict), which is kept in
+    records, logged (as JSON, at INFO level, on the ashla.data_access.metrics logger), appended to the metrics file
+    (JSON lines) and passed to every hook. Stages can be nested, and record their parent stage.
+
+    Use set_recorder or recording to make a recorder the active one, used by GaiaDataAccess (unless it is given its
+    own) and the BinaryStarDataFrame methods.
+
+    """
+
+    def __init__(self, metrics_file=None, track_memory=False, log_records=True, enabled=True):
+        """
+
+        Args:
+            metrics_file (str): Optional, default None. JSON lines file the records are appended to.
+            track_memory (bool): Optional, default False. Record the peak memory allocated by each stage, with
+                tracemalloc (so Python and NumPy / pandas allocations, not Arrow's). This slows the stages down, and
+                the peaks are approximate when stages run at the same time in different threads.
+            log_records (bool): Optional, default True. Log each record.
+            enabled (bool): Optional, default True. If False, stages are not timed or recorded.
+
+        """
+        self.metrics_file = metrics_file
+        self.track_memory = track_memory
+        self.log_records = log_records
+        self.enabled = enabled
+        self.records = []
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open_stages = 0
+        self._started_tracemalloc = False
+
+    def add_hook(self, hook):
+        """
+
+        Adds a function called with each record (dict) as its stage finishes.
+
+        """
+        self.hooks.append(hook)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _start_memory_tracking(self):
+        with self._lock:
+            self._open_stages += 1
+            if self._open_stages == 1 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+
+    def _stop_memory_tracking(self):
+        with self._lock:
+            self._open_stages -= 1
+            if self._open_stages == 0 and self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+
+        Context manager timing a stage. The record is yielded, so the stage can add its rows, bytes or anything else:
+
+            with recorder.stage('download', job_id=job.jobid) as record:
+                ...
+                record['bytes'] = os.path.getsize(output_file)
+
+        Args:
+            name (str): Name of the stage.
+
+        Kwargs:
+            Extra fields of the record.
+
+        Yields:
+            dict: The record of the stage.
+
+        """
+        record = {'stage': name, 'rows': None, 'bytes': None}
+        record.update(fields)
+        if not self.enabled:
+            yield record
+            return
+
+        stack = self._stack()
+        record['parent'] = stack[-1]['record']['stage'] if stack else None
+        record['thread'] = threading.current_thread().name
+        frame = {'record': record, 'start_memory': None, 'peak_memory': 0}
+        if self.track_memory:
+            self._start_memory_tracking()
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak is reset for this stage, so fold it into the stages this one is nested in first
+            for open_frame in stack:
+                open_frame['peak_memory'] = max(open_frame['peak_memory'], peak)
+            tracemalloc.reset_peak()
+            frame['start_memory'] = current
+        stack.append(frame)
+        record['start_time'] = time.time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as ex:
+            record['error'] = repr(ex)
+            raise
+        finally:
+            record['wall_time_s'] = time.perf_counter() - start
+            stack.pop()
+            if self.track_memory:
+                frame['peak_memory'] = max(frame['peak_memory'], tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1]['peak_memory'] = max(stack[-1]['peak_memory'], frame['peak_memory'])
+                record['peak_memory_mb'] = (frame['peak_memory'] - frame['start_memory']) / 1e6
+                self._stop_memory_tracking()
+            self._finish(record)
+
+    def _finish(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self.metrics_file is not None:
+                with open(self.metrics_file, 'a') as metrics_file:
+                    metrics_file.write(json.dumps(record, default=str) + '\n')
+        if self.log_records:
+            logger.info("%s", json.dumps(record, default=str))
+        for hook in self.hooks:
+            hook(record)
+
+    def to_dataframe(self):
+        """
+
+        Returns:
+            pd.DataFrame: One row per record.
+
+        """
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        """
+
+        Returns:
+            pd.DataFrame: Per stage number of calls, total and mean wall time, total rows and bytes and the largest
+                peak memory, slowest (in total) first.
+
+        """
+        data = self.to_dataframe()
+        if data.empty:
+            return data
+        if 'peak_memory_mb' not in data.columns:
+            data['peak_memory_mb'] = float('nan')
+        summary = data.groupby('stage').agg(calls=('wall_time_s', 'size'), total_s=('wall_time_s', 'sum'),
+                                            mean_s=('wall_time_s', 'mean'), rows=('rows', 'sum'),
+                                            bytes=('bytes', 'sum'), peak_memory_mb=('peak_memory_mb', 'max'))
+        return summary.sort_values('total_s', ascending=False)
+
+    def write(self, path):
+        """
+
+        Writes all the records to a JSON lines file.
+
+        """
+        with open(path, 'w') as metrics_file:
+            for record in self.records:
+                metrics_file.write(json.dumps(record, default=str) + '\n')
+        return path
+
+    def clear(self):
+        self.records = []
+
+
+_active_recorder = MetricsRecorder(enabled=False)
+
+
+def get_recorder():
+    """
+
+    The active recorder. By default this is disabled, so nothing is recorded.
+
+    """
+    return _active_recorder
+
+
+def set_recorder(recorder):
+    """
+
+    Makes recorder the active recorder (None for a disabled one).
+
+    Returns:
+        MetricsRecorder: The previously active recorder.
+
+    """
+    global _active_recorder
+    previous = _active_recorder
+    _active_recorder = recorder if recorder is not None else MetricsRecorder(enabled=False)
+    return previous
+
+
+@contextlib.contextmanager
+def recording(recorder=None, **kwargs):
+    """
+
+    Context manager making a recorder the active one, and restoring the previous one at the end.
+
+    Args:
+        recorder (MetricsRecorder): Optional, default None. If None, a new MetricsRecorder is made with kwargs.
+
+    Yields:
+        MetricsRecorder: The active recorder.
+
+    """
+    if recorder is None:
+        recorder = MetricsRecorder(**kwargs)
+    previous = set_recorder(recorder)
+    try:
+        yield recorder
+    finally:
+        set_recorder(previous)
+
+
+def instrumented(name):
+    """
+
+    Decorator recording each call of a function (or method) as a stage of the active recorder. The rows of the
+    record are the length of the result, if it has one.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = _active_recorder
+            if not recorder.enabled:
+                return func(*args, **kwargs)
+            with recorder.stage(name) as record:
+                result = func(*args, **kwargs)
+                if hasattr(result, '__len__'):
+                    record['rows'] = len(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def table_nbytes(table):
+    """
+
+    Size in memory of the columns of an astropy Table (e.g. query results), in bytes.
+
+    """
+    return int(sum(getattr(table[col], 'nbytes', 0) for col in table.colnames))
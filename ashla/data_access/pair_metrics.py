@@ -0,0 +1,188 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from ashla.data_access import close_pairs
+
+# km/s per (mas/yr * pc)
+KMS_PER_MASYR_PC = 4.740470446e-3
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+
+    Angular separation in degrees between positions in degrees (haversine formula, accurate at small separations).
+
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (ra1, dec1, ra2, dec2))
+    hav = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1))))
+
+
+def pair_kinematics(pairs):
+    """
+
+    Separation and velocity differences of pairs of stars, with propagated errors, calculated for all the pairs at
+    once. Velocities use the mean distance of the pair, and ignore projection effects (fine for the small angular
+    separations of wide binaries).
+
+    Args:
+        pairs (pd.DataFrame): Pair rows, with the columns from close_pairs.find_close_star_pairs (ra1, dec1, d1, d1_err,
+            pmra1, pmra1_err, pmdec1, pmdec1_err, rad_vel1, rad_vel1_err and the same for star 2).
+
+    Returns:
+        pd.DataFrame: With the index of pairs, columns:
+            ang_sep_arcsec: Angular separation.
+            proj_sep_pc, proj_sep_pc_err: Projected separation at the mean distance.
+            delta_v_tan, delta_v_tan_err: Tangential velocity difference from the proper motions (km/s).
+            delta_rv, delta_rv_err: Radial velocity difference (km/s).
+            delta_v_3d, delta_v_3d_err: 3D velocity difference (km/s).
+
+    """
+    def col(name):
+        return pairs[name].to_numpy(dtype=np.float64)
+
+    ang_sep = angular_separation(col('ra1'), col('dec1'), col('ra2'), col('dec2'))
+    mean_dist = (col('d1') + col('d2')) / 2.0
+    mean_dist_err = np.sqrt(col('d1_err') ** 2 + col('d2_err') ** 2) / 2.0
+    proj_sep = np.radians(ang_sep) * mean_dist
+
+    d_pmra = col('pmra1') - col('pmra2')
+    d_pmdec = col('pmdec1') - col('pmdec2')
+    d_pmra_err2 = col('pmra1_err') ** 2 + col('pmra2_err') ** 2
+    d_pmdec_err2 = col('pmdec1_err') ** 2 + col('pmdec2_err') ** 2
+    d_pm = np.hypot(d_pmra, d_pmdec)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_pm_err = np.sqrt(np.where(d_pm > 0, (d_pmra ** 2 * d_pmra_err2 + d_pmdec ** 2 * d_pmdec_err2) / d_pm ** 2,
+                                    (d_pmra_err2 + d_pmdec_err2) / 2.0))
+        delta_v_tan = KMS_PER_MASYR_PC * d_pm * mean_dist
+        delta_v_tan_err = KMS_PER_MASYR_PC * np.hypot(d_pm_err * mean_dist, d_pm * mean_dist_err)
+
+        delta_rv = col('rad_vel1') - col('rad_vel2')
+        delta_rv_err = np.hypot(col('rad_vel1_err'), col('rad_vel2_err'))
+
+        delta_v_3d = np.hypot(delta_v_tan, delta_rv)
+        delta_v_3d_err = np.sqrt(np.where(delta_v_3d > 0,
+                                          (delta_v_tan ** 2 * delta_v_tan_err ** 2 + delta_rv ** 2 * delta_rv_err ** 2)
+                                          / delta_v_3d ** 2,
+                                          (delta_v_tan_err ** 2 + delta_rv_err ** 2) / 2.0))
+
+    return pd.DataFrame({'ang_sep_arcsec': ang_sep * 3600.0,
+                         'proj_sep_pc': proj_sep,
+                         'proj_sep_pc_err': np.radians(ang_sep) * mean_dist_err,
+                         'delta_v_tan': delta_v_tan,
+                         'delta_v_tan_err': delta_v_tan_err,
+                         'delta_rv': delta_rv,
+                         'delta_rv_err': delta_rv_err,
+                         'delta_v_3d': delta_v_3d,
+                         'delta_v_3d_err': delta_v_3d_err}, index=pairs.index)
+
+
+def offset_positions(ra, dec, offset_deg, bearing_deg):
+    """
+
+    Moves positions (in degrees) along great circles, by offset_deg at a bearing of bearing_deg (east of north). A
+    true angular offset, unlike a shift in RA, which barely moves stars near the poles.
+
+    Returns:
+        (np.ndarray, np.ndarray): RA (between 0 and 360) and Dec of the moved positions, in degrees.
+
+    """
+    ra, dec, offset, bearing = (np.radians(np.asarray(a, dtype=np.float64)) for a in (ra, dec, offset_deg,
+                                                                                       bearing_deg))
+    new_dec = np.arcsin(np.clip(np.sin(dec) * np.cos(offset) + np.cos(dec) * np.sin(offset) * np.cos(bearing),
+                                -1.0, 1.0))
+    new_ra = ra + np.arctan2(np.sin(bearing) * np.sin(offset) * np.cos(dec),
+                             np.cos(offset) - np.sin(dec) * np.sin(new_dec))
+    return np.degrees(new_ra) % 360.0, np.degrees(new_dec)
+
+
+# Star data for the chance alignment trials, set once per worker process rather than sent with every trial
+_trial_stars = None
+
+
+def _init_trial_worker(stars):
+    global _trial_stars
+    _trial_stars = stars
+
+
+def _chance_alignment_trial(seed, shift_range_deg, pair_kwargs, max_delta_v_tan, sep_bins):
+    """
+
+    One Monte Carlo trial: move every star by a random angular offset (in a random direction), and count the pairs
+    between the moved and the original stars. None of these can be physical, so they estimate the number of chance
+    alignments.
+
+    Pairs of a star with its own moved copy are dropped. Every other pair of stars A, B can be found twice, as A with
+    moved B and as B with moved A, while the candidates count each pair once, so each chance pair counts as a half.
+
+    """
+    rng = np.random.default_rng(seed)
+    stars = _trial_stars
+    moved = stars.copy()
+    moved['ra'], moved['dec'] = offset_positions(stars['ra'], stars['dec'], rng.uniform(*shift_range_deg, len(stars)),
+                                                 rng.uniform(0.0, 360.0, len(stars)))
+    moved = moved.drop(columns=['cart_x', 'cart_y', 'cart_z'], errors='ignore')
+    chance_pairs = close_pairs.find_close_star_pairs(stars, other=moved, **pair_kwargs)
+    chance_pairs = chance_pairs.loc[chance_pairs['id1'].to_numpy() != chance_pairs['id2'].to_numpy()]
+    if max_delta_v_tan is not None and len(chance_pairs):
+        chance_pairs = chance_pairs.loc[pair_kinematics(chance_pairs)['delta_v_tan'].to_numpy() <= max_delta_v_tan]
+    return np.histogram(chance_pairs['dist'].to_numpy(), bins=sep_bins)[0] / 2.0
+
+
+def estimate_chance_alignment(pairs, stars, num_trials=100, seed=0, shift_range_deg=(1.0, 5.0), sep_bins=20,
+                              max_delta_v_tan=None, max_workers=None, **pair_kwargs):
+    """
+
+    Monte Carlo estimate of the chance alignment probability of each candidate pair. Each trial moves the stars by a
+    random angular offset and counts the (necessarily unphysical) pairs found between the moved and original stars,
+    binned by separation (see _chance_alignment_trial). The probability of a candidate is the mean number of chance
+    pairs in its separation bin over the number of candidates in that bin.
+
+    Trials run in a process pool. Trial seeds are spawned from seed, so the results don't depend on max_workers or on
+    the order the trials finish in.
+
+    Args:
+        pairs (pd.DataFrame): Candidate pairs, from close_pairs.find_close_star_pairs.
+        stars (pd.DataFrame): Single star rows the candidates were found in.
+        num_trials (int): Number of Monte Carlo trials.
+        seed (int): Seed for the trials.
+        shift_range_deg (tuple): Range of the angular offset of the stars, in degrees. Large enough to break up real
+            pairs, small enough to keep the local star density.
+        sep_bins (int or np.ndarray): Separation bins (number, or bin edges in parsecs).
+        max_delta_v_tan (float): Optional, default None. Only count chance pairs with a tangential velocity difference
+            below this (km/s), to match a kinematic cut applied to the candidates.
+        max_workers (int): Optional, default None. Number of processes, None for the number of CPUs.
+
+    Kwargs:
+        Passed to close_pairs.find_close_star_pairs (max_dist, parallax_error_factor, ...), and should match the
+        search the candidates came from.
+
+    Returns:
+        pd.Series: Chance alignment probability of each pair (between 0 and 1), with the index of pairs.
+
+    """
+    max_dist = pair_kwargs.setdefault('max_dist', 1.0)
+    if np.ndim(sep_bins) == 0:
+        sep_bins = np.linspace(0.0, max_dist, int(sep_bins) + 1)
+    stars = close_pairs.prepare_single_stars(stars, pair_kwargs.get('min_parallax_over_error', 5),
+                                             pair_kwargs.get('require_kinematics', True)).to_df()
+
+    seeds = np.random.SeedSequence(seed).spawn(num_trials)
+    max_workers = max_workers or os.cpu_count() or 1
+    # spawn rather than fork: forking after NumPy / Arrow have started their thread pools can deadlock the workers
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_trial_worker, initargs=(stars,)) as executor:
+        futures = [executor.submit(_chance_alignment_trial, trial_seed, shift_range_deg, pair_kwargs,
+                                   max_delta_v_tan, sep_bins) for trial_seed in seeds]
+        chance_counts = np.sum([future.result() for future in futures], axis=0) / float(num_trials)
+
+    pair_dist = pairs['dist'].to_numpy(dtype=np.float64)
+    candidate_counts = np.histogram(pair_dist, bins=sep_bins)[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bin_probability = np.clip(np.where(candidate_counts > 0, chance_counts / candidate_counts, 0.0), 0.0, 1.0)
+    pair_bins = np.clip(np.digitize(pair_dist, sep_bins) - 1, 0, len(bin_probability) - 1)
+    return pd.Series(bin_probability[pair_bins], index=pairs.index, name='chance_alignment_prob')
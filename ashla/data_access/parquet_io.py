@@ -0,0 +1,163 @@
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from ashla.data_access import metrics
+from ashla.data_access import schema
+from ashla.data_access.healpix import SOURCE_ID_HEALPIX_FACTOR, HEALPIX_MAX_LEVEL
+
+PARQUET_CODECS = ('zstd', 'snappy', 'lz4', 'gzip', 'brotli', 'none')
+
+
+def sky_cell(source_id, healpix_level):
+    """
+
+    HEALPix (nested) index of the sky cell containing each source, at the given level, from its Gaia source_id.
+
+    """
+    return source_id // (SOURCE_ID_HEALPIX_FACTOR * 4 ** (HEALPIX_MAX_LEVEL - healpix_level))
+
+
+def write_parquet(data, path, compression='zstd', compression_level=None, row_group_size=1000000, sort_by=None,
+                  partition_cols=None, sky_cell_level=None, compact=True):
+    """
+
+    Writes a DataFrame (or Arrow table) to Parquet, with min / max statistics for every column of every row group, so
+    reads with filters (see read_parquet_table) can skip row groups and partitions.
+
+    Args:
+        data (pd.DataFrame or pa.Table): Data to write. Arrow tables are written without converting to pandas.
+        path (str): Output file, or directory if partitioning.
+        compression (str): Compression codec, one of PARQUET_CODECS. zstd is smaller than snappy and lz4 and much
+            faster than gzip, snappy and lz4 are the fastest to read.
+        compression_level (int): Optional, default None. Codec specific compression level.
+        row_group_size (int): Maximum number of rows per row group. Smaller row groups let filters skip more data,
+            at the cost of more overhead.
+        sort_by (str or list): Optional, default None. Sort by these columns before writing, which makes the row group
+            statistics (and so filtering on these columns) much more selective. source_id sorts by sky position.
+        partition_cols (list): Optional, default None. Write a directory partitioned (hive style) by these columns,
+            e.g. ['binary_id'].
+        sky_cell_level (int): Optional, default None. If set, adds a sky_cell column (HEALPix index at this level,
+            see sky_cell) and partitions by it.
+        compact (bool): Optional, default True. Write the known columns with compact dtypes (see
+            schema.COLUMN_SCHEMA), for smaller files which also read back compact.
+
+    Returns:
+        str: path.
+
+    """
+    if compression not in PARQUET_CODECS:
+        raise ValueError("compression must be one of {0}, not {1}".format(PARQUET_CODECS, compression))
+    recorder = metrics.get_recorder()
+    with recorder.stage('parquet_write', rows=len(data), path=path, compression=compression) as record:
+        _write_parquet(data, path, compression, compression_level, row_group_size, sort_by, partition_cols,
+                       sky_cell_level, compact)
+        if recorder.enabled:
+            record['bytes'] = path_size(path)
+    return path
+
+
+def path_size(path):
+    """
+
+    Size in bytes of a file, or of all the files in a directory.
+
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _write_parquet(data, path, compression, compression_level, row_group_size, sort_by, partition_cols,
+                   sky_cell_level, compact):
+    if isinstance(data, pa.Table):
+        table = _prepare_arrow_table(data, sort_by, sky_cell_level, compact)
+    else:
+        if hasattr(data, 'add_distance_cols'):
+            # Save the lazily calculated BinaryStarDataFrame columns too
+            data = data.add_distance_cols()
+        if compact:
+            data = schema.compact_dtypes(data)
+        if sky_cell_level is not None:
+            data = data.assign(sky_cell=sky_cell(data['source_id'], sky_cell_level))
+        if sort_by is not None:
+            data = data.sort_values(sort_by)
+        table = pa.Table.from_pandas(data, preserve_index=False)
+    if sky_cell_level is not None:
+        partition_cols = list(partition_cols or []) + ['sky_cell']
+
+    if not partition_cols:
+        pq.write_table(table, path, compression=compression, compression_level=compression_level,
+                       row_group_size=row_group_size, write_statistics=True)
+        return
+
+    file_options = ds.ParquetFileFormat().make_write_options(compression=compression,
+                                                             compression_level=compression_level,
+                                                             write_statistics=True)
+    ds.write_dataset(table, path, format='parquet', file_options=file_options,
+                     partitioning=partition_cols, partitioning_flavor='hive',
+                     max_rows_per_group=row_group_size, min_rows_per_group=min(row_group_size, 1 << 16),
+                     existing_data_behavior='delete_matching')
+
+
+def _prepare_arrow_table(table, sort_by, sky_cell_level, compact):
+    # Arrow version of the pandas preparation in _write_parquet, so Arrow tables are written without a pandas copy
+    if compact:
+        table = schema.compact_arrow_table(table)
+    if sky_cell_level is not None:
+        cell_size = SOURCE_ID_HEALPIX_FACTOR * 4 ** (HEALPIX_MAX_LEVEL - sky_cell_level)
+        # Integer division, as source_ids are positive
+        table = table.append_column('sky_cell', pc.divide(table.column('source_id'), cell_size))
+    if sort_by is not None:
+        sort_by = [sort_by] if isinstance(sort_by, str) else sort_by
+        table = table.sort_by([(col, 'ascending') for col in sort_by])
+    return table
+
+
+def sky_box_filter(ra_range=None, dec_range=None):
+    """
+
+    Filter expression for an RA / Dec box, in degrees. ra_range may wrap through 0 (e.g. (350, 10)).
+
+    """
+    expression = None
+    if ra_range is not None:
+        ra_min, ra_max = ra_range
+        if ra_min <= ra_max:
+            expression = (ds.field('ra') >= ra_min) & (ds.field('ra') <= ra_max)
+        else:
+            expression = (ds.field('ra') >= ra_min) | (ds.field('ra') <= ra_max)
+    if dec_range is not None:
+        dec_expression = (ds.field('dec') >= dec_range[0]) & (ds.field('dec') <= dec_range[1])
+        expression = dec_expression if expression is None else expression & dec_expression
+    return expression
+
+
+def read_parquet_table(path, columns=None, filters=None, ra_range=None, dec_range=None):
+    """
+
+    Reads a Parquet file or (partitioned) dataset as an Arrow table, only loading the columns asked for. Filters
+    are pushed down to the Parquet reader, so row groups and partitions whose statistics can't match are skipped.
+
+    Args:
+        path (str): Parquet file or dataset directory.
+        columns (list): Optional, default None. Columns to read. None reads all columns.
+        filters (list or pyarrow.dataset.Expression): Optional, default None. Row filters, either as an expression or
+            in the pandas / pyarrow list of tuples format, e.g. [('parallax_over_error', '>', 5)].
+        ra_range (tuple): Optional, default None. (min, max) RA in degrees, may wrap through 0.
+        dec_range (tuple): Optional, default None. (min, max) Dec in degrees.
+
+    Returns:
+        pa.Table: The matching rows.
+
+    """
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    box = sky_box_filter(ra_range=ra_range, dec_range=dec_range)
+    if box is not None:
+        filters = box if filters is None else filters & box
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    return dataset.to_table(columns=columns, filter=filters)
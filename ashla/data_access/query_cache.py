@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Quoted strings or identifiers (kept as they are), or runs of whitespace and comments (collapsed to a space)
+_NORMALISE_RE = re.compile(r'(\'(?:[^\']|\'\')*\'|"(?:[^"]|"")*")|(?:\s|--[^\n]*)+')
+_RELEASE_RE = re.compile(r'\bgaia(dr\d+|edr\d+|fpr)\b', re.IGNORECASE)
+# Job launch kwargs which don't change the results, so are left out of cache keys
+_RESULT_NEUTRAL_KWARGS = ('verbose', 'dump_to_file', 'output_file', 'background', 'autorun', 'name')
+
+
+def normalise_query(query):
+    """
+
+    Normalises ADQL text so that queries differing only in comments or whitespace share a cache entry. Text inside
+    quotes (string literals and delimited identifiers) is left as it is.
+
+    """
+    return _NORMALISE_RE.sub(lambda match: match.group(1) or ' ', query).strip()
+
+
+def query_release(query):
+    """
+
+    Catalogue release(s) a query uses, from the schema names in it (e.g. 'dr2', 'edr3'). Empty if none are found.
+
+    """
+    return ','.join(sorted({release.lower() for release in _RELEASE_RE.findall(query)}))
+
+
+def resource_digest(resource):
+    """
+
+    SHA-256 of an upload_resource (a file path, bytes or an astropy Table), so uploads with the same content share a
+    cache entry and uploads with different content don't.
+
+    """
+    digest = hashlib.sha256()
+    if isinstance(resource, bytes):
+        digest.update(resource)
+    elif isinstance(resource, (str, os.PathLike)):
+        with open(resource, 'rb') as resource_file:
+            for block in iter(lambda: resource_file.read(1 << 20), b''):
+                digest.update(block)
+    elif hasattr(resource, 'colnames'):
+        for name in resource.colnames:
+            column = resource[name]
+            digest.update(name.encode('utf-8'))
+            digest.update(str(column.dtype).encode('utf-8'))
+            digest.update(column.tobytes() if hasattr(column, 'tobytes') else repr(column.tolist()).encode('utf-8'))
+    else:
+        digest.update(repr(resource).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def canonical_job_kwargs(job_kwargs):
+    """
+
+    Canonical text of the job launch kwargs which can change the results of a query (upload_resource,
+    upload_table_name, output_format, maxrec, ...), with uploads replaced by the digest of their content. Empty if
+    there are none.
+
+    """
+    relevant = {}
+    for name, value in (job_kwargs or {}).items():
+        if name in _RESULT_NEUTRAL_KWARGS or value is None:
+            continue
+        relevant[name] = resource_digest(value) if name == 'upload_resource' else value
+    if not relevant:
+        return ''
+    return json.dumps(relevant, sort_keys=True, default=repr)
+
+
+def query_key(query, release=None, job_kwargs=None):
+    """
+
+    Hash of a query's normalised ADQL, catalogue release and result changing job kwargs. Queries with the same key
+    give the same results.
+
+    Args:
+        query (str): ADQL query.
+        release (str): Optional, default None. Catalogue release, if None it is taken from the query.
+        job_kwargs (dict): Optional, default None. Kwargs the job is launched with (e.g. upload_resource).
+
+    Returns:
+        str: SHA-256 hex digest.
+
+    """
+    release = query_release(query) if release is None else release
+    text = "{0}\n{1}".format(release, normalise_query(query))
+    kwargs_text = canonical_job_kwargs(job_kwargs)
+    if kwargs_text:
+        # Only added when there are any, so keys of plain queries are unchanged
+        text += "\n" + kwargs_text
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class QueryCache:
+    """
+
+    On disk cache of query results. Each entry is a Parquet file of the results, with a JSON file of metadata (query,
+    release, job ID, creation and last access time, number of rows and size), named by a hash of the normalised query,
+    the catalogue release and the job kwargs which change the results (see canonical_job_kwargs), including the
+    content of any upload.
+
+    """
+
+    def __init__(self, cache_dir, ttl=None, max_size_bytes=None):
+        """
+
+        Args:
+            cache_dir (str): Directory for the cache files. Created if it doesn't exist.
+            ttl (float): Optional, default None. Seconds before an entry expires. None keeps entries forever.
+            max_size_bytes (int): Optional, default None. When the cache is larger than this, the least recently used
+                entries are removed. None has no limit.
+
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, query, release=None, job_kwargs=None):
+        """
+
+        Cache key of a query, see query_key.
+
+        """
+        return query_key(query, release=release, job_kwargs=job_kwargs)
+
+    def _paths(self, key):
+        return (os.path.join(self.cache_dir, "{0}.parquet".format(key)),
+                os.path.join(self.cache_dir, "{0}.json".format(key)))
+
+    def _read_metadata(self, key):
+        metadata_path = self._paths(key)[1]
+        try:
+            with open(metadata_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _replace(self, path, write):
+        # Written to a temporary file of its own first, so concurrent writers of an entry never share a file, and
+        # readers only see complete files
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=os.path.basename(path) + '.', suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _write_metadata(self, key, metadata):
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(metadata, f)
+
+        self._replace(self._paths(key)[1], write)
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get(self, query, release=None, as_arrow=False, job_kwargs=None):
+        """
+
+        Args:
+            query (str): ADQL query.
+            release (str): Optional, default None. Catalogue release, if None it is taken from the query.
+            job_kwargs (dict): Optional, default None. Kwargs the job is launched with, see key.
+            as_arrow (bool): Optional, default False. Return an Arrow table rather than a DataFrame.
+
+        Returns:
+            pd.DataFrame or pa.Table: The cached results, or None if there is no (unexpired) entry.
+
+        """
+        key = self.key(query, release, job_kwargs=job_kwargs)
+        metadata = self._read_metadata(key)
+        data_path = self._paths(key)[0]
+        if metadata is not None and self.ttl is not None and time.time() - metadata['created'] > self.ttl:
+            self._remove(key)
+            self.evictions += 1
+            metadata = None
+        if metadata is None or not os.path.exists(data_path):
+            self.misses += 1
+            return None
+        data = pq.read_table(data_path) if as_arrow else pd.read_parquet(data_path)
+        metadata['last_access'] = time.time()
+        self._write_metadata(key, metadata)
+        self.hits += 1
+        return data
+
+    def put(self, query, data, release=None, job_id=None, job_kwargs=None):
+        """
+
+        Adds query results to the cache, then evicts entries if the cache is over its size limit.
+
+        Args:
+            query (str): ADQL query.
+            data (pd.DataFrame or pa.Table): Results of the query.
+            release (str): Optional, default None. Catalogue release, if None it is taken from the query.
+            job_id (str): Optional, default None. Archive job ID of the results.
+            job_kwargs (dict): Optional, default None. Kwargs the job was launched with, see key.
+
+        """
+        release = query_release(query) if release is None else release
+        key = self.key(query, release, job_kwargs=job_kwargs)
+        data_path = self._paths(key)[0]
+        if isinstance(data, pa.Table):
+            self._replace(data_path, lambda tmp_path: pq.write_table(data, tmp_path, compression='snappy'))
+        else:
+            self._replace(data_path, lambda tmp_path: pd.DataFrame(data).to_parquet(tmp_path, compression='snappy'))
+        now = time.time()
+        self._write_metadata(key, {'query': normalise_query(query), 'release': release,
+                                   'job_kwargs': canonical_job_kwargs(job_kwargs), 'job_id': job_id,
+                                   'created': now, 'last_access': now, 'rows': len(data),
+                                   'size_bytes': os.path.getsize(data_path)})
+        self.evict()
+
+    def entries(self):
+        """
+
+        Returns:
+            pd.DataFrame: Metadata of every entry in the cache, indexed by key.
+
+        """
+        keys = [name[:-5] for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+        metadata = {key: self._read_metadata(key) for key in keys}
+        return pd.DataFrame.from_dict({key: value for key, value in metadata.items() if value is not None},
+                                      orient='index')
+
+    def evict(self):
+        """
+
+        Removes expired entries, then the least recently used entries until the cache is within max_size_bytes.
+
+        Returns:
+            int: Number of entries removed.
+
+        """
+        entries = self.entries()
+        if entries.empty:
+            return 0
+        removed = []
+        if self.ttl is not None:
+            removed += entries.index[time.time() - entries['created'] > self.ttl].tolist()
+        if self.max_size_bytes is not None:
+            remaining = entries.drop(index=removed).sort_values('last_access', ascending=False)
+            over_limit = remaining['size_bytes'].cumsum() > self.max_size_bytes
+            removed += remaining.index[over_limit].tolist()
+        for key in removed:
+            self._remove(key)
+        self.evictions += len(removed)
+        return len(removed)
+
+    def clear(self):
+        for key in self.entries().index:
+            self._remove(key)
+
+    def stats(self):
+        """
+
+        Returns:
+            dict: Hits, misses and evictions since the cache was created, and the current entries and size.
+
+        """
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(entries),
+                'size_bytes': int(entries['size_bytes'].sum()) if not entries.empty else 0}
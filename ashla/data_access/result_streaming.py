@@ -0,0 +1,170 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from ashla.data_access import schema
+
+STREAMING_FORMATS = ('csv', 'fits')
+
+
+def csv_column_types(file_path, block_size, column_types=None):
+    """
+
+    Arrow types to read the columns of a CSV result file with. pyarrow would infer the types from the first block
+    alone and keep them for the whole file, so a column with only nulls there (or only integers, before floats) fails
+    in a later block. Known columns (schema.COLUMN_SCHEMA) get their type, widened (float64, int64 or string) so any
+    archive value parses; the file is compacted afterwards. Other columns are inferred from the first block, with
+    all null columns read as strings and integer columns as float64 (so later non integer values still parse). Give
+    integer columns which need all 64 bits, such as IDs, in column_types.
+
+    Args:
+        file_path (str): Result file, optionally gzipped.
+        block_size (int): Bytes read at a time.
+        column_types (dict): Optional, default None. Column -> Arrow type, overriding the types above.
+
+    Returns:
+        dict: Column -> Arrow type, for every column of the file.
+
+    """
+    reader = pa_csv.open_csv(file_path, read_options=pa_csv.ReadOptions(block_size=block_size))
+    inferred = reader.schema
+    reader.close()
+    types = {}
+    for field in inferred:
+        if field.name in schema.COLUMN_SCHEMA:
+            kind = schema.arrow_type(schema.COLUMN_SCHEMA[field.name])
+            if pa.types.is_floating(kind):
+                types[field.name] = pa.float64()
+            elif pa.types.is_integer(kind):
+                types[field.name] = pa.int64()
+            else:
+                types[field.name] = pa.string()
+        elif pa.types.is_null(field.type):
+            types[field.name] = pa.string()
+        elif pa.types.is_integer(field.type):
+            types[field.name] = pa.float64()
+        else:
+            types[field.name] = field.type
+    types.update(column_types or {})
+    return types
+
+
+def _iter_csv_batches(file_path, block_size, column_types=None):
+    # Every block is read with the same, explicit, column types (see csv_column_types), so every chunk has the same
+    # schema (nulls stay nulls rather than turning integer columns into floats).
+    convert_options = pa_csv.ConvertOptions(column_types=csv_column_types(file_path, block_size, column_types))
+    reader = pa_csv.open_csv(file_path, read_options=pa_csv.ReadOptions(block_size=block_size),
+                             convert_options=convert_options)
+    for batch in reader:
+        yield batch
+
+
+def _iter_fits_batches(file_path, chunk_rows):
+    from astropy.io import fits
+    from astropy.table import Table
+
+    if file_path.endswith('.gz'):
+        # Compressed FITS can't be memory mapped, so decompress to disk first (streamed, not into memory)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            unzipped_path = os.path.join(tmp_dir, os.path.basename(file_path)[:-3])
+            with gzip.open(file_path, 'rb') as f_in, open(unzipped_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            yield from _iter_fits_batches(unzipped_path, chunk_rows)
+        return
+
+    with fits.open(file_path, memmap=True) as hdu_list:
+        data = hdu_list[1].data
+        for start in range(0, len(data), chunk_rows):
+            chunk = Table(data[start:start + chunk_rows]).to_pandas()
+            yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+
+def iter_result_file_tables(file_path, output_format, chunk_rows=1000000, block_size=1 << 24, column_types=None):
+    """
+
+    Reads a TAP result file incrementally, as Arrow tables of at most chunk_rows rows.
+
+    Args:
+        file_path (str): Result file, optionally gzipped.
+        output_format (str): 'csv' or 'fits'. VOTables can't be parsed incrementally.
+        chunk_rows (int): Maximum number of rows per table.
+        block_size (int): Bytes read at a time from CSV files.
+        column_types (dict): Optional, default None. Column -> Arrow type of CSV columns, see csv_column_types.
+
+    Yields:
+        pa.Table: The next chunk of rows.
+
+    """
+    if output_format == 'csv':
+        batches = _iter_csv_batches(file_path, block_size, column_types=column_types)
+    elif output_format == 'fits':
+        batches = _iter_fits_batches(file_path, chunk_rows)
+    else:
+        raise ValueError("Streaming needs one of the output formats {0}, not {1}".format(STREAMING_FORMATS,
+                                                                                        output_format))
+    pending = []
+    pending_rows = 0
+    for batch in batches:
+        while batch.num_rows:
+            take = min(chunk_rows - pending_rows, batch.num_rows)
+            pending.append(batch.slice(0, take))
+            pending_rows += take
+            batch = batch.slice(take)
+            if pending_rows == chunk_rows:
+                yield pa.Table.from_batches(pending)
+                pending, pending_rows = [], 0
+    if pending_rows:
+        yield pa.Table.from_batches(pending)
+
+
+def iter_result_file_chunks(file_path, output_format, chunk_rows=1000000, column_types=None):
+    """
+
+    Reads a TAP result file incrementally, as BinaryStarDataFrame chunks.
+
+    Args:
+        file_path (str): Result file, optionally gzipped.
+        output_format (str): 'csv' or 'fits'.
+        chunk_rows (int): Maximum number of rows per chunk.
+        column_types (dict): Optional, default None. Column -> Arrow type of CSV columns, see csv_column_types.
+
+    Yields:
+        BinaryStarDataFrame: The next chunk of rows.
+
+    """
+    from ashla.data_access.binary_data import BinaryStarDataFrame
+    for table in iter_result_file_tables(file_path, output_format, chunk_rows=chunk_rows, column_types=column_types):
+        yield BinaryStarDataFrame(table.to_pandas(), compact=True)
+
+
+def result_file_to_parquet_dataset(file_path, output_format, output_dir, chunk_rows=1000000, compression='snappy',
+                                   column_types=None):
+    """
+
+    Converts a TAP result file to a Parquet dataset (a directory of part files), one chunk at a time.
+
+    Args:
+        file_path (str): Result file, optionally gzipped.
+        output_format (str): 'csv' or 'fits'.
+        output_dir (str): Directory for the dataset. Created if it doesn't exist.
+        chunk_rows (int): Maximum number of rows per part file.
+        compression (str): Parquet compression codec.
+        column_types (dict): Optional, default None. Column -> Arrow type of CSV columns, see csv_column_types.
+
+    Returns:
+        list: Paths of the part files written.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    part_files = []
+    for num, table in enumerate(iter_result_file_tables(file_path, output_format, chunk_rows=chunk_rows,
+                                                        column_types=column_types)):
+        part_file = os.path.join(output_dir, "part-{0:05d}.parquet".format(num))
+        pq.write_table(table, part_file, compression=compression)
+        part_files.append(part_file)
+    return part_files
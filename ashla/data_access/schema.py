@@ -0,0 +1,203 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+logger = logging.getLogger(__name__)
+
+# Compact dtypes of the columns returned by the built in queries (and added by BinaryStarDataFrame). float32 is only
+# used where its precision (about 7 significant figures) is well below the measurement errors. Positions (ra, dec,
+# l, b, ecl_lon, ecl_lat) stay float64, as float32 would lose tens of milliarcseconds, and so do the parallaxes, their
+# errors and the distances from them, as the pair and distance cuts difference and divide them.
+COLUMN_SCHEMA = {
+    # Identifiers
+    'source_id': 'int64',
+    'random_index': 'int64',
+    'hip': 'Int32',
+    # Astrometry
+    'ra_error': 'float32',
+    'dec_error': 'float32',
+    'parallax': 'float64',
+    'parallax_error': 'float64',
+    'parallax_over_error': 'float64',
+    'pmra': 'float32',
+    'pmra_error': 'float32',
+    'pmdec': 'float32',
+    'pmdec_error': 'float32',
+    'proper_motion_ra': 'float32',
+    'proper_motion_ra_error': 'float32',
+    'proper_motion_dec': 'float32',
+    'proper_motion_dec_error': 'float32',
+    'radial_velocity': 'float32',
+    'radial_velocity_error': 'float32',
+    'dr2_radial_velocity': 'float32',
+    'dr2_radial_velocity_error': 'float32',
+    # Photometry and astrophysical parameters
+    'phot_g_mean_mag': 'float32',
+    'phot_g_mean_flux': 'float32',
+    'bp_rp': 'float32',
+    'bp_g': 'float32',
+    'pseudocolour': 'float32',
+    'teff_val': 'float32',
+    'a_g_val': 'float32',
+    'dr2_rv_template_teff': 'float32',
+    'phot_variable_flag': 'category',
+    # Hipparcos
+    'hipp_parallax': 'float64',
+    'hipp_error_parallax': 'float64',
+    'angular_distance_between_hipp_gaia': 'float32',
+    'gaia_astrometric_params': 'Int8',
+    'ccdm': 'category',
+    'ccdm_history': 'Int8',
+    'nsys': 'Int8',
+    'num_stars_in_binary_w_data_available': 'Int16',
+    # Added by BinaryStarDataFrame
+    'dist_pc': 'float64',
+    'dist_err_pc': 'float64',
+    'dot_size': 'float32',
+    'rgb_colour': 'category',
+    'rgb_r': 'float32',
+    'rgb_g': 'float32',
+    'rgb_b': 'float32',
+}
+
+
+# pandas dtypes of the small Arrow integer types, so their nulls convert to nullable integers rather than float NaN
+NULLABLE_INT_TYPES = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype()}
+
+
+def _cast_column(values, dtype):
+    """
+
+    Casts a Series to dtype, where this loses nothing but precision the schema allows. Integer columns with missing
+    values become nullable integers, and columns which don't fit (non integer or out of range values) are left as they
+    are.
+
+    """
+    target = pd.api.types.pandas_dtype(dtype)
+    if values.dtype == target or isinstance(values.dtype, pd.ArrowDtype):
+        # Arrow backed columns are compacted in Arrow, see compact_arrow_table
+        return values
+    if isinstance(target, pd.CategoricalDtype):
+        return values.astype('category')
+    if values.dtype == object:
+        # Masked values come through to_pandas as object columns
+        values = pd.to_numeric(values, errors='coerce')
+    if target.kind == 'f':
+        return values.astype(target)
+
+    numpy_target = target.numpy_dtype if isinstance(target, pd.api.extensions.ExtensionDtype) else target
+    present = values.dropna()
+    if len(present):
+        info = np.iinfo(numpy_target)
+        if present.min() < info.min or present.max() > info.max:
+            return values
+        if values.dtype.kind == 'f' and not np.array_equal(present, np.floor(present)):
+            return values
+    if values.isna().any() and not isinstance(target, pd.api.extensions.ExtensionDtype):
+        target = pd.api.types.pandas_dtype(target.name.capitalize())
+    return values.astype(target)
+
+
+def compact_dtypes(data, schema=None):
+    """
+
+    Casts the columns of data to the compact dtypes of the schema. Columns not in the schema are left as they are.
+
+    Args:
+        data (pd.DataFrame): Data, e.g. query results. Not changed.
+        schema (dict): Optional, default None. Column -> dtype. None for COLUMN_SCHEMA.
+
+    Returns:
+        pd.DataFrame: data with the compact columns.
+
+    """
+    schema = COLUMN_SCHEMA if schema is None else schema
+    changes = {}
+    for col, dtype in schema.items():
+        if col in data.columns:
+            original = data[col]
+            values = _cast_column(original, dtype)
+            if values is not original:
+                changes[col] = values
+    if not changes:
+        return data
+    output = data.assign(**changes)
+    if logger.isEnabledFor(logging.DEBUG):
+        report = memory_report(data, output)
+        logger.debug("Compact dtypes saved %.1f MB (%.1f%%)", report.loc['total', 'saved_bytes'] / 1e6,
+                     100. * report.loc['total', 'saved_bytes'] / max(report.loc['total', 'before_bytes'], 1))
+    return output
+
+
+def arrow_type(dtype):
+    """
+
+    Arrow type of a schema dtype. Categoricals become dictionary encoded strings.
+
+    """
+    if dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.from_numpy_dtype(pd.api.types.pandas_dtype(dtype.lower()))
+
+
+def compact_arrow_table(table, schema=None):
+    """
+
+    Arrow version of compact_dtypes: casts the columns of an Arrow table to the compact types of the schema. Integer
+    columns whose values don't fit are left as they are. Missing values stay nulls, so no nullable types are needed.
+
+    Args:
+        table (pa.Table): Data, e.g. from arrow_results.table_to_arrow.
+        schema (dict): Optional, default None. Column -> dtype. None for COLUMN_SCHEMA.
+
+    Returns:
+        pa.Table: table with the compact columns.
+
+    """
+    schema = COLUMN_SCHEMA if schema is None else schema
+    for num, name in enumerate(table.column_names):
+        if name not in schema:
+            continue
+        column = table.column(num)
+        target = arrow_type(schema[name])
+        if column.type == target:
+            continue
+        try:
+            if pa.types.is_dictionary(target):
+                if not pa.types.is_string(column.type) and not pa.types.is_large_string(column.type):
+                    column = pc.cast(column, pa.string())
+                column = pc.dictionary_encode(column)
+            else:
+                # Unsafe for floats, as float64 -> float32 is meant to lose precision. Integers are checked.
+                column = pc.cast(column, target, safe=not pa.types.is_floating(target))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            continue
+        table = table.set_column(num, name, column)
+    return table
+
+
+def memory_report(before, after):
+    """
+
+    Memory used by each column before and after compacting (e.g. with compact_dtypes).
+
+    Args:
+        before (pd.DataFrame): Original data.
+        after (pd.DataFrame): Compacted data.
+
+    Returns:
+        pd.DataFrame: Per column (and a final total row) dtype and bytes before and after, and bytes saved.
+
+    """
+    before_bytes = before.memory_usage(index=False, deep=True)
+    after_bytes = after.memory_usage(index=False, deep=True).reindex(before_bytes.index)
+    report = pd.DataFrame({'before_dtype': before.dtypes.astype(str),
+                           'after_dtype': after.dtypes.reindex(before.columns).astype(str),
+                           'before_bytes': before_bytes,
+                           'after_bytes': after_bytes})
+    report['saved_bytes'] = report['before_bytes'] - report['after_bytes']
+    report.loc['total'] = ['', '', before_bytes.sum(), after_bytes.sum(), before_bytes.sum() - after_bytes.sum()]
+    return report
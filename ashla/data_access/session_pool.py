@@ -0,0 +1,112 @@
+import os
+import threading
+
+# Seconds before a pooled session logs in again. The archive ends idle sessions on its side, after which jobs would
+# run anonymously (or fail), so sessions are renewed well before then.
+DEFAULT_SESSION_MAX_AGE = 1800.
+
+
+class SessionPool:
+    """
+
+    Pool of logged in GaiaDataAccess sessions, one per login config, shared by everything asking for the same login.
+    Reusing a session saves the login (and its HTTPS round trips) of each query, e.g. for batch scripts running many
+    queries through the module level helpers (run_gaia_query, query_gaia_to_pandas, gaia_query_to_parquet).
+
+    The pool is thread safe: concurrent callers asking for the same login get the same session, which logs in once
+    (see GaiaDataAccess.connect). Sessions log in again when older than session_max_age, or when the archive rejects
+    their login (see GaiaDataAccess.renew), so expired sessions are renewed without the callers noticing.
+
+    """
+
+    def __init__(self, session_max_age=DEFAULT_SESSION_MAX_AGE, **session_kwargs):
+        """
+
+        Args:
+            session_max_age (float): Optional, default DEFAULT_SESSION_MAX_AGE. Seconds before a session logs in
+                again. None to keep the first login.
+
+        Kwargs:
+            Passed on to each new GaiaDataAccess (e.g. cache_dir, metrics_recorder).
+
+        """
+        self.session_max_age = session_max_age
+        self.session_kwargs = session_kwargs
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(login_config):
+        return os.path.abspath(login_config) if login_config is not None else None
+
+    def get(self, login_config=None):
+        """
+
+        Args:
+            login_config (str): Optional, default None. Path of the login config file (see config.GaiaLoginConf). If
+                None, the session of the interactive login (you are prompted for your details once).
+
+        Returns:
+            GaiaDataAccess: The shared session of this login. It logs in when first used.
+
+        """
+        key = self._key(login_config)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                # Imported here, as the GaiaDataAccess module imports this one
+                from ashla.data_access import GaiaDataAccess
+                session = GaiaDataAccess(login_config=login_config, session_max_age=self.session_max_age,
+                                         **self.session_kwargs)
+                self._sessions[key] = session
+        return session
+
+    def close(self):
+        """
+
+        Logs out of the sessions which logged in, and empties the pool.
+
+        """
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.disconnect()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+_default_pool = SessionPool()
+
+
+def get_session_pool():
+    """
+
+    The process wide pool used by the module level helpers.
+
+    """
+    return _default_pool
+
+
+def set_session_pool(pool):
+    """
+
+    Makes pool the process wide pool (None for a new default one), e.g. to give the sessions a query cache.
+
+    Returns:
+        SessionPool: The previous pool. It is not closed.
+
+    """
+    global _default_pool
+    previous = _default_pool
+    _default_pool = pool if pool is not None else SessionPool()
+    return previous
+
+
+def get_session(login_config=None):
+    """
+
+    Shared session of a login, from the process wide pool (see SessionPool.get).
+
+    """
+    return _default_pool.get(login_config)
@@ -1,11 +1,58 @@
+import functools
+
 import numpy as np
 import pandas as pd
-from astropy import units as u
-from astropy.coordinates import SkyCoord
 
 
-def ra_dec_dist_to_cartesian(ra, dec, distance):
-    c = SkyCoord(ra=ra * u.degree, dec=dec * u.degree, distance=distance * u.kpc)
+def ra_dec_dist_to_cartesian(ra, dec, distance, out=None, dtype=np.float64):
+    """
+
+    Converts RA / Dec (degrees) and distance to cartesian coordinates, in the units of the distance. Vectorised with
+    NumPy, matching ra_dec_dist_to_cartesian_skycoord (ICRS cartesian representation) without the astropy overhead.
+
+    Args:
+        ra (array-like): Right ascension, in degrees.
+        dec (array-like): Declination, in degrees.
+        distance (array-like): Distance.
+        out (tuple): Optional, default None. Three preallocated arrays (x, y, z) to write the results into.
+        dtype (np.dtype): Optional, default np.float64. dtype of the output arrays, if out is None. Calculations are
+            always done in float64.
+
+    Returns:
+        (pd.Series, pd.Series, pd.Series): x, y and z, with the index of ra if ra is a Series. If ra is not a Series,
+            or out is given, arrays are returned instead.
+
+    """
+    index = ra.index if isinstance(ra, pd.Series) else None
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    distance = np.asarray(distance, dtype=np.float64)
+
+    if out is None:
+        x, y, z = (np.empty(ra.shape, dtype=dtype) for _ in range(3))
+    else:
+        x, y, z = out
+
+    dist_cos_dec = distance * np.cos(dec)
+    np.multiply(dist_cos_dec, np.cos(ra), out=x, casting='same_kind')
+    np.multiply(dist_cos_dec, np.sin(ra), out=y, casting='same_kind')
+    np.multiply(distance, np.sin(dec), out=z, casting='same_kind')
+
+    if out is None and index is not None:
+        return pd.Series(x, index=index), pd.Series(y, index=index), pd.Series(z, index=index)
+    return x, y, z
+
+
+def ra_dec_dist_to_cartesian_skycoord(ra, dec, distance):
+    """
+
+    Reference (astropy SkyCoord) version of ra_dec_dist_to_cartesian. Slow and memory hungry on large arrays, kept to
+    check the accuracy of the NumPy version.
+
+    """
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    c = SkyCoord(ra=np.asarray(ra) * u.degree, dec=np.asarray(dec) * u.degree, distance=np.asarray(distance) * u.kpc)
     x = c.cartesian.x
     y = c.cartesian.y
     z = c.cartesian.z
@@ -40,5 +87,109 @@ def bv2rgb(b_g_ci):
         max(0, min(255, blueco(temp))) / 255.)
 
 
+# Colour of stars without a (finite) colour index: white, as bv2rgb gives for NaN
+FALLBACK_RGB = (1., 1., 1.)
+
+
+def bv2rgb_array(b_g_ci, lookup_table=None):
+    """
+
+    Vectorised version of bv2rgb, converting an array of colour indices to RGB colours in one pass.
+
+    Args:
+        b_g_ci (array-like): Colour indices (e.g. bp_g).
+        lookup_table (tuple): Optional, default None. Table from bv2rgb_lookup_table. Colour indices within the table
+            range are interpolated from it, the rest are calculated exactly.
+
+    Returns:
+        np.ndarray: (N, 3) array of RGB values between 0 and 1. Missing (or infinite) colour indices give
+            FALLBACK_RGB.
+
+    """
+    b_g_ci = np.asarray(b_g_ci, dtype=np.float64)
+    rgb = np.empty(b_g_ci.shape + (3,), dtype=np.float64)
+    if lookup_table is None:
+        exact = np.ones(b_g_ci.shape, dtype=bool)
+    else:
+        grid, table = lookup_table
+        exact = ~((b_g_ci >= grid[0]) & (b_g_ci <= grid[-1]))
+        in_table = ~exact
+        for channel in range(3):
+            rgb[in_table, channel] = np.interp(b_g_ci[in_table], grid, table[:, channel])
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # convert to temp K
+        temp = 4600 * (1 / (0.92 * b_g_ci[exact] + 1.7) + 1 / (0.92 * b_g_ci[exact] + 0.62))
+        # convert to RGB
+        for channel, poly in enumerate((redco, greenco, blueco)):
+            rgb[exact, channel] = np.clip(poly(temp), 0, 255) / 255.
+    rgb[~np.isfinite(b_g_ci) | ~np.isfinite(rgb).all(axis=-1)] = FALLBACK_RGB
+    return rgb
+
+
+@functools.lru_cache(maxsize=8)
+def bv2rgb_lookup_table(b_g_min=-0.5, b_g_max=5.0, num_points=4096):
+    """
+
+    Precomputes bv2rgb over a grid of colour indices, for use with bv2rgb_array. The default range covers the usual
+    Gaia bp_g values, and avoids the pole of the temperature formula at -0.62 / 0.92.
+
+    Args:
+        b_g_min (float): Smallest colour index in the table.
+        b_g_max (float): Largest colour index in the table.
+        num_points (int): Number of grid points.
+
+    Returns:
+        (np.ndarray, np.ndarray): Grid of colour indices, and the (num_points, 3) RGB values at those points.
+
+    """
+    grid = np.linspace(b_g_min, b_g_max, num_points)
+    table = bv2rgb_array(grid)
+    grid.setflags(write=False)
+    table.setflags(write=False)
+    return grid, table
+
+
+def rgb_to_strings(rgb):
+    """
+
+    Formats an (N, 3) array of RGB values as plotting strings, e.g. 'rgb(0.5, 0.25, 1.0)'.
+
+    """
+    return np.array(["rgb({0}, {1}, {2})".format(*colour) for colour in np.asarray(rgb).tolist()], dtype=object)
+
+
+def bv2rgb_colours(b_g_ci, output='string', lookup_table=None):
+    """
+
+    Converts colour indices to colours for plotting. Only the unique colour indices are converted, so strings are
+    built once per colour rather than once per row.
+
+    Args:
+        b_g_ci (array-like): Colour indices (e.g. bp_g).
+        output (str): 'rgb' for an (N, 3) float array, 'string' for an object array of 'rgb(r, g, b)' strings or
+            'category' for a pd.Categorical of those strings.
+        lookup_table (tuple): Optional, default None. Table from bv2rgb_lookup_table, passed to bv2rgb_array.
+
+    Returns:
+        np.ndarray or pd.Categorical: Colours, in the format given by output.
+
+    """
+    if output not in ('rgb', 'string', 'category'):
+        raise ValueError("output must be one of 'rgb', 'string' or 'category', not {0}".format(output))
+    b_g_ci = np.asarray(b_g_ci, dtype=np.float64)
+    unique_ci, inverse = np.unique(b_g_ci, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    unique_rgb = bv2rgb_array(unique_ci, lookup_table=lookup_table)
+    if output == 'rgb':
+        return unique_rgb[inverse]
+    colours = rgb_to_strings(unique_rgb)
+    if output == 'string':
+        return colours[inverse]
+    # Identical colours from different colour indices share a category
+    categories, codes = np.unique(colours.astype(str), return_inverse=True)
+    return pd.Categorical.from_codes(codes.reshape(-1)[inverse], categories=categories)
+
+
 def dot_size_from_mag(g_mag, max_mag=19):
     return 2 ** (max_mag - g_mag)
@@ -0,0 +1,47 @@
+"""
+
+Benchmark of utils.ra_dec_dist_to_cartesian (NumPy) against the astropy SkyCoord reference version. Their agreement
+is tested in tests/test_utils.py.
+
+Usage:
+    python benchmarks/bench_cartesian.py [num_rows]
+
+"""
+import sys
+import time
+
+import numpy as np
+
+from ashla import utils
+
+
+def time_call(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main(num_rows=1000000):
+    rng = np.random.default_rng(42)
+    ra = rng.uniform(0., 360., num_rows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., num_rows)))
+    dist = 1000. / rng.uniform(0.5, 50., num_rows)
+
+    sky_time, sky_xyz = time_call(utils.ra_dec_dist_to_cartesian_skycoord, ra, dec, dist)
+    np_time, np_xyz = time_call(utils.ra_dec_dist_to_cartesian, ra, dec, dist)
+    out = tuple(np.empty(num_rows, dtype=np.float32) for _ in range(3))
+    np32_time, _ = time_call(utils.ra_dec_dist_to_cartesian, ra, dec, dist, out=out)
+
+    max_diff = max(np.max(np.abs(np.asarray(s) - n)) for s, n in zip(sky_xyz, np_xyz))
+    max_diff_32 = max(np.max(np.abs(np.asarray(s) - n) / dist) for s, n in zip(sky_xyz, out))
+
+    print("rows: {0}".format(num_rows))
+    print("SkyCoord:        {0:.3f} s".format(sky_time))
+    print("NumPy float64:   {0:.3f} s ({1:.1f}x)".format(np_time, sky_time / np_time))
+    print("NumPy float32:   {0:.3f} s ({1:.1f}x)".format(np32_time, sky_time / np32_time))
+    print("max abs diff (float64): {0:.3e}".format(max_diff))
+    print("max rel diff (float32): {0:.3e}".format(max_diff_32))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
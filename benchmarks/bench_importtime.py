@@ -0,0 +1,62 @@
+"""
+
+Startup time check for ashla.data_access, using python -X importtime. Fails (exit code 1) if the import takes longer
+than the budget, or if it loads any of the modules which should only be imported when used (dask, astroquery,
+astropy, scipy).
+
+Usage:
+    python benchmarks/bench_importtime.py [budget_ms] [num_runs]
+
+"""
+import os
+import subprocess
+import sys
+
+MODULE = 'ashla.data_access'
+LAZY_MODULES = ('dask', 'astroquery', 'astropy', 'scipy')
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def import_times(module):
+    """
+
+    Imports module in a new interpreter.
+
+    Returns:
+        dict: Module name -> (self time, cumulative time) in microseconds, for every module imported.
+
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(module)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main(budget_ms=400, num_runs=5):
+    runs = [import_times(MODULE) for _ in range(num_runs)]
+    # Best of the runs, the others are slowed down by a cold disk cache or other processes
+    best = min(runs, key=lambda times: times[MODULE][1])
+    total_ms = best[MODULE][1] / 1000.
+
+    print("import {0}: {1:.1f} ms (best of {2}, budget {3} ms)".format(MODULE, total_ms, num_runs, budget_ms))
+    print("slowest modules (self time):")
+    for name, (self_us, _) in sorted(best.items(), key=lambda item: -item[1][0])[:10]:
+        print("    {0:8.1f} ms  {1}".format(self_us / 1000., name))
+
+    eager = sorted(name for name in best if name.split('.')[0] in LAZY_MODULES)
+    if eager:
+        print("FAIL: modules which should be lazy were imported: {0}".format(', '.join(eager[:10])))
+    if total_ms > budget_ms:
+        print("FAIL: import took longer than the budget")
+    return 1 if eager or total_ms > budget_ms else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*(int(arg) for arg in sys.argv[1:])))
@@ -0,0 +1,47 @@
+"""
+
+Benchmark of Parquet write / read throughput for each compression codec, and of reading with column projection and
+filters.
+
+Usage:
+    python benchmarks/bench_parquet.py [num_rows]
+
+"""
+import os
+import sys
+import tempfile
+import time
+
+from ashla.data_access import parquet_io
+from ashla.data_access.binary_data import BinaryStarDataFrame
+from synthetic_catalogue import make_catalogue
+
+
+def main(num_rows=1000000):
+    data = make_catalogue(num_rows)[0]
+    size_mb = data.memory_usage(deep=True).sum() / 1e6
+    print("rows: {0}, in memory: {1:.1f} MB".format(num_rows, size_mb))
+    print("{0:<8} {1:>10} {2:>12} {3:>12} {4:>14}".format('codec', 'file MB', 'write MB/s', 'read MB/s',
+                                                         'filtered read'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for codec in parquet_io.PARQUET_CODECS:
+            path = os.path.join(tmp_dir, "data_{0}.parquet".format(codec))
+            start = time.perf_counter()
+            parquet_io.write_parquet(data, path, compression=codec, row_group_size=100000, sort_by='ra')
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            BinaryStarDataFrame.from_parquet(path)
+            read_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            BinaryStarDataFrame.from_parquet(path, columns=['source_id', 'ra', 'dec', 'parallax'],
+                                             filters=[('parallax_over_error', '>', 5)], ra_range=(10., 20.))
+            filtered_time = time.perf_counter() - start
+
+            print("{0:<8} {1:>10.1f} {2:>12.1f} {3:>12.1f} {4:>12.3f} s".format(
+                codec, os.path.getsize(path) / 1e6, size_mb / write_time, size_mb / read_time, filtered_time))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,233 @@
+"""
+
+Benchmark suite of the hot paths (BinaryStarDataFrame construction, coordinate and plotting columns, binary ID
+tagging, pair finding, Parquet round trip and TAP result conversion, through pandas and through Arrow), on seeded
+synthetic catalogues (see synthetic_catalogue.py). Each benchmark is timed (best of --repeat runs), and its peak Python
+memory allocation (not including Arrow's) measured with tracemalloc in a separate run. Results are written as JSON,
+and can be compared with an earlier run.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--sizes 10000 1000000 10000000] [--repeat 3] [--output results.json]
+        [--compare old_results.json] [--only construction parquet_roundtrip ...]
+
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from ashla.data_access import GaiaDataAccess
+from ashla.data_access import close_pairs
+from ashla.data_access import parquet_io
+from ashla.data_access.binary_data import BinaryStarDataFrame, group_binary_systems
+from ashla.data_access.known_binaries import KnownBinariesIndex
+from synthetic_catalogue import make_catalogue
+
+
+class StubGaiaJob:
+    """
+
+    Stands in for an Astroquery job, returning a prepared astropy Table.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.jobid = None
+
+    def get_results(self):
+        return self.table
+
+
+class StubGaia:
+    """
+
+    Stands in for the Astroquery Gaia class, so gaia_query_to_pandas can be timed without the archive.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def launch_job_async(self, query, **kwargs):
+        return StubGaiaJob(self.table)
+
+    def launch_job(self, query, **kwargs):
+        return StubGaiaJob(self.table)
+
+
+def setup_star_df(context):
+    return (BinaryStarDataFrame(context['stars'], copy=True).add_distance_cols(),)
+
+
+def setup_binary_index(context):
+    pairs = context['pairs']
+    index = KnownBinariesIndex.from_arrays(np.concatenate([pairs['source_id_1'], pairs['source_id_2']]),
+                                           np.concatenate([pairs['binary_id'], pairs['binary_id']]))
+    return BinaryStarDataFrame(context['stars'], copy=True), index
+
+
+def setup_tagged_stars(context):
+    stars, index = setup_binary_index(context)
+    return (stars.add_binary_sys_id_column(known_binaries_index=index).to_df(),)
+
+
+def setup_tap_stub(context):
+    from astropy.table import Table
+    gaia_data_access = GaiaDataAccess()
+    gaia_data_access._gaia = StubGaia(Table.from_pandas(context['stars']))
+    return (gaia_data_access,)
+
+
+def parquet_roundtrip(data, tmp_dir):
+    path = os.path.join(tmp_dir, 'roundtrip.parquet')
+    parquet_io.write_parquet(data, path, compression='zstd')
+    return BinaryStarDataFrame.from_parquet(path)
+
+
+def recovered_pairs(pairs, context):
+    """
+
+    Fraction of the injected binaries found by the pair search, for checking the pair search and the generator.
+
+    """
+    injected = context['pairs']
+    found = pd.MultiIndex.from_arrays([np.minimum(pairs['id1'], pairs['id2']), np.maximum(pairs['id1'], pairs['id2'])])
+    expected = pd.MultiIndex.from_arrays([np.minimum(injected['source_id_1'], injected['source_id_2']),
+                                          np.maximum(injected['source_id_1'], injected['source_id_2'])])
+    found_fraction = float(expected.isin(found).mean()) if len(expected) else 0.
+    return {'num_pairs': len(pairs), 'injected_pairs_found': found_fraction}
+
+
+# name -> (setup, function to benchmark, optional check of the result). setup is not timed, and is run again before
+# every run, as most of the functions add columns in place.
+BENCHMARKS = {
+    'construction': (lambda context: (context['stars'],), BinaryStarDataFrame, None),
+    'distance_cols': (lambda context: (BinaryStarDataFrame(context['stars'], copy=True),),
+                      lambda data: data.add_distance_cols(), None),
+    'cartesian_coords': (setup_star_df, lambda data: data.add_cartesian_coords_cols(), None),
+    'plotting_cols': (setup_star_df, lambda data: data.add_plotting_data_cols(), None),
+    'plotting_cols_lookup_rgb': (setup_star_df,
+                                 lambda data: data.add_plotting_data_cols(colour_output='rgb', use_lookup_table=True),
+                                 None),
+    'binary_id_tagging': (setup_binary_index,
+                          lambda data, index: data.add_binary_sys_id_column(known_binaries_index=index), None),
+    'group_binary_systems': (setup_tagged_stars, group_binary_systems, None),
+    'close_pairs': (lambda context: (context['stars'],),
+                    lambda data: close_pairs.find_close_star_pairs(data, max_dist=0.25, min_parallax_over_error=20,
+                                                                 require_kinematics=False),
+                    recovered_pairs),
+    'parquet_roundtrip': (lambda context: (context['stars'], context['tmp_dir']), parquet_roundtrip, None),
+    'tap_result_to_dataframe': (setup_tap_stub,
+                                lambda gaia_data_access: gaia_data_access.gaia_query_to_pandas('SELECT stub',
+                                                                                               use_cache=False),
+                                None),
+    'tap_result_to_arrow_df': (setup_tap_stub,
+                               lambda gaia_data_access: gaia_data_access.gaia_query_to_pandas('SELECT stub',
+                                                                                              use_cache=False,
+                                                                                              arrow_backed=True),
+                               None),
+}
+
+
+def run_benchmark(name, context, repeat):
+    setup, func, check = BENCHMARKS[name]
+    times = []
+    for _ in range(repeat):
+        args = setup(context)
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+        del result, args
+
+    args = setup(context)
+    tracemalloc.start()
+    result = func(*args)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    num_rows = len(context['stars'])
+    output = {'benchmark': name,
+              'num_rows': num_rows,
+              'times_s': times,
+              'best_s': min(times),
+              'mean_s': sum(times) / len(times),
+              'rows_per_s': num_rows / min(times) if min(times) > 0 else None,
+              'peak_memory_mb': peak_memory / 1e6}
+    if check is not None:
+        output.update(check(result, context))
+    return output
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_results):
+    old = {(result['benchmark'], result['num_rows']): result for result in old_results['results']}
+    print("\n{0:<26} {1:>10} {2:>10} {3:>10} {4:>8} {5:>10}".format('benchmark', 'rows', 'old s', 'new s', 'speedup',
+                                                                  'mem ratio'))
+    for result in results['results']:
+        previous = old.get((result['benchmark'], result['num_rows']))
+        if previous is None:
+            continue
+        print("{0:<26} {1:>10} {2:>10.4f} {3:>10.4f} {4:>7.2f}x {5:>10.2f}".format(
+            result['benchmark'], result['num_rows'], previous['best_s'], result['best_s'],
+            previous['best_s'] / result['best_s'] if result['best_s'] > 0 else float('inf'),
+            result['peak_memory_mb'] / previous['peak_memory_mb'] if previous['peak_memory_mb'] > 0 else float('inf')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ashla hot paths on synthetic catalogues.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000], help="Catalogue sizes (rows).")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs of each benchmark.")
+    parser.add_argument('--seed', type=int, default=42, help="Seed of the synthetic catalogues.")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="Only run these benchmarks.")
+    parser.add_argument('--output', help="JSON file for the results.")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with.")
+    args = parser.parse_args(argv)
+
+    results = {'metadata': {'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                            'git_commit': git_commit(),
+                            'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'numpy': np.__version__,
+                            'pandas': pd.__version__,
+                            'seed': args.seed,
+                            'repeat': args.repeat},
+               'results': []}
+    print("{0:<26} {1:>10} {2:>10} {3:>14} {4:>10}".format('benchmark', 'rows', 'best s', 'rows/s', 'peak MB'))
+    for num_rows in args.sizes:
+        stars, pairs = make_catalogue(num_rows, seed=args.seed)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            context = {'stars': stars, 'pairs': pairs, 'tmp_dir': tmp_dir}
+            for name in args.only or BENCHMARKS:
+                result = run_benchmark(name, context, args.repeat)
+                results['results'].append(result)
+                print("{0:<26} {1:>10} {2:>10.4f} {3:>14.0f} {4:>10.1f}".format(
+                    name, num_rows, result['best_s'], result['rows_per_s'] or 0, result['peak_memory_mb']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as old_file:
+            compare(results, json.load(old_file))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+
+Seeded generator of synthetic gaia_source-like catalogues for the benchmarks, with injected wide binary pairs.
+
+Stars are spread uniformly in volume out to max_dist_pc, with Gaia EDR3 column names and roughly realistic magnitudes,
+colours, errors (growing with magnitude) and kinematics. Radial velocities are only given for stars brighter than
+G = 13, as in Gaia. A fraction of the stars are replaced by the secondaries of wide binaries: at the distance of their
+primary, within max_binary_sep_au of it on the sky, and moving with it (plus a small orbital velocity).
+
+Usage:
+    python benchmarks/synthetic_catalogue.py [num_rows] [seed]
+
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+# km/s per (mas/yr * kpc)
+KMS_PER_MASYR_KPC = 4.740470446
+AU_PER_PC = 206264.806
+MAX_SOURCE_ID = 6917529027641081855
+
+
+def make_catalogue(num_rows, seed=42, binary_fraction=0.1, max_dist_pc=2000., min_binary_sep_au=100.,
+                   max_binary_sep_au=50000.):
+    """
+
+    Args:
+        num_rows (int): Number of stars.
+        seed (int): Seed, the same seed always gives the same catalogue.
+        binary_fraction (float): Fraction of the stars in injected wide binaries.
+        max_dist_pc (float): Maximum distance of the stars, in parsecs.
+        min_binary_sep_au (float): Minimum projected separation of the binaries, in AU.
+        max_binary_sep_au (float): Maximum projected separation of the binaries, in AU. Separations are log-uniform.
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): The stars, in source_id order, and the injected pairs (source_id_1, source_id_2,
+            binary_id, sep_pc).
+
+    """
+    rng = np.random.default_rng(seed)
+    num_pairs = int(num_rows * binary_fraction / 2)
+    # Strictly increasing source_ids
+    source_id = np.sort(rng.integers(0, MAX_SOURCE_ID - num_rows, num_rows)) + np.arange(num_rows)
+    # Random rows for the primaries and secondaries, so the binaries are spread through the source_id order
+    binary_rows = rng.permutation(num_rows)[:2 * num_pairs]
+    primary, secondary = binary_rows[:num_pairs], binary_rows[num_pairs:]
+
+    # True positions and velocities
+    ra = rng.uniform(0., 360., num_rows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., num_rows)))
+    dist_pc = np.maximum(max_dist_pc * rng.uniform(0., 1., num_rows) ** (1. / 3.), 10.)
+    v_ra, v_dec, v_rad = (rng.normal(0., 30., num_rows) for _ in range(3))
+
+    sep_pc = np.exp(rng.uniform(np.log(min_binary_sep_au), np.log(max_binary_sep_au), num_pairs)) / AU_PER_PC
+    position_angle = rng.uniform(0., 2. * np.pi, num_pairs)
+    ang_sep_deg = np.degrees(sep_pc / dist_pc[primary])
+    dist_pc[secondary] = dist_pc[primary]
+    dec[secondary] = np.clip(dec[primary] + ang_sep_deg * np.cos(position_angle), -90., 90.)
+    ra[secondary] = (ra[primary] + ang_sep_deg * np.sin(position_angle) / np.cos(np.radians(dec[primary]))) % 360.
+    orbital_v = rng.normal(0., 1., (3, num_pairs))
+    v_ra[secondary] = v_ra[primary] + orbital_v[0]
+    v_dec[secondary] = v_dec[primary] + orbital_v[1]
+    v_rad[secondary] = v_rad[primary] + orbital_v[2]
+
+    # Photometry
+    abs_mag = rng.normal(5., 3., num_rows)
+    phot_g_mean_mag = np.clip(abs_mag + 5. * np.log10(dist_pc) - 5., 3., 21.)
+    bp_rp = np.clip(0.4 + 0.15 * abs_mag + rng.normal(0., 0.2, num_rows), -0.5, 5.)
+    bp_g = 0.45 * bp_rp + rng.normal(0., 0.05, num_rows)
+
+    # Observed values, with errors growing with magnitude
+    parallax_error = np.clip(0.02 * 10. ** (0.2 * (phot_g_mean_mag - 15.)), 0.01, 2.)
+    parallax = 1000. / dist_pc + rng.normal(0., 1., num_rows) * parallax_error
+    pm_error = 1.1 * parallax_error
+    pmra = v_ra / (KMS_PER_MASYR_KPC * dist_pc / 1000.) + rng.normal(0., 1., num_rows) * pm_error
+    pmdec = v_dec / (KMS_PER_MASYR_KPC * dist_pc / 1000.) + rng.normal(0., 1., num_rows) * pm_error
+    has_rv = phot_g_mean_mag < 13.
+    rv_error = np.where(has_rv, np.clip(0.3 * 10. ** (0.2 * (phot_g_mean_mag - 10.)), 0.2, 10.), np.nan)
+    rv = np.where(has_rv, v_rad + rng.normal(0., 1., num_rows) * rv_error, np.nan)
+
+    stars = pd.DataFrame({'source_id': source_id,
+                          'ra': ra,
+                          'ra_error': 0.8 * parallax_error,
+                          'dec': dec,
+                          'dec_error': 0.8 * parallax_error,
+                          'parallax': parallax,
+                          'parallax_error': parallax_error,
+                          'parallax_over_error': parallax / parallax_error,
+                          'pmra': pmra,
+                          'pmra_error': pm_error,
+                          'pmdec': pmdec,
+                          'pmdec_error': pm_error,
+                          'dr2_radial_velocity': rv,
+                          'dr2_radial_velocity_error': rv_error,
+                          'phot_g_mean_mag': phot_g_mean_mag,
+                          'phot_g_mean_flux': 10. ** (-0.4 * (phot_g_mean_mag - 25.6874)),
+                          'bp_rp': bp_rp,
+                          'bp_g': bp_g,
+                          'random_index': rng.permutation(num_rows)})
+    pairs = pd.DataFrame({'source_id_1': source_id[primary],
+                          'source_id_2': source_id[secondary],
+                          'binary_id': np.arange(num_pairs),
+                          'sep_pc': sep_pc})
+    return stars, pairs
+
+
+def main(num_rows=10000, seed=42):
+    stars, pairs = make_catalogue(num_rows, seed=seed)
+    print(stars.describe().T.to_string())
+    print("injected pairs: {0}".format(len(pairs)))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -20,7 +20,7 @@ setup(
     long_description=README,
     long_description_content_type="text/markdown",
     description="A package for researching Wide Binary stars.",
-    install_requires=["dash", "numpy", "pandas", "astropy", "astroquery", "plotly"],
+    install_requires=["dash", "numpy", "pandas", "scipy", "dask", "pyarrow", "astropy", "astroquery", "plotly"],
     classifiers=[
         "Programming Language :: Python :: 3",
     ],
@@ -0,0 +1,137 @@
+"""
+
+Stand ins for the Astroquery Gaia class and its jobs, so GaiaDataAccess can be tested without the archive.
+
+"""
+import threading
+import time
+
+import numpy as np
+from astropy.table import Table
+
+
+class FakeJob:
+
+    def __init__(self, results, jobid, output_file=None):
+        self.results = results
+        self.jobid = jobid
+        self.outputFile = output_file
+
+    def wait_for_job_end(self, verbose=False):
+        return 200, 'COMPLETED'
+
+    def save_results(self, verbose=False):
+        self.results.write(self.outputFile, format='votable')
+
+    def get_results(self):
+        return self.results
+
+
+class FakeGaia:
+    """
+
+    Answers every launched job with results(query, **kwargs) (an astropy Table), recording the calls and the most
+    jobs running at once. The first num_failures jobs raise RuntimeError.
+
+    """
+
+    def __init__(self, results=None, delay=0., num_failures=0):
+        self.results = results if results is not None else default_results
+        self.delay = delay
+        self.num_failures = num_failures
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def launch_job_async(self, query, **kwargs):
+        with self._lock:
+            self.calls.append((query, kwargs))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            fail = self.num_failures > 0
+            self.num_failures -= fail
+        try:
+            time.sleep(self.delay)
+            if fail:
+                raise RuntimeError("Job failed")
+            return FakeJob(self.results(query, **kwargs), jobid=str(len(self.calls)),
+                           output_file=kwargs.get('output_file'))
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    launch_job = launch_job_async
+
+
+def default_results(query, **kwargs):
+    # A different result for each query text
+    seed = sum(query.encode('utf-8'))
+    return Table({'source_id': np.arange(3, dtype=np.int64) + seed, 'parallax': np.full(3, 1.5)})
+
+
+def fake_gaia_data_access(fake_gaia=None, **kwargs):
+    """
+
+    GaiaDataAccess running its jobs on a FakeGaia, rather than logging in to the archive.
+
+    """
+    from ashla.data_access import GaiaDataAccess
+    gaia_data_access = GaiaDataAccess(**kwargs)
+    gaia_data_access._gaia = fake_gaia if fake_gaia is not None else FakeGaia()
+    return gaia_data_access
+
+
+class RejectedResponse:
+    """
+
+    HTTP response of the archive rejecting the login of a request.
+
+    """
+
+    status = 401
+    reason = 'Unauthorized'
+
+    def getheaders(self):
+        return []
+
+    def read(self, size=None):
+        return b''
+
+
+class RejectingConnHandler:
+    """
+
+    Astroquery TAP connection handler answering every request with RejectedResponse, so the real Astroquery Gaia
+    class raises the exception it raises when the archive has ended a session.
+
+    """
+
+    def execute_tappost(self, subcontext=None, data=None, content_type=None, verbose=False):
+        return RejectedResponse()
+
+    def check_launch_response_status(self, response, debug, expected_response_status, raise_exception=True):
+        return response.status != expected_response_status
+
+    def get_file_from_header(self, headers):
+        return None
+
+    def get_suitable_extension(self, headers):
+        return ''
+
+    def get_suitable_extension_by_format(self, output_format):
+        return ''
+
+    def find_header(self, headers, key):
+        return None
+
+
+def rejecting_gaia():
+    """
+
+    Astroquery Gaia class whose requests the archive rejects (HTTP 401).
+
+    """
+    from astroquery.gaia.core import GaiaClass
+    return GaiaClass(tap_plus_conn_handler=RejectingConnHandler(), datalink_handler=RejectingConnHandler(),
+                     show_server_messages=False)
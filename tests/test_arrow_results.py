@@ -0,0 +1,116 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from astropy.io import votable
+from astropy.table import MaskedColumn, Table
+
+from ashla.data_access import arrow_results
+from ashla.data_access import schema
+from ashla.data_access.binary_data import BinaryStarDataFrame
+from tests.fake_tap import FakeGaia, fake_gaia_data_access
+
+
+def results_table():
+    # Archive results, as parsed from a binary VOTable
+    table = Table()
+    table['source_id'] = np.array([1, 2, 3, 4], dtype=np.int64)
+    table['parallax'] = MaskedColumn([1.5, 2.5, 3.5, 4.5], mask=[False, True, False, False])
+    table['radial_velocity'] = MaskedColumn([10., 20., 30., 40.], mask=[True, False, False, True])
+    table['hip'] = MaskedColumn(np.array([7, 0, 9, 0], dtype=np.int32), mask=[False, True, False, True])
+    table['phot_variable_flag'] = np.array(['VARIABLE', 'NOT_AVAILABLE', 'VARIABLE', 'CONSTANT'])
+    votable_file = io.BytesIO()
+    votable.from_table(table).to_xml(votable_file, tabledata_format='binary2')
+    votable_file.seek(0)
+    results = votable.parse_single_table(votable_file).to_table()
+    # FITS results have big endian columns
+    results['radial_velocity'] = results['radial_velocity'].astype('>f8')
+    return results
+
+
+def test_votable_results_to_arrow():
+    results = results_table()
+    assert not results['radial_velocity'].dtype.isnative
+    table = arrow_results.table_to_arrow(results)
+    assert table.column_names == ['source_id', 'parallax', 'radial_velocity', 'hip', 'phot_variable_flag']
+    assert table.column('source_id').type == pa.int64()
+    assert table.column('source_id').to_pylist() == [1, 2, 3, 4]
+    # Masked values are nulls
+    assert table.column('parallax').to_pylist() == [1.5, None, 3.5, 4.5]
+    assert table.column('radial_velocity').to_pylist() == [None, 20., 30., None]
+    assert table.column('hip').type == pa.int32()
+    assert table.column('hip').to_pylist() == [7, None, 9, None]
+    assert table.column('phot_variable_flag').type == pa.string()
+    assert table.column('phot_variable_flag').to_pylist() == ['VARIABLE', 'NOT_AVAILABLE', 'VARIABLE', 'CONSTANT']
+    # Not consumed
+    assert len(results.colnames) == 5
+
+
+def test_consumed_table_is_emptied():
+    results = results_table()
+    table = arrow_results.table_to_arrow(results, consume=True)
+    assert results.colnames == []
+    assert table.num_rows == 4
+
+
+def test_compact_arrow_table():
+    table = arrow_results.table_to_arrow(results_table())
+    table = table.append_column('nsys', pa.array([2, 2, 300, None], type=pa.int64()))
+    compacted = schema.compact_arrow_table(table)
+    assert compacted.column('source_id').type == pa.int64()
+    assert compacted.column('radial_velocity').type == pa.float32()
+    assert compacted.column('radial_velocity').to_pylist() == [None, 20., 30., None]
+    assert compacted.column('parallax').type == pa.float64()
+    assert compacted.column('hip').to_pylist() == [7, None, 9, None]
+    assert pa.types.is_dictionary(compacted.column('phot_variable_flag').type)
+    assert compacted.column('phot_variable_flag').to_pylist() == table.column('phot_variable_flag').to_pylist()
+    # 300 doesn't fit the schema's int8, so the column is left as it is
+    assert compacted.column('nsys').type == pa.int64()
+    assert compacted.column('nsys').to_pylist() == [2, 2, 300, None]
+
+
+def test_from_arrow():
+    table = arrow_results.table_to_arrow(results_table())
+    arrow_backed = BinaryStarDataFrame.from_arrow(table, arrow_backed=True)
+    assert isinstance(arrow_backed['radial_velocity'].dtype, pd.ArrowDtype)
+    assert arrow_backed['radial_velocity'].isna().tolist() == [True, False, False, True]
+    assert arrow_backed['hip'].isna().tolist() == [False, True, False, True]
+
+    converted = BinaryStarDataFrame.from_arrow(arrow_results.table_to_arrow(results_table()))
+    assert converted['source_id'].dtype == np.int64
+    assert converted['radial_velocity'].dtype == np.float32
+    assert converted['parallax'].isna().tolist() == [False, True, False, False]
+    # Integer columns with nulls are nullable, rather than float
+    assert converted['hip'].dtype == 'Int32'
+    assert converted['hip'].tolist()[0] == 7
+    assert converted['hip'].isna().tolist() == [False, True, False, True]
+    assert isinstance(converted['phot_variable_flag'].dtype, pd.CategoricalDtype)
+    assert converted['phot_variable_flag'].tolist() == ['VARIABLE', 'NOT_AVAILABLE', 'VARIABLE', 'CONSTANT']
+
+    # Both hold the same values
+    for column in converted.columns:
+        assert (arrow_backed[column].astype(object).where(arrow_backed[column].notna(), None).tolist() ==
+                converted[column].astype(object).where(converted[column].notna(), None).tolist())
+
+
+def test_arrow_backed_query_round_trip(tmp_path):
+    fake_gaia = FakeGaia(results=lambda query, **kwargs: results_table())
+    gaia_data_access = fake_gaia_data_access(fake_gaia, cache_dir=str(tmp_path / 'cache'))
+    table = gaia_data_access.gaia_query_to_arrow("SELECT 1", parquet_output_name=str(tmp_path / 'results'))
+    assert table.column('parallax').to_pylist() == [1.5, None, 3.5, 4.5]
+    # Answered from the cache the second time, the same as the first
+    assert gaia_data_access.gaia_query_to_arrow("SELECT 1").equals(table)
+    assert len(fake_gaia.calls) == 1
+
+    data = gaia_data_access.gaia_query_to_pandas("SELECT 1", arrow_backed=True)
+    assert isinstance(data, BinaryStarDataFrame)
+    assert len(fake_gaia.calls) == 1
+    assert data['source_id'].tolist() == [1, 2, 3, 4]
+    assert data['radial_velocity'].isna().tolist() == [True, False, False, True]
+    assert data['hip'].isna().tolist() == [False, True, False, True]
+    # The same values as the to_pandas path
+    expected = gaia_data_access.gaia_query_to_pandas("SELECT 2")
+    for column in ['source_id', 'parallax', 'radial_velocity', 'hip']:
+        np.testing.assert_array_equal(data[column].to_numpy(dtype=np.float64, na_value=np.nan),
+                                      expected[column].to_numpy(dtype=np.float64, na_value=np.nan))
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+from ashla.data_access.binary_data import BinaryStarDataFrame, BinarySystemDataFrame, group_binary_systems
+from ashla.data_access.known_binaries import KnownBinariesIndex
+
+
+def stars():
+    return pd.DataFrame({'source_id': np.array([10, 11, 12, 20, 21, 5], dtype=np.int64),
+                         'parallax': [10., 10.1, 9.9, 5., 5.1, 2.],
+                         'phot_g_mean_mag': [12., 10., 14., 11., 13., 9.]})
+
+
+def test_binary_ids_stay_integers():
+    index = KnownBinariesIndex.from_arrays(np.array([10, 11, 12, 20, 21]), np.array([1, 1, 1, 2, 2]))
+    data = BinaryStarDataFrame(stars()).add_binary_sys_id_column(known_binaries_index=index)
+    assert data['binary_id'].dtype == 'Int64'
+    assert data['binary_id'].tolist()[:5] == [1, 1, 1, 2, 2]
+    assert data['binary_id'].isna().tolist() == [False] * 5 + [True]
+
+    systems = BinarySystemDataFrame(data)
+    assert systems.index.dtype == 'Int64'
+    assert systems.index.tolist() == [1, 2]
+    assert systems['num_stars'].tolist() == [3, 2]
+    # Brightest star first
+    assert systems['source_id_1'].tolist() == [11, 20]
+
+
+def test_grouped_columns_keep_their_dtypes():
+    data = pd.DataFrame({'binary_id': pd.array([1, 1, 1, 2, 2], dtype='Int64'),
+                         'source_id': np.array([10, 11, 12, 20, 21], dtype=np.int64),
+                         'hip': pd.array([100, None, 102, None, 201], dtype='Int32'),
+                         'phot_g_mean_mag': pd.array([12., 10., None, 11., 13.], dtype='Float32'),
+                         'flag': pd.Categorical(['VARIABLE', None, 'CONSTANT', 'CONSTANT', None]),
+                         'in_hip': pd.array([True, None, False, True, True], dtype='boolean'),
+                         'name': ['a', 'b', 'c', 'd', 'e']})
+    systems = group_binary_systems(data)
+    assert systems['source_id_1'].dtype == 'Int64'
+    assert systems['hip_1'].dtype == 'Int32'
+    assert systems['phot_g_mean_mag_1'].dtype == 'Float32'
+    assert systems['in_hip_1'].dtype == 'boolean'
+    assert systems['flag_1'].dtype == data['flag'].dtype
+    assert systems['name_1'].dtype == data['name'].dtype
+    # Brightest first, the star without a magnitude last, and missing values kept apart from missing stars
+    assert systems['source_id_1'].tolist() == [11, 20]
+    assert systems['source_id_3'].isna().tolist() == [False, True]
+    assert systems['hip_1'].isna().tolist() == [True, True]
+    assert systems['hip_3'].tolist()[0] == 102
+    assert systems['phot_g_mean_mag_3'].isna().all()
+    assert systems['flag_2'].tolist()[0] == 'VARIABLE'
+    assert systems['flag_3'].tolist() == ['CONSTANT', np.nan]
+    assert systems['in_hip_1'].isna().tolist() == [True, False]
+    assert systems['name_2'].tolist() == ['a', 'e']
+
+
+def test_string_binary_ids():
+    index = KnownBinariesIndex.from_arrays(np.array([10, 11]), np.array(['A', 'A'], dtype=object))
+    data = BinaryStarDataFrame(stars()).add_binary_sys_id_column(known_binaries_index=index)
+    assert data['binary_id'].tolist()[:2] == ['A', 'A']
+    assert data['binary_id'].isna().sum() == 4
+
+
+def test_construction_keeps_dtypes_and_shares_data():
+    data = stars()
+    star_df = BinaryStarDataFrame(data)
+    assert (star_df.dtypes == data.dtypes).all()
+    assert np.shares_memory(star_df['parallax'].to_numpy(), data['parallax'].to_numpy())
+
+
+def test_compacting_keeps_parallaxes_float64(tmp_path):
+    data = stars()
+    data['parallax_error'] = 0.1
+    compact = BinaryStarDataFrame(data, compact=True)
+    assert compact['phot_g_mean_mag'].dtype == np.float32
+    assert compact['parallax'].dtype == np.float64
+    assert compact['parallax_error'].dtype == np.float64
+    assert compact['dist_pc'].dtype == np.float64
+    np.testing.assert_array_equal(compact['dist_pc'], 1000. / data['parallax'])
+
+    path = str(tmp_path / 'stars.parquet')
+    BinaryStarDataFrame(data).to_df().to_parquet(path)
+    read = BinaryStarDataFrame.from_parquet(path)
+    assert read['phot_g_mean_mag'].dtype == np.float32
+    assert read['parallax'].dtype == np.float64
+
+
+def test_dask_frame_matches_pandas(tmp_path):
+    import dask.dataframe as dd
+    from ashla.data_access.binary_data import DaskBinaryStarDataFrame
+    rng = np.random.default_rng(3)
+    num_rows = 1000
+    data = pd.DataFrame({'source_id': np.arange(num_rows, dtype=np.int64) + 10,
+                         'ra': rng.uniform(0., 360., num_rows),
+                         'dec': rng.uniform(-90., 90., num_rows),
+                         'parallax': rng.uniform(1., 20., num_rows),
+                         'parallax_error': rng.uniform(0.01, 0.2, num_rows),
+                         'phot_g_mean_mag': rng.uniform(5., 20., num_rows),
+                         'bp_g': rng.uniform(-0.5, 2., num_rows)})
+    index = KnownBinariesIndex.from_arrays(np.array([10, 11, 500, 501]), np.array([1, 1, 2, 2]))
+    path = str(tmp_path / 'stars')
+    dd.from_pandas(data, npartitions=4).to_parquet(path)
+    dask_stars = DaskBinaryStarDataFrame.from_parquet(path)
+    expected = (BinaryStarDataFrame(data, copy=True).add_cartesian_coords_cols().add_plotting_data_cols()
+                .add_binary_sys_id_column(known_binaries_index=index))
+    computed = (dask_stars.add_cartesian_coords_cols().add_plotting_data_cols()
+                .add_binary_sys_id_column(known_binaries_index=index).compute(scheduler='sync'))
+    assert dask_stars.npartitions == 4
+    pd.testing.assert_frame_equal(computed.to_df().reset_index(drop=True), expected.to_df()[computed.columns])
+    assert computed['binary_id'].dtype == 'Int64'
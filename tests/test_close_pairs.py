@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from ashla.data_access import close_pairs
+
+
+def make_stars(num_stars, seed, num_pairs=0, min_dist=20., max_dist=200.):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0., 360., num_stars)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., num_stars)))
+    dist = rng.uniform(min_dist, max_dist, num_stars)
+    # Close pairs: the second star of each pair is put 0.5 pc from the first on the sky
+    dist[1:2 * num_pairs:2] = dist[:2 * num_pairs:2]
+    offset = np.degrees(0.5 / dist[:2 * num_pairs:2])
+    dec[1:2 * num_pairs:2] = np.clip(dec[:2 * num_pairs:2] + offset, -90., 90.)
+    ra[1:2 * num_pairs:2] = ra[:2 * num_pairs:2]
+    parallax_error = rng.uniform(0.02, 0.2, num_stars)
+    return pd.DataFrame({'source_id': np.arange(num_stars),
+                         'ra': ra,
+                         'dec': dec,
+                         'parallax': 1000. / dist + rng.normal(0., 1., num_stars) * parallax_error,
+                         'parallax_error': parallax_error})
+
+
+def brute_force_pairs(stars1, stars2, max_dist, parallax_error_factor):
+    """
+
+    Every pair of stars meeting the archive query's cuts, checking all N^2 pairs.
+
+    """
+    def unit(stars):
+        ra, dec = np.radians(stars['ra'].to_numpy()), np.radians(stars['dec'].to_numpy())
+        return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+    plx1, plx2 = stars1['parallax'].to_numpy()[:, None], stars2['parallax'].to_numpy()[None, :]
+    err1, err2 = stars1['parallax_error'].to_numpy()[:, None], stars2['parallax_error'].to_numpy()[None, :]
+    chord = np.linalg.norm(unit(stars1)[:, None, :] - unit(stars2)[None, :, :], axis=2)
+    sep = (1000. / plx1 + 1000. / plx2) * chord / 2.
+    ok = (np.abs(plx1 - plx2) <= np.sqrt(err1 ** 2 + err2 ** 2) * parallax_error_factor) & (sep <= max_dist)
+    first, second = np.nonzero(ok)
+    ids1, ids2 = stars1['source_id'].to_numpy()[first], stars2['source_id'].to_numpy()[second]
+    return {(id1, id2) for id1, id2 in zip(ids1, ids2) if id1 != id2}
+
+
+def test_pairs_match_brute_force():
+    stars = make_stars(2000, seed=1, num_pairs=50)
+    pairs = close_pairs.find_close_star_pairs(stars, max_dist=1.0, min_parallax_over_error=None,
+                                              require_kinematics=False)
+    found = set(zip(pairs['id1'], pairs['id2']))
+    expected = {(min(pair), max(pair)) for pair in brute_force_pairs(stars, stars, 1.0, 1.2)}
+    # Parallax errors split a few of the injected pairs
+    assert len(expected) >= 30
+    assert found == expected
+    assert (pairs['dist'] <= 1.0).all()
+
+
+def test_cross_pairs_match_brute_force():
+    stars = make_stars(1500, seed=2, num_pairs=40)
+    stars1, stars2 = stars.iloc[::2], stars.iloc[1::2]
+    pairs = close_pairs.find_close_star_pairs(stars1, other=stars2, max_dist=2.0, min_parallax_over_error=None,
+                                              require_kinematics=False)
+    found = set(zip(pairs['id1'], pairs['id2']))
+    assert found == brute_force_pairs(stars1, stars2, 2.0, 1.2)
+
+
+def test_candidates_scale_with_the_sky_density():
+    # Distant stars search tiny circles, so there are fewer candidates than stars, rather than N^2
+    stars = make_stars(50000, seed=3, min_dist=100., max_dist=2000.)
+    arrays = close_pairs._star_arrays(close_pairs.prepare_single_stars(stars, None, False), 1.0)
+    first, _ = close_pairs._candidate_pairs(arrays['positions'], arrays['search_radius'])
+    assert len(first) < len(stars)
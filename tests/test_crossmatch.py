@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+from astropy.io.votable import parse_single_table
+from astropy.table import Table
+
+from ashla.data_access import crossmatch
+from ashla.data_access import query_cache
+from tests.fake_tap import FakeGaia, fake_gaia_data_access
+
+
+def join_upload(query, upload_resource=None, upload_table_name=None, **kwargs):
+    # Archive stand in: every source has phot_g_mean_mag = source_id / 1000, except source_ids divisible by 7
+    upload = parse_single_table(upload_resource).to_table()
+    found = upload['source_id'] % 7 != 0
+    return Table({crossmatch.ROW_COLUMN: upload[crossmatch.ROW_COLUMN][found],
+                  'phot_g_mean_mag': upload['source_id'][found] / 1000.})
+
+
+def candidates(num_rows=300):
+    return pd.DataFrame({'source_id': np.arange(num_rows, dtype=np.int64) * 3 + 1},
+                        index=pd.Index(np.arange(num_rows)[::-1] * 10, name='candidate'))
+
+
+def test_chunks_have_their_own_cache_keys(tmp_path):
+    upload = crossmatch.upload_table(candidates(), 'source_id')
+    chunks = crossmatch.write_upload_chunks(upload, str(tmp_path), max_upload_bytes=2000)
+    assert len(chunks) > 1
+    query = crossmatch.crossmatch_query(['g.phot_g_mean_mag'], 'gaiaedr3.gaia_source', 'source_id')
+    keys = {query_cache.query_key(query, job_kwargs={'upload_resource': path,
+                                                     'upload_table_name': crossmatch.UPLOAD_TABLE_NAME})
+            for path in chunks}
+    assert len(keys) == len(chunks)
+
+
+def test_cached_cross_match_upload_matches_every_row(tmp_path):
+    data = candidates()
+    expected = (data['source_id'] / 1000.).where(data['source_id'] % 7 != 0)
+    fake_gaia = FakeGaia(results=join_upload)
+    gaia_data_access = fake_gaia_data_access(fake_gaia, cache_dir=str(tmp_path / 'cache'))
+    for _ in range(2):
+        matches = gaia_data_access.cross_match_upload(data, columns=['g.phot_g_mean_mag'], max_upload_bytes=2000)
+        assert matches.index.equals(data.index)
+        np.testing.assert_allclose(matches['phot_g_mean_mag'].astype(float), expected)
+    # The second cross match is answered from the cache
+    num_chunks = len(fake_gaia.calls)
+    assert num_chunks > 1
+    assert gaia_data_access.query_cache.hits == num_chunks
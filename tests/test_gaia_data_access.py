@@ -0,0 +1,183 @@
+import copy
+import threading
+
+import pytest
+import requests
+
+import ashla.data_access as da
+from ashla.data_access import GaiaDataAccess
+from tests.fake_tap import FakeGaia, fake_gaia_data_access, rejecting_gaia
+
+
+class NoLogin(GaiaDataAccess):
+
+    def connect(self):
+        raise AssertionError("Logged in")
+
+
+def test_probing_attributes_does_not_log_in():
+    gaia_data_access = NoLogin()
+    assert not hasattr(gaia_data_access, 'no_such_attribute')
+    assert not hasattr(gaia_data_access, '_repr_html_')
+    assert not hasattr(gaia_data_access, '__deepcopy__')
+    with pytest.raises(AttributeError):
+        gaia_data_access.get_status_messages
+    # Logging out when not logged in doesn't log in first
+    gaia_data_access.logout()
+    copied = copy.copy(gaia_data_access)
+    assert copied.login_config == gaia_data_access.login_config
+
+
+def test_gaia_methods_are_passed_on():
+    fake_gaia = FakeGaia()
+    gaia_data_access = fake_gaia_data_access(fake_gaia)
+    assert gaia_data_access.launch_job_async == fake_gaia.launch_job_async
+    gaia_data_access.launch_job_async("SELECT 1")
+    assert fake_gaia.calls == [("SELECT 1", {})]
+    # cross_match_upload doesn't hide the Astroquery cross_match of archive tables
+    assert 'cross_match' in da.GAIA_METHODS
+
+
+class FakeLoginGaia(FakeGaia):
+    """
+
+    FakeGaia standing in for the Astroquery GaiaClass, recording logins and logouts. Jobs on a session which has been
+    rejected (rejected = True) raise what Astroquery raises when the archive rejects the login.
+
+    """
+
+    sessions = []
+
+    def __init__(self):
+        super().__init__()
+        self.logged_in = False
+        self.logged_out = False
+        self.rejected = False
+        FakeLoginGaia.sessions.append(self)
+
+    def login(self, user=None, password=None):
+        self.logged_in = (user, password)
+
+    def login_gui(self, verbose=False):
+        self.logged_in = 'gui'
+
+    def logout(self):
+        self.logged_out = True
+
+    def launch_job_async(self, query, **kwargs):
+        if self.rejected:
+            return rejecting_gaia().launch_job_async(query)
+        return super().launch_job_async(query, **kwargs)
+
+    def launch_job(self, query, **kwargs):
+        if self.rejected:
+            return rejecting_gaia().launch_job(query)
+        return super().launch_job(query, **kwargs)
+
+
+@pytest.fixture
+def fake_login(monkeypatch):
+    import astroquery.gaia
+    FakeLoginGaia.sessions = []
+    monkeypatch.setattr(astroquery.gaia, 'GaiaClass', FakeLoginGaia)
+    monkeypatch.setattr(GaiaDataAccess, '_get_login_details', lambda self: self._login_details or ('user', 'password'))
+    return FakeLoginGaia.sessions
+
+
+@pytest.mark.parametrize('asyncronous', [True, False])
+def test_rejected_session_is_logged_out_and_renewed(fake_login, asyncronous):
+    gaia_data_access = GaiaDataAccess()
+    first = gaia_data_access.connect()
+    first.rejected = True
+    gaia_data_access.launch_gaia_job("SELECT 1", asyncronous=asyncronous)
+    assert len(fake_login) == 2
+    assert first.logged_out
+    second = fake_login[1]
+    assert second.logged_in and not second.logged_out
+    assert second.calls == [("SELECT 1", {})]
+
+
+def test_expired_session_is_logged_out(fake_login):
+    gaia_data_access = GaiaDataAccess(session_max_age=0.)
+    first = gaia_data_access.connect()
+    gaia_data_access._login_time -= 1.
+    assert gaia_data_access.connect() is not first
+    assert first.logged_out
+
+
+def test_renewal_during_a_running_job(fake_login):
+    gaia_data_access = GaiaDataAccess(session_max_age=60.)
+    first = gaia_data_access.connect()
+    job_started, renewed = threading.Event(), threading.Event()
+    logged_out_while_running = []
+
+    def results(query, **kwargs):
+        job_started.set()
+        renewed.wait(5.)
+        logged_out_while_running.append(first.logged_out)
+        return FakeGaia().results(query)
+
+    first.results = results
+    job = threading.Thread(target=gaia_data_access.gaia_query_to_pandas, args=("SELECT 1",))
+    job.start()
+    assert job_started.wait(5.)
+    # The session ages out while the job runs: new jobs get a new session, the running job keeps the old one
+    gaia_data_access._login_time -= 120.
+    second = gaia_data_access.connect()
+    assert second is not first
+    assert not first.logged_out
+    renewed.set()
+    job.join(5.)
+    assert logged_out_while_running == [False]
+    assert first.logged_out
+    assert not second.logged_out
+
+
+def test_renew_of_an_already_replaced_session_keeps_the_new_one(fake_login):
+    gaia_data_access = GaiaDataAccess()
+    first = gaia_data_access.connect()
+    second = gaia_data_access.renew(first)
+    assert gaia_data_access.renew(first) is second
+    assert not second.logged_out
+
+
+def test_login_errors():
+    gaia = rejecting_gaia()
+    for launch in (gaia.launch_job_async, gaia.launch_job):
+        # The exceptions Astroquery raises when the archive rejects the login
+        with pytest.raises(requests.exceptions.HTTPError) as error:
+            launch("SELECT 1")
+        assert da._is_login_error(error.value)
+
+    def http_error(message, status_code=None):
+        response = None
+        if status_code is not None:
+            response = requests.Response()
+            response.status_code = status_code
+        return requests.exceptions.HTTPError(message, response=response)
+
+    assert da._is_login_error(http_error("Forbidden"))
+    assert da._is_login_error(http_error("Error 403:\nForbidden"))
+    assert da._is_login_error(http_error("Access denied", 403))
+    assert not da._is_login_error(http_error("Unauthorized", 500))
+    assert not da._is_login_error(http_error("Error 500:\nServer error"))
+    assert not da._is_login_error(RuntimeError("Unauthorized"))
+
+
+def test_login_and_logout(fake_login, tmp_path):
+    gaia_data_access = GaiaDataAccess()
+    first = gaia_data_access.login(user='someone', password='secret')
+    assert first.logged_in == ('someone', 'secret')
+    credentials_file = tmp_path / 'credentials.txt'
+    credentials_file.write_text("other\nsecret2\n")
+    second = gaia_data_access.login(credentials_file=str(credentials_file))
+    assert second.logged_in == ('other', 'secret2')
+    assert first.logged_out
+    # Renewing the session logs in with the same details
+    assert gaia_data_access.renew().logged_in == ('other', 'secret2')
+    gui = gaia_data_access.login_gui()
+    assert gui.logged_in == 'gui'
+    assert gaia_data_access.connect() is gui
+    gaia_data_access.logout()
+    assert gui.logged_out
+    assert len(fake_login) == 4
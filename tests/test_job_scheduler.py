@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from ashla.data_access import job_scheduler
+from tests.fake_tap import FakeGaia, fake_gaia_data_access
+
+QUERIES = ["SELECT source_id, parallax FROM gaiaedr3.gaia_source WHERE source_id BETWEEN {0} AND {1}".format(
+    num * 100, num * 100 + 99) for num in range(8)]
+
+
+def test_concurrency_limit():
+    fake_gaia = FakeGaia(delay=0.05)
+    scheduler = job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia), max_concurrent=3)
+    results = scheduler.run(QUERIES)
+    assert len(fake_gaia.calls) == len(QUERIES)
+    assert 1 < fake_gaia.max_running <= 3
+    assert len(results) == 3 * len(QUERIES)
+
+
+def test_results_in_query_order():
+    fake_gaia = FakeGaia(delay=0.01)
+    results = job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia), max_concurrent=4).run(QUERIES)
+    first_ids = results['source_id'].to_numpy()[::3]
+    assert list(first_ids) == [sum(query.encode('utf-8')) for query in QUERIES]
+
+
+def test_failed_jobs_are_retried():
+    fake_gaia = FakeGaia(num_failures=2)
+    scheduler = job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia), max_concurrent=1, max_retries=2,
+                                           retry_wait=0.)
+    results = scheduler.run(QUERIES[:3])
+    assert len(fake_gaia.calls) == 5
+    assert len(results) == 9
+
+
+def test_jobs_failing_every_retry_raise():
+    fake_gaia = FakeGaia(num_failures=3)
+    scheduler = job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia), max_concurrent=1, max_retries=2,
+                                           retry_wait=0.)
+    with pytest.raises(RuntimeError, match="1 of 2 queries failed"):
+        scheduler.run(QUERIES[:2])
+    assert len(fake_gaia.calls) == 4
+
+
+def test_resume_skips_finished_queries(tmp_path):
+    output_dir = str(tmp_path / 'tiles')
+    scheduler = job_scheduler.JobScheduler(fake_gaia_data_access(), max_concurrent=2)
+    files = scheduler.run(QUERIES, output_dir=output_dir)
+    assert all(os.path.exists(path) for path in files)
+    assert not [name for name in os.listdir(output_dir) if name.endswith('.tmp')]
+
+    fake_gaia = FakeGaia()
+    scheduler = job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia), max_concurrent=2)
+    assert scheduler.run(QUERIES, output_dir=output_dir) == files
+    assert fake_gaia.calls == []
+
+
+def test_resume_reruns_partial_files(tmp_path):
+    output_dir = str(tmp_path / 'tiles')
+    files = job_scheduler.JobScheduler(fake_gaia_data_access()).run(QUERIES[:3], output_dir=output_dir)
+    # A file cut short by a crash
+    with open(files[1], 'r+b') as tile_file:
+        tile_file.truncate(20)
+    fake_gaia = FakeGaia()
+    job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia)).run(QUERIES[:3], output_dir=output_dir)
+    assert [query for query, _ in fake_gaia.calls] == [QUERIES[1]]
+
+
+def test_resume_reruns_different_queries(tmp_path):
+    output_dir = str(tmp_path / 'tiles')
+    job_scheduler.JobScheduler(fake_gaia_data_access()).run(QUERIES[:2], output_dir=output_dir)
+    fake_gaia = FakeGaia()
+    changed = [QUERIES[0], QUERIES[1].replace('gaiaedr3', 'gaiadr2')]
+    job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia)).run(changed, output_dir=output_dir)
+    assert [query for query, _ in fake_gaia.calls] == [changed[1]]
+
+
+def test_tile_queries_cover_the_source_ids():
+    queries = job_scheduler.tile_queries("SELECT * FROM gaiaedr3.gaia_source WHERE {tile_condition}", healpix_level=1)
+    ranges = job_scheduler.healpix_source_id_ranges(1)
+    assert len(queries) == 48
+    assert ranges[0][0] == 0 and ranges[-1][1] == 12 * 4 ** 12 * 2 ** 35 - 1
+    assert all(first == last + 1 for (_, last), (first, _) in zip(ranges, ranges[1:]))
+    with pytest.raises(ValueError):
+        job_scheduler.tile_queries("SELECT * FROM gaiaedr3.gaia_source")
+
+
+def test_tiles_are_written_with_the_parquet_settings(tmp_path):
+    import pyarrow.parquet as pq
+    output_dir = str(tmp_path / 'tiles')
+    scheduler = job_scheduler.JobScheduler(fake_gaia_data_access())
+    files = scheduler.run(QUERIES[:2], output_dir=output_dir, parquet_kwargs={'compression': 'zstd'})
+    assert pq.read_metadata(files[0]).row_group(0).column(0).compression == 'ZSTD'
+
+    partitioned_dir = str(tmp_path / 'partitioned')
+    files = scheduler.run(QUERIES[:2], output_dir=partitioned_dir, parquet_kwargs={'sky_cell_level': 0})
+    assert all(os.path.isdir(path) for path in files)
+    assert pq.read_table(files[1]).num_rows == 3
+    fake_gaia = FakeGaia()
+    job_scheduler.JobScheduler(fake_gaia_data_access(fake_gaia)).run(QUERIES[:2], output_dir=partitioned_dir,
+                                                                     parquet_kwargs={'sky_cell_level': 0})
+    assert fake_gaia.calls == []
@@ -0,0 +1,101 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+
+from ashla.data_access import local_mirror
+from ashla.data_access.local_mirror import LocalGaiaDataAccess, build_local_mirror
+from tests.fake_tap import FakeGaia, fake_gaia_data_access
+
+
+def archive_tables():
+    # Hipparcos systems A (both stars match Gaia, with parallaxes in agreement) and B (the second star's parallaxes
+    # disagree), and star 5, which is not in a system
+    hipparcos = pd.DataFrame({'hip': [1, 2, 3, 4, 5], 'ccdm': ['A', 'A', 'B', 'B', None], 'n_ccdm': [1, 1, 2, 2, 0],
+                              'nsys': [2, 2, 2, 2, 1]})
+    new_reduction = pd.DataFrame({'hip': [1, 2, 3, 4, 5], 'plx': [20., 20.2, 15., 15., 30.],
+                                  'e_plx': [0.5, 0.5, 0.5, 0.5, 0.5]})
+    best_neighbour = pd.DataFrame({'source_id': np.array([101, 102, 103, 104, 105], dtype=np.int64),
+                                   'original_ext_source_id': [1, 2, 3, 4, 5],
+                                   'angular_distance': [0.1, 0.2, 0.1, 0.3, 0.1],
+                                   'gaia_astrometric_params': [5, 5, 5, 5, 5]})
+    dr2_columns = local_mirror.MIRROR_TABLES['gaiadr2.gaia_source']
+    dr2 = pd.DataFrame({col: np.full(5, 1.) for col in dr2_columns})
+    dr2['source_id'] = np.array([101, 102, 103, 104, 105], dtype=np.int64)
+    dr2['parallax'] = [20.1, 20.0, 15.2, 10., 30.]
+    dr2['parallax_error'] = 0.1
+    dr2['parallax_over_error'] = dr2['parallax'] / dr2['parallax_error']
+    dr2['phot_g_mean_mag'] = [9., 8., 10., 11., 7.]
+    dr2['phot_variable_flag'] = 'NOT_AVAILABLE'
+
+    rng = np.random.default_rng(4)
+    num_stars = 200
+    edr3_columns = local_mirror.MIRROR_TABLES['gaiaedr3.gaia_source']
+    edr3 = pd.DataFrame({col: rng.uniform(1., 2., num_stars) for col in edr3_columns})
+    edr3['source_id'] = np.arange(num_stars, dtype=np.int64) + 1000
+    edr3['ra'] = rng.uniform(0., 360., num_stars)
+    edr3['dec'] = rng.uniform(-60., 60., num_stars)
+    edr3['parallax'] = rng.uniform(1., 5., num_stars)
+    edr3['parallax_error'] = edr3['parallax'] / 50.
+    edr3['parallax_over_error'] = edr3['parallax'] / edr3['parallax_error']
+    edr3.loc[::4, 'dr2_radial_velocity'] = np.nan
+    # One close (co-moving) pair
+    edr3.loc[2, edr3_columns[1:]] = edr3.loc[1, edr3_columns[1:]]
+    edr3.loc[2, 'ra'] += 1e-4
+    edr3['random_index'] = rng.permutation(num_stars)
+    return {'public.hipparcos': hipparcos, 'public.hipparcos_newreduction': new_reduction,
+            'gaiadr2.hipparcos2_best_neighbour': best_neighbour, 'gaiadr2.gaia_source': dr2,
+            'gaiaedr3.gaia_source': edr3}
+
+
+def build_mirror(tmp_path):
+    tables = archive_tables()
+
+    def results(query, **kwargs):
+        return Table.from_pandas(tables[re.search(r'FROM (\S+)', query).group(1)])
+
+    fake_gaia = FakeGaia(results=results)
+    mirror_dir = build_local_mirror(fake_gaia_data_access(fake_gaia), str(tmp_path / 'mirror'),
+                                    gaia_source_conditions='parallax > 1')
+    return tables, fake_gaia, mirror_dir
+
+
+def test_build_local_mirror(tmp_path):
+    tables, fake_gaia, mirror_dir = build_mirror(tmp_path)
+    queries = [query for query, _ in fake_gaia.calls]
+    assert len(queries) == len(local_mirror.MIRROR_TABLES)
+    assert [query.endswith('WHERE parallax > 1') for query in queries] == [table.endswith('.gaia_source') for table
+                                                                          in local_mirror.MIRROR_TABLES]
+    for table, columns in local_mirror.MIRROR_TABLES.items():
+        assert os.path.exists(local_mirror.mirror_table_path(mirror_dir, table))
+        read = LocalGaiaDataAccess(mirror_dir).read_table(table)
+        assert list(read.columns) == columns
+        assert len(read) == len(tables[table])
+    edr3 = LocalGaiaDataAccess(mirror_dir).read_table('gaiaedr3.gaia_source')
+    assert edr3['parallax_over_error'].is_monotonic_increasing
+
+
+def test_local_hipp_binaries(tmp_path):
+    _, _, mirror_dir = build_mirror(tmp_path)
+    local = LocalGaiaDataAccess(mirror_dir)
+    binaries = local.gaia_get_hipp_binaries()
+    assert sorted(binaries['source_id']) == [101, 102]
+    assert binaries['num_stars_in_binary_w_data_available'].tolist() == [2, 2]
+    assert 'hipp_parallax' in binaries.columns and 'proper_motion_ra' in binaries.columns
+    every_match = local.gaia_get_hipp_binaries(only_show_stars_with_both_stars_in_data=False)
+    assert sorted(every_match['source_id']) == [101, 102, 103]
+
+
+def test_local_pairs_and_random_selection(tmp_path):
+    tables, _, mirror_dir = build_mirror(tmp_path)
+    local = LocalGaiaDataAccess(mirror_dir)
+    pairs = local.gaia_get_pairs_of_close_stars(max_dist=1.)
+    assert {tuple(sorted(pair)) for pair in zip(pairs['id1'], pairs['id2'])} == {(1001, 1002)}
+
+    selection = local.query_random_selection(10)
+    edr3 = tables['gaiaedr3.gaia_source']
+    expected = edr3.loc[edr3['dr2_radial_velocity'].notnull()].nsmallest(10, 'random_index')['source_id']
+    assert selection['source_id'].tolist() == expected.tolist()
+    assert 'random_index' not in selection.columns
@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ashla.data_access import metrics
+from ashla.data_access.binary_data import BinaryStarDataFrame
+from tests.fake_tap import FakeGaia, fake_gaia_data_access
+
+
+def test_stages_are_recorded(tmp_path):
+    metrics_file = str(tmp_path / 'metrics.jsonl')
+    recorder = metrics.MetricsRecorder(metrics_file=metrics_file, log_records=False)
+    hooked = []
+    recorder.add_hook(hooked.append)
+    with recorder.stage('outer', rows=10) as outer:
+        outer['bytes'] = 80
+        with recorder.stage('inner', job_id='1'):
+            pass
+    with pytest.raises(ValueError):
+        with recorder.stage('failing'):
+            raise ValueError("Failed")
+
+    inner, outer, failing = recorder.records
+    assert [record['stage'] for record in hooked] == ['inner', 'outer', 'failing']
+    assert inner['parent'] == 'outer' and inner['job_id'] == '1'
+    assert outer['parent'] is None and outer['rows'] == 10 and outer['bytes'] == 80
+    assert outer['wall_time_s'] >= inner['wall_time_s'] >= 0.
+    assert 'ValueError' in failing['error']
+    with open(metrics_file) as f:
+        assert [json.loads(line)['stage'] for line in f] == ['inner', 'outer', 'failing']
+
+    summary = recorder.summary()
+    assert summary.loc['outer', 'calls'] == 1
+    assert summary.loc['outer', 'rows'] == 10
+    assert summary.loc['outer', 'bytes'] == 80
+
+
+def test_memory_of_a_stage():
+    recorder = metrics.MetricsRecorder(track_memory=True, log_records=False)
+    with recorder.stage('allocate'):
+        data = np.ones(2_000_000)
+    del data
+    assert recorder.records[0]['peak_memory_mb'] >= 15.
+
+
+def test_disabled_recorder_records_nothing():
+    recorder = metrics.MetricsRecorder(enabled=False)
+    with recorder.stage('stage') as record:
+        record['rows'] = 1
+    assert recorder.records == []
+    assert recorder.summary().empty
+
+
+def test_instrumented_methods_use_the_active_recorder():
+    data = BinaryStarDataFrame(pd.DataFrame({'ra': [10., 20.], 'dec': [-5., 5.], 'dist_pc': [100., 200.]}))
+    data.add_cartesian_coords_cols()
+    with metrics.recording(log_records=False) as recorder:
+        data.add_cartesian_coords_cols()
+    data.add_cartesian_coords_cols()
+    assert [record['stage'] for record in recorder.records] == ['cartesian_coords']
+    assert recorder.records[0]['rows'] == 2
+    # The previous (disabled) recorder is active again
+    assert not metrics.get_recorder().enabled
+
+
+def test_job_stages():
+    recorder = metrics.MetricsRecorder(log_records=False)
+    fake_gaia = FakeGaia()
+    gaia_data_access = fake_gaia_data_access(fake_gaia, metrics_recorder=recorder)
+    data = gaia_data_access.gaia_query_to_pandas("SELECT 1")
+    assert len(data) == 3
+    # Recording runs the job in the background, so the queue wait is timed apart from the download
+    assert fake_gaia.calls == [("SELECT 1", {'background': True})]
+    stages = {record['stage']: record for record in recorder.records}
+    assert list(stages) == ['job_submit', 'queue_wait', 'download_parse', 'to_pandas', 'binary_star_df']
+    assert stages['job_submit']['job_id'] == '1'
+    assert stages['queue_wait']['job_id'] == '1'
+    assert stages['queue_wait']['phase'] == 'COMPLETED'
+    assert stages['download_parse']['rows'] == 3
+    # int64 source_id and float64 parallax
+    assert stages['download_parse']['bytes'] == 3 * 16
+    assert all(record['wall_time_s'] >= 0. for record in recorder.records)
+
+
+def test_dumped_job_stages(tmp_path):
+    recorder = metrics.MetricsRecorder(log_records=False)
+    gaia_data_access = fake_gaia_data_access(metrics_recorder=recorder)
+    output_file = str(tmp_path / 'results.vot')
+    gaia_data_access.gaia_query_to_pandas("SELECT 1", dump_to_file=True, output_file=output_file)
+    stages = {record['stage']: record for record in recorder.records}
+    assert list(stages)[:4] == ['job_submit', 'queue_wait', 'download', 'parse']
+    assert stages['download']['bytes'] > 0
+    assert stages['parse']['rows'] == 3
+
+
+def test_sync_jobs_are_one_stage():
+    recorder = metrics.MetricsRecorder(log_records=False)
+    fake_gaia = FakeGaia()
+    gaia_data_access = fake_gaia_data_access(fake_gaia, metrics_recorder=recorder)
+    gaia_data_access.gaia_query_to_pandas("SELECT 1", asyncronous=False)
+    assert fake_gaia.calls == [("SELECT 1", {})]
+    job = recorder.records[0]
+    assert job['stage'] == 'job' and job['rows'] == 3 and job['job_id'] == '1'
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from ashla.data_access import close_pairs
+from ashla.data_access import pair_metrics
+
+
+def random_stars(num_stars=20000, seed=5):
+    # No binaries: every pair found is a chance alignment
+    rng = np.random.default_rng(seed)
+    dist = rng.uniform(20., 200., num_stars)
+    parallax_error = rng.uniform(0.05, 0.2, num_stars)
+    return pd.DataFrame({'source_id': np.arange(num_stars),
+                         'ra': rng.uniform(0., 360., num_stars),
+                         'dec': np.degrees(np.arcsin(rng.uniform(-1., 1., num_stars))),
+                         'parallax': 1000. / dist + rng.normal(0., 1., num_stars) * parallax_error,
+                         'parallax_error': parallax_error})
+
+
+def test_offset_positions_move_by_the_offset():
+    ra = np.array([0., 120., 300., 10., 45.])
+    dec = np.array([0., 45., -60., 89.9, -89.9])
+    offset = np.array([1., 2., 5., 3., 4.])
+    bearing = np.array([0., 90., 200., 45., 300.])
+    new_ra, new_dec = pair_metrics.offset_positions(ra, dec, offset, bearing)
+    np.testing.assert_allclose(pair_metrics.angular_separation(ra, dec, new_ra, new_dec), offset, rtol=1e-9)
+    assert ((new_ra >= 0.) & (new_ra < 360.)).all()
+    np.testing.assert_allclose(new_dec[0], 1.)
+
+
+def test_chance_rate_of_a_random_catalogue_matches_its_candidates():
+    pair_kwargs = {'max_dist': 2.0, 'min_parallax_over_error': None, 'require_kinematics': False}
+    stars = close_pairs.prepare_single_stars(random_stars(), None, False).to_df()
+    candidates = close_pairs.find_close_star_pairs(stars, **pair_kwargs)
+    sep_bins = np.array([0., 2.])
+    pair_metrics._init_trial_worker(stars)
+    seeds = np.random.SeedSequence(0).spawn(10)
+    chance = np.mean([pair_metrics._chance_alignment_trial(seed, (1.0, 5.0), pair_kwargs, None, sep_bins)[0]
+                      for seed in seeds])
+    assert len(candidates) > 50
+    assert 0.7 < chance / len(candidates) < 1.4
+
+
+def test_estimate_chance_alignment():
+    pairs = pd.DataFrame({'dist': [0.1, 0.5, 0.9]})
+    stars = random_stars(2000)
+    probability = pair_metrics.estimate_chance_alignment(pairs, stars, num_trials=2, max_workers=1, max_dist=1.0,
+                                                         sep_bins=2, min_parallax_over_error=None,
+                                                         require_kinematics=False)
+    assert probability.index.equals(pairs.index)
+    assert ((probability >= 0.) & (probability <= 1.)).all()
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from ashla.data_access import parquet_io
+from ashla.data_access.healpix import SOURCE_ID_HEALPIX_FACTOR
+
+
+def stars(num_rows=5000, seed=2):
+    rng = np.random.default_rng(seed)
+    healpix_12 = rng.integers(0, 12 * 4 ** 12, num_rows)
+    return pd.DataFrame({'source_id': healpix_12 * SOURCE_ID_HEALPIX_FACTOR + rng.integers(0, 1000, num_rows),
+                         'ra': rng.uniform(0., 360., num_rows),
+                         'dec': rng.uniform(-90., 90., num_rows),
+                         'parallax': rng.uniform(0.1, 20., num_rows),
+                         'parallax_over_error': rng.uniform(0., 50., num_rows),
+                         'phot_g_mean_mag': rng.uniform(5., 20., num_rows)})
+
+
+def sorted_rows(data):
+    return data.sort_values('source_id').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('as_arrow', [False, True])
+def test_sky_cell_partitions(tmp_path, as_arrow):
+    data = stars()
+    path = str(tmp_path / 'stars')
+    parquet_io.write_parquet(pa.Table.from_pandas(data) if as_arrow else data, path, sky_cell_level=1)
+    cells = parquet_io.sky_cell(data['source_id'], 1)
+    assert sorted(os.listdir(path)) == sorted("sky_cell={0}".format(cell) for cell in cells.unique())
+    read = parquet_io.read_parquet_table(path).to_pandas()
+    np.testing.assert_array_equal(sorted_rows(read)['sky_cell'], sorted_rows(data.assign(sky_cell=cells))['sky_cell'])
+
+    cell = int(cells.iloc[0])
+    in_cell = parquet_io.read_parquet_table(path, columns=['source_id'], filters=[('sky_cell', '=', cell)])
+    assert in_cell.column_names == ['source_id']
+    assert sorted(in_cell.column('source_id').to_pylist()) == sorted(data['source_id'][cells == cell])
+
+
+def test_filters_and_columns(tmp_path):
+    data = stars()
+    path = str(tmp_path / 'stars.parquet')
+    parquet_io.write_parquet(data, path, row_group_size=500, sort_by='parallax_over_error')
+    metadata = pq.read_metadata(path)
+    assert metadata.num_row_groups == 10
+    assert all(metadata.row_group(num).column(0).statistics.has_min_max for num in range(10))
+
+    read = parquet_io.read_parquet_table(path, columns=['source_id', 'ra'],
+                                         filters=[('parallax_over_error', '>', 20.)], ra_range=(350., 10.),
+                                         dec_range=(-30., 60.)).to_pandas()
+    expected = data.loc[(data['parallax_over_error'] > 20.) & ((data['ra'] >= 350.) | (data['ra'] <= 10.)) &
+                        data['dec'].between(-30., 60.), ['source_id', 'ra']]
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(sorted_rows(read), sorted_rows(expected))
+
+
+@pytest.mark.parametrize('codec', parquet_io.PARQUET_CODECS)
+def test_codecs(tmp_path, codec):
+    data = stars(500)
+    path = str(tmp_path / 'stars.parquet')
+    parquet_io.write_parquet(data, path, compression=codec)
+    assert pq.read_metadata(path).row_group(0).column(0).compression == ('UNCOMPRESSED' if codec == 'none' else
+                                                                         codec.upper())
+    read = parquet_io.read_parquet_table(path).to_pandas()
+    np.testing.assert_array_equal(read['source_id'], data['source_id'])
+    assert read['parallax'].dtype == np.float64
+    assert read['phot_g_mean_mag'].dtype == np.float32
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError):
+        parquet_io.write_parquet(stars(10), str(tmp_path / 'stars.parquet'), compression='zip')
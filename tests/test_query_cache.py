@@ -0,0 +1,121 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table
+
+from ashla.data_access import query_cache
+from tests.fake_tap import fake_gaia_data_access
+
+QUERY = "SELECT source_id, parallax FROM gaiaedr3.gaia_source WHERE parallax > 10"
+
+
+@pytest.fixture
+def gaia_data_access(tmp_path):
+    return fake_gaia_data_access(cache_dir=str(tmp_path / 'cache'))
+
+
+def test_hit_and_miss(gaia_data_access):
+    first = gaia_data_access.gaia_query_to_pandas(QUERY)
+    second = gaia_data_access.gaia_query_to_pandas(QUERY)
+    assert len(gaia_data_access.gaia.calls) == 1
+    pd.testing.assert_frame_equal(first.to_df(), second.to_df())
+    gaia_data_access.gaia_query_to_pandas(QUERY + " AND parallax_over_error > 5")
+    assert len(gaia_data_access.gaia.calls) == 2
+    assert gaia_data_access.query_cache.stats()['hits'] == 1
+    assert gaia_data_access.query_cache.stats()['misses'] == 2
+
+
+def test_use_cache_false_runs_the_query(gaia_data_access):
+    gaia_data_access.gaia_query_to_pandas(QUERY)
+    gaia_data_access.gaia_query_to_pandas(QUERY, use_cache=False)
+    assert len(gaia_data_access.gaia.calls) == 2
+
+
+def test_comments_and_whitespace_share_an_entry(gaia_data_access):
+    gaia_data_access.gaia_query_to_pandas(QUERY)
+    gaia_data_access.gaia_query_to_pandas("-- bright stars\nSELECT  source_id, parallax\n  FROM gaiaedr3.gaia_source "
+                                          "WHERE parallax > 10 -- nearby\n")
+    assert len(gaia_data_access.gaia.calls) == 1
+
+
+def test_quoted_text_is_not_normalised():
+    base = "SELECT * FROM gaiaedr3.gaia_source WHERE phot_variable_flag = "
+    assert query_cache.query_key(base + "'A  B'") != query_cache.query_key(base + "'A B'")
+    assert query_cache.query_key(base + "'A -- B'") != query_cache.query_key(base + "'A'")
+    assert query_cache.query_key(base + "'it''s  -- x'") != query_cache.query_key(base + "'it''s'")
+    assert query_cache.normalise_query('SELECT  "My  Column" -- note\nFROM t') == 'SELECT "My  Column" FROM t'
+    assert query_cache.query_key(base + "'A' -- flag\n") == query_cache.query_key(base + " 'A'")
+
+
+def test_concurrent_puts_of_an_entry(tmp_path):
+    cache = query_cache.QueryCache(str(tmp_path))
+    data = pd.DataFrame({'source_id': np.arange(10000)})
+    errors = []
+
+    def put():
+        try:
+            for _ in range(5):
+                cache.put(QUERY, data)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=put) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
+    pd.testing.assert_frame_equal(cache.get(QUERY), data)
+
+
+def test_release_changes_the_key(tmp_path):
+    cache = query_cache.QueryCache(str(tmp_path))
+    dr2_query = QUERY.replace('gaiaedr3', 'gaiadr2')
+    assert query_cache.query_release(QUERY) == 'edr3'
+    assert query_cache.query_release(dr2_query) == 'dr2'
+    assert cache.key(QUERY) != cache.key(dr2_query)
+    assert cache.key(QUERY) != cache.key(QUERY, release='dr3')
+    cache.put(QUERY, pd.DataFrame({'a': [1]}))
+    assert cache.get(QUERY, release='dr3') is None
+    assert cache.get(QUERY) is not None
+
+
+def test_job_kwargs_change_the_key(tmp_path):
+    cache = query_cache.QueryCache(str(tmp_path / 'cache'))
+    upload_1, upload_2 = str(tmp_path / 'upload_1.vot'), str(tmp_path / 'upload_2.vot')
+    Table({'source_id': np.array([1, 2])}).write(upload_1, format='votable')
+    Table({'source_id': np.array([3, 4])}).write(upload_2, format='votable')
+    key_1 = cache.key(QUERY, job_kwargs={'upload_resource': upload_1, 'upload_table_name': 'ids'})
+    assert key_1 != cache.key(QUERY)
+    assert key_1 != cache.key(QUERY, job_kwargs={'upload_resource': upload_2, 'upload_table_name': 'ids'})
+    assert key_1 != cache.key(QUERY, job_kwargs={'upload_resource': upload_1, 'upload_table_name': 'other'})
+    assert cache.key(QUERY, job_kwargs={'output_format': 'csv'}) != cache.key(QUERY)
+    # Kwargs which don't change the results don't change the key
+    assert cache.key(QUERY, job_kwargs={'verbose': True, 'output_file': 'x.vot'}) == cache.key(QUERY)
+    # Nor does where the upload is, only its content
+    table = Table({'source_id': np.array([1, 2])})
+    assert cache.key(QUERY, job_kwargs={'upload_resource': table}) == cache.key(QUERY, job_kwargs={
+        'upload_resource': Table({'source_id': np.array([1, 2])})})
+
+
+def test_uploads_get_their_own_entries(tmp_path):
+    gaia_data_access = fake_gaia_data_access(cache_dir=str(tmp_path / 'cache'))
+    results = {}
+    for num in range(2):
+        upload = str(tmp_path / 'upload_{0}.vot'.format(num))
+        Table({'source_id': np.array([num])}).write(upload, format='votable')
+        results[num] = gaia_data_access.gaia_query_to_pandas(QUERY, upload_resource=upload,
+                                                             upload_table_name='ids')
+    gaia_data_access.gaia_query_to_pandas(QUERY, upload_resource=upload, upload_table_name='ids')
+    assert len(gaia_data_access.gaia.calls) == 2
+    assert gaia_data_access.query_cache.stats()['entries'] == 2
+
+
+def test_ttl_expires_entries(tmp_path):
+    cache = query_cache.QueryCache(str(tmp_path), ttl=-1)
+    cache.put(QUERY, pd.DataFrame({'a': [1]}))
+    assert cache.get(QUERY) is None
@@ -0,0 +1,104 @@
+import gzip
+import inspect
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ashla.data_access import result_streaming
+from tests.fake_tap import fake_gaia_data_access
+
+
+def write_result_csv(path, num_rows=5000):
+    # The first rows have no radial velocity or flag, integer parallaxes, no values for an unknown column and integers
+    # in an unknown numeric column, as in the first block of many archive results
+    lines = ['source_id,parallax,dr2_radial_velocity,phot_variable_flag,nsys,unknown_col,unknown_num']
+    for num in range(num_rows):
+        if num < 100:
+            lines.append('{0},{1},,,,,{0}'.format(num, num % 7 + 1))
+        else:
+            lines.append('{0},{1},{2},VARIABLE,{3},text{0},{4}'.format(num, num / 3., num * 0.01, num % 300,
+                                                                       num / 3.))
+    with open(path, 'w') as csv_file:
+        csv_file.write('\n'.join(lines) + '\n')
+
+
+def test_csv_types_beyond_the_first_block(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    write_result_csv(path)
+    tables = list(result_streaming.iter_result_file_tables(path, 'csv', chunk_rows=1000, block_size=2048))
+    assert len(tables) == 5
+    assert len({table.schema for table in tables}) == 1
+    table = pa.concat_tables(tables)
+    assert table.num_rows == 5000
+    assert table.schema.field('source_id').type == pa.int64()
+    assert table.schema.field('parallax').type == pa.float64()
+    assert table.schema.field('dr2_radial_velocity').type == pa.float64()
+    assert table.schema.field('unknown_col').type == pa.string()
+    assert table.schema.field('unknown_num').type == pa.float64()
+    np.testing.assert_allclose(table.column('unknown_num').to_numpy()[98:101], [98., 99., 100. / 3.])
+    # Values above the compact Int8 range of nsys still parse
+    assert table.column('nsys').to_numpy(zero_copy_only=False)[-1] == 4999 % 300
+    np.testing.assert_allclose(table.column('parallax').to_numpy()[100:103], np.arange(100, 103) / 3.)
+
+
+def test_csv_column_types_override(tmp_path):
+    path = str(tmp_path / 'results.csv.gz')
+    with gzip.open(path, 'wt') as csv_file:
+        csv_file.write('a,b\n1,2\n3,4\n')
+    table = next(result_streaming.iter_result_file_tables(path, 'csv', column_types={'b': pa.int64()}))
+    assert table.schema.field('a').type == pa.float64()
+    assert table.schema.field('b').type == pa.int64()
+
+
+def test_csv_to_parquet_dataset(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    write_result_csv(path, num_rows=2500)
+    parts = result_streaming.result_file_to_parquet_dataset(path, 'csv', str(tmp_path / 'dataset'), chunk_rows=1000)
+    assert len(parts) == 3
+    assert pq.read_table(str(tmp_path / 'dataset')).num_rows == 2500
+
+
+class FakeOldJob:
+
+    def __init__(self, csv_text):
+        self.csv_text = csv_text
+        self.parameters = {'format': 'csv'}
+        self.outputFile = None
+        self.outputFileUser = None
+
+    def save_results(self, verbose=False):
+        self.outputFile = self.outputFileUser
+        with open(self.outputFile, 'w') as output_file:
+            output_file.write(self.csv_text)
+
+
+class FakeOldJobGaia:
+    """
+
+    Loads old jobs with the argument checking of the Astroquery method (which only takes keyword arguments).
+
+    """
+
+    def __init__(self, csv_text):
+        self.csv_text = csv_text
+        self.jobids = []
+
+    def load_async_job(self, *args, **kwargs):
+        from astroquery.gaia import GaiaClass
+        arguments = inspect.signature(GaiaClass.load_async_job).bind(self, *args, **kwargs).arguments
+        self.jobids.append(arguments['jobid'])
+        return FakeOldJob(self.csv_text)
+
+
+def test_old_job_chunks(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    write_result_csv(path, num_rows=2500)
+    with open(path) as csv_file:
+        fake_gaia = FakeOldJobGaia(csv_file.read())
+    gaia_data_access = fake_gaia_data_access(fake_gaia)
+    chunks = list(gaia_data_access.iter_job_chunks(jobid='1616446549863O', chunk_rows=1000))
+    assert fake_gaia.jobids == ['1616446549863O']
+    assert sum(len(chunk) for chunk in chunks) == 2500
+    parts = gaia_data_access.job_to_parquet_dataset(str(tmp_path / 'dataset'), jobid='1616446549863O')
+    assert pq.read_table(parts[0]).num_rows == 2500
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+from ashla import utils
+
+
+def sky_positions(num_rows=1000, seed=42):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0., 360., num_rows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., num_rows)))
+    # Include the poles and the ends of the RA range
+    ra[:4] = [0., 360., 123.4, 359.9]
+    dec[:4] = [90., -90., 90., -90.]
+    dist = 1000. / rng.uniform(0.5, 50., num_rows)
+    return ra, dec, dist
+
+
+def test_cartesian_matches_skycoord():
+    ra, dec, dist = sky_positions()
+    expected = utils.ra_dec_dist_to_cartesian_skycoord(ra, dec, dist)
+    result = utils.ra_dec_dist_to_cartesian(ra, dec, dist)
+    for exp, res in zip(expected, result):
+        np.testing.assert_allclose(res, exp, rtol=0, atol=1e-9 * dist.max())
+
+
+def test_cartesian_at_the_poles():
+    x, y, z = utils.ra_dec_dist_to_cartesian(np.array([10., 250.]), np.array([90., -90.]), np.array([5., 7.]))
+    np.testing.assert_allclose(x, [0., 0.], atol=1e-12)
+    np.testing.assert_allclose(y, [0., 0.], atol=1e-12)
+    np.testing.assert_allclose(z, [5., -7.])
+
+
+def test_cartesian_out_arrays():
+    ra, dec, dist = sky_positions()
+    expected = utils.ra_dec_dist_to_cartesian_skycoord(ra, dec, dist)
+    out = tuple(np.empty(len(ra), dtype=np.float32) for _ in range(3))
+    result = utils.ra_dec_dist_to_cartesian(ra, dec, dist, out=out)
+    for exp, res, out_array in zip(expected, result, out):
+        assert res is out_array
+        np.testing.assert_allclose(res, exp, rtol=1e-6, atol=1e-6 * dist.max())
+
+
+def test_cartesian_keeps_series_index():
+    ra, dec, dist = sky_positions(10)
+    index = pd.Index(np.arange(10) * 3)
+    x, y, z = utils.ra_dec_dist_to_cartesian(pd.Series(ra, index=index), dec, dist)
+    assert x.index.equals(index) and z.index.equals(index)
+
+
+def test_bv2rgb_array_matches_scalar():
+    b_g_ci = np.linspace(-0.4, 4.5, 50)
+    expected = np.array([utils.bv2rgb(value) for value in b_g_ci])
+    np.testing.assert_allclose(utils.bv2rgb_array(b_g_ci), expected)
+    np.testing.assert_allclose(utils.bv2rgb_array(b_g_ci, lookup_table=utils.bv2rgb_lookup_table()), expected,
+                               atol=1e-3)
+
+
+def test_missing_colours_use_the_fallback():
+    b_g_ci = np.array([0.5, np.nan, np.inf, -np.inf, -0.62 / 0.92])
+    for lookup_table in (None, utils.bv2rgb_lookup_table()):
+        rgb = utils.bv2rgb_array(b_g_ci, lookup_table=lookup_table)
+        assert np.isfinite(rgb).all()
+        np.testing.assert_allclose(rgb[1:4], [utils.FALLBACK_RGB] * 3)
+    # Same as the scalar version
+    np.testing.assert_allclose(utils.bv2rgb(np.nan), utils.FALLBACK_RGB)
+    strings = utils.bv2rgb_colours(b_g_ci, output='string')
+    assert not any('nan' in colour or 'inf' in colour for colour in strings)
+    assert strings[1] == 'rgb(1.0, 1.0, 1.0)'
+    categories = utils.bv2rgb_colours(b_g_ci, output='category')
+    assert not categories.isna().any()